@@ -63,7 +63,10 @@ except ImportError:
     sys_exit("Missing 'dablooms' Python bindings, available from "
              "https://github.com/bitly/dablooms")
 
-VERSION = "0.0.5"
+VERSION = "0.0.6"
+
+#Chunk size used by the block based read parsers (bytes)
+BLOCK_SIZE = 4 * 1024 * 1024
 
 # TODO - Re-examine SAM input and paired vs single mode
 
@@ -109,6 +112,99 @@ def fastq_iterator(handle):
             raise ValueError("Different FASTQ seq/qual lengths for %r" % title)
         yield seq.strip().upper(), title+seq+"+\n"+qual
 
+def fasta_block_iterator(handle, block_size=BLOCK_SIZE):
+    """Block based FASTA parser yielding (upper case sequence, raw record) tuples.
+
+    Reads the input in large chunks and splits these into records by
+    searching for the newline-greater-than record boundaries, which avoids
+    the per-line overhead of fasta_iterator. The raw record is given as a
+    zero-copy buffer slice of the current block (suitable for writing to
+    the output handle), and is exactly the original text.
+    """
+    data = ""
+    start = 0
+    at_eof = False
+    while not at_eof:
+        block = handle.read(block_size)
+        if block:
+            data = data[start:] + block
+        else:
+            #Ensure the final record gets terminated
+            at_eof = True
+            data = data[start:]
+            if data and data[-1] != "\n":
+                data += "\n"
+            data += ">"
+        start = 0
+        if data[:1] != ">" and data.strip(">"):
+            raise ValueError("Bad FASTA line %r" % data.split("\n", 1)[0])
+        while True:
+            end = data.find("\n>", start + 1)
+            if end == -1:
+                break
+            end += 1
+            title_end = data.find("\n", start, end)
+            yield "".join(data[title_end:end].split()).upper(), \
+                  buffer(data, start, end - start)
+            start = end
+
+def fastq_block_iterator(handle, block_size=BLOCK_SIZE):
+    """Block based FASTQ parser yielding (upper case sequence, raw record) tuples.
+
+    Reads the input in large chunks and splits these into four line
+    records using string find calls, which avoids the per-line readline
+    overhead of fastq_iterator. The raw record is given as a zero-copy
+    buffer slice of the current block (suitable for writing to the output
+    handle), and unlike fastq_iterator is exactly the original record
+    (including any text on the '+' line).
+
+    Like fastq_iterator, this assumes simple four line FASTQ records.
+    """
+    data = ""
+    start = 0
+    at_eof = False
+    while not at_eof:
+        block = handle.read(block_size)
+        if block:
+            data = data[start:] + block
+        else:
+            at_eof = True
+            data = data[start:]
+            if not data:
+                break
+            if data[-1] != "\n":
+                data += "\n"
+        start = 0
+        find = data.find
+        while True:
+            title_end = find("\n", start)
+            if title_end == -1:
+                break
+            seq_end = find("\n", title_end + 1)
+            if seq_end == -1:
+                break
+            plus_end = find("\n", seq_end + 1)
+            if plus_end == -1:
+                break
+            qual_end = find("\n", plus_end + 1)
+            if qual_end == -1:
+                break
+            if data[start] != "@":
+                raise ValueError("Expected FASTQ @ line, got %r" \
+                                 % data[start:title_end+1])
+            if data[seq_end + 1] != "+":
+                raise ValueError("Expected FASTQ + line, got %r" \
+                                 % data[seq_end+1:plus_end+1])
+            if seq_end - title_end != qual_end - plus_end:
+                raise ValueError("Different FASTQ seq/qual lengths for %r" \
+                                 % data[start:title_end+1])
+            qual_end += 1
+            yield data[title_end+1:seq_end].rstrip("\r").upper(), \
+                  buffer(data, start, qual_end - start)
+            start = qual_end
+        if at_eof and start < len(data):
+            raise ValueError("Truncated FASTQ record %r" % data[start:])
+
 def fastq_batched_iterator(handle):
     """FASTQ parser yielding (upper case sequence list, raw record(s) string) tuples.
 
@@ -360,9 +456,9 @@ def go(input, output, format, paired, linear_refs, circular_refs, kmer, mismatch
             sys_exit("Paired read format %r not recognised" % format)
     else:
         if format=="fasta":
-            read_iterator = fasta_iterator
+            read_iterator = fasta_block_iterator
         elif format=="fastq":
-            read_iterator = fastq_iterator
+            read_iterator = fastq_block_iterator
         elif format=="sam":
             read_iterator = sam_iterator
         else:
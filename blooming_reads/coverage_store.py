@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+usage = """Chunked compressed coverage store, with range queries.
+
+Combines the coverage output of sam_circular_coverage.py or
+re_pair_circular_sam.py (plain text .cov files, or NumPy binary .npz
+files including multiple sample files) from any number of runs into
+a single store file. Each coverage array (categories by positions,
+for one reference in one sample) is split into fixed size chunks of
+positions, each compressed separately, and an index records where
+each chunk is. A query for a window of coverage then only needs to
+read and decompress the chunks it touches (similar to bigWig files).
+
+To build a store, give the coverage files as arguments with -o, e.g.
+
+coverage_store.py -c circular.fasta -o runs.covstore run1.cov run2.npz
+
+The sample names are taken from the filenames (without the extension),
+or for multiple sample .npz files from the names recorded within them.
+Any references in the FASTA files given with -c are marked as circular,
+so that queries can span their origin.
+
+To query a store, give it with -i along with a region -r REF:START-END
+using zero based coordinates (with the end exclusive). For a circular
+reference the region may extend past the end, wrapping round the
+origin. This prints a line of tab separated values for each category.
+
+The file format is an eight byte magic string, COVSTORE, and the offset
+of the index (unsigned 64 bit little endian integer), followed by the
+chunks (zlib compressed float32 arrays of categories by positions, in
+C order and little endian), with the index as JSON at the end.
+
+This can also be used as a Python module, see the CoverageStore class
+(e.g. used by stack_coverage_plot.py).
+"""
+
+import sys
+import os
+import json
+import struct
+import zlib
+from collections import OrderedDict
+from optparse import OptionParser
+import numpy as np
+
+def sys_exit(msg, error_level=1):
+    """Print error message to stdout and quit with given error level."""
+    sys.stderr.write("%s\n" % msg)
+    sys.exit(error_level)
+
+VERSION = "0.0.1"
+
+MAGIC = "COVSTORE"
+
+#Default number of positions per compressed chunk
+CHUNK_SIZE = 65536
+
+#Number of decompressed chunks to keep for repeated queries
+CACHE_CHUNKS = 32
+
+
+class CoverageStoreWriter(object):
+    """Creates a coverage store file, one array at a time.
+
+    e.g.
+
+    writer = CoverageStoreWriter("example.covstore")
+    writer.add("run1", "chrX", values)
+    writer.close()
+    """
+
+    def __init__(self, filename, chunk_size=CHUNK_SIZE):
+        self.handle = open(filename, "wb")
+        self.chunk_size = chunk_size
+        self.samples = []
+        self.data = dict()
+        #Index offset is filled in by close
+        self.handle.write(MAGIC + struct.pack("<Q", 0))
+
+    def add(self, sample, ref, values, circular=False):
+        """Add the coverage for a reference, shape (categories, length)."""
+        if sample not in self.data:
+            self.samples.append(sample)
+            self.data[sample] = dict()
+        if ref in self.data[sample]:
+            raise ValueError("Already have %s for sample %s" % (ref, sample))
+        values = np.asarray(values, "<f4")
+        chunks = []
+        for start in range(0, values.shape[1], self.chunk_size):
+            chunk = values[:, start:start + self.chunk_size]
+            data = zlib.compress(np.ascontiguousarray(chunk).tostring())
+            chunks.append([self.handle.tell(), len(data),
+                           round(float(chunk.sum(axis=0).max()), 3)])
+            self.handle.write(data)
+        self.data[sample][ref] = {"length": values.shape[1],
+                                  "categories": values.shape[0],
+                                  "circular": bool(circular),
+                                  "chunks": chunks}
+
+    def close(self):
+        """Write the index, and close the file."""
+        offset = self.handle.tell()
+        json.dump({"version": 1, "chunk_size": self.chunk_size,
+                   "samples": self.samples, "data": self.data}, self.handle)
+        self.handle.seek(len(MAGIC))
+        self.handle.write(struct.pack("<Q", offset))
+        self.handle.close()
+
+
+class CoverageStore(object):
+    """Read only access to a coverage store file, see query.
+
+    The index also records the maximum total coverage in each chunk,
+    so chunk_max can give a quick overview without decompressing.
+    """
+
+    def __init__(self, filename):
+        self.handle = open(filename, "rb")
+        if self.handle.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a coverage store" % filename)
+        offset = struct.unpack("<Q", self.handle.read(8))[0]
+        self.handle.seek(offset)
+        index = json.loads(self.handle.read())
+        self.chunk_size = index["chunk_size"]
+        self.samples = [str(s) for s in index["samples"]]
+        self._data = index["data"]
+        self._cache = OrderedDict()
+
+    def _entry(self, ref, sample):
+        if sample is None:
+            if len(self.samples) != 1:
+                raise ValueError("Store has %i samples, which one?" % len(self.samples))
+            sample = self.samples[0]
+        try:
+            return self._data[sample][ref]
+        except KeyError:
+            raise KeyError("No coverage for %s in sample %s" % (ref, sample))
+
+    def references(self, sample=None):
+        """Returns the reference names for the sample, sorted."""
+        if sample is None:
+            return sorted(set(str(r) for s in self.samples for r in self._data[s]))
+        return sorted(str(r) for r in self._data[sample])
+
+    def length(self, ref, sample=None):
+        return self._entry(ref, sample)["length"]
+
+    def is_circular(self, ref, sample=None):
+        return self._entry(ref, sample)["circular"]
+
+    def chunk_max(self, ref, sample=None):
+        """Returns the maximum total coverage of each chunk (from the index)."""
+        return np.array([c[2] for c in self._entry(ref, sample)["chunks"]])
+
+    def _chunk(self, entry, number):
+        offset, size, max_total = entry["chunks"][number]
+        try:
+            values = self._cache.pop(offset)
+        except KeyError:
+            self.handle.seek(offset)
+            values = np.fromstring(zlib.decompress(self.handle.read(size)), "<f4")
+            values = values.reshape(entry["categories"], -1)
+        self._cache[offset] = values
+        if len(self._cache) > CACHE_CHUNKS:
+            self._cache.popitem(last=False)
+        return values
+
+    def query(self, ref, start, end, category=None, sample=None):
+        """Returns the coverage for positions start:end of the reference.
+
+        Uses zero based coordinates (end exclusive). For a circular
+        reference the positions are taken modulo its length, so the
+        region can span the origin. Returns a float32 array of shape
+        (categories, end - start), or just the values for one category
+        if given (as an integer). The sample can only be omitted if the
+        store holds a single sample.
+        """
+        entry = self._entry(ref, sample)
+        length = entry["length"]
+        if end < start:
+            raise ValueError("Region end %i is before start %i" % (end, start))
+        if not entry["circular"] and (start < 0 or length < end):
+            raise ValueError("Region %i:%i is outside linear reference %s of length %i"
+                             % (start, end, ref, length))
+        values = np.empty((entry["categories"], end - start), np.float32)
+        done = 0
+        while start + done < end:
+            #Only wraps round for circular references
+            a = (start + done) % length
+            b = min(length, a + end - start - done)
+            for number in range(a // self.chunk_size, (b - 1) // self.chunk_size + 1):
+                chunk_start = number * self.chunk_size
+                chunk = self._chunk(entry, number)
+                wanted = chunk[:, max(a, chunk_start) - chunk_start:
+                                  min(b, chunk_start + self.chunk_size) - chunk_start]
+                values[:, done:done + wanted.shape[1]] = wanted
+                done += wanted.shape[1]
+        if category is None:
+            return values
+        return values[category]
+
+    def close(self):
+        self.handle.close()
+        self._cache.clear()
+
+
+def get_fasta_ids(fasta_filename):
+    """Returns the record identifiers from a FASTA file."""
+    ids = []
+    handle = open(fasta_filename)
+    for line in handle:
+        if line[0] == ">":
+            ids.append(line[1:].split(None, 1)[0])
+    handle.close()
+    return ids
+
+
+def read_coverage(filename):
+    """Yields (sample, reference, values) from a .cov or .npz coverage file.
+
+    Only per-base coverage is used, any binned coverage in .npz files is
+    ignored. The arrays in .npz files are named refs:0, refs:1, etc with
+    the reference names in refs:names. Plain text files must have five
+    rows of equal length per reference (so not the --stream layout).
+    """
+    sample = os.path.splitext(os.path.basename(filename))[0]
+    if filename.endswith(".npz"):
+        data = np.load(filename)
+        if "samples:names" in data.files:
+            samples = [str(s) for s in data["samples:names"]]
+        else:
+            samples = None
+        if "refs:names" not in data.files:
+            sys_exit("No refs:names array in %s, not a coverage file?" % filename)
+        refs = [(str(ref), "refs:%i" % i) for i, ref in enumerate(data["refs:names"])]
+        for ref, key in sorted(refs):
+            values = data[key]
+            if samples is None:
+                yield sample, ref, values
+            else:
+                for name, sample_values in zip(samples, values):
+                    yield name, ref, sample_values
+        data.close()
+        return
+    handle = open(filename)
+    line = handle.readline()
+    if not line.startswith(">"):
+        sys_exit("Expected > line at start of %s" % filename)
+    while line and line[0] == ">":
+        parts = line[1:].split()
+        ref = parts[0]
+        if parts[-1] == "stream":
+            sys_exit("Coverage for %s in %s is from --stream, which is not supported"
+                     % (ref, filename))
+        length = None
+        if len(parts) > 2 and parts[1] == "length":
+            length = int(parts[2])
+            if parts[3:5] == ["bin", "size"]:
+                #One value per bin, the last bin perhaps shorter
+                length = -(-length // int(parts[5]))
+        rows = []
+        while line:
+            line = handle.readline()
+            if not line or line[0] == ">":
+                break
+            if line.rstrip("\n") == "None":
+                rows.append(None)
+            else:
+                rows.append(np.fromstring(line, np.float32, sep="\t"))
+        if len(rows) != 5:
+            #e.g. --stream output, one row of position and values per base
+            sys_exit("Expected 5 rows of coverage for %s in %s, found %i "
+                     "(output from --stream is not supported)" % (ref, filename, len(rows)))
+        if length is None:
+            length = max(len(row) for row in rows if row is not None)
+        for row in rows:
+            if row is not None and len(row) != length:
+                sys_exit("Expected %i values per row for %s in %s, found %i "
+                         "(output from --stream is not supported)"
+                         % (length, ref, filename, len(row)))
+        yield sample, ref, np.array([np.zeros(length, np.float32) if row is None else row
+                                     for row in rows], np.float32)
+    handle.close()
+
+
+def build(store_filename, coverage_filenames, circular_refs, chunk_size):
+    #Write to a temporary file, so any failure leaves no half written store
+    temp_filename = store_filename + ".tmp"
+    writer = CoverageStoreWriter(temp_filename, chunk_size)
+    try:
+        for filename in coverage_filenames:
+            for sample, ref, values in read_coverage(filename):
+                try:
+                    writer.add(sample, ref, values, ref in circular_refs)
+                except ValueError, err:
+                    sys_exit("%s (from %s)" % (err, filename))
+                sys.stderr.write("Added %s, %s length %i\n" % (sample, ref, values.shape[1]))
+        writer.close()
+    except:
+        #Including sys_exit
+        writer.handle.close()
+        os.remove(temp_filename)
+        raise
+    os.rename(temp_filename, store_filename)
+
+
+def query(store_filename, region, sample):
+    try:
+        ref, positions = region.rsplit(":", 1)
+        start, end = [int(p) for p in positions.split("-")]
+    except ValueError:
+        sys_exit("Bad region %r, expected REF:START-END" % region)
+    store = CoverageStore(store_filename)
+    try:
+        values = store.query(ref, start, end, sample=sample)
+    except (KeyError, ValueError), err:
+        sys_exit(str(err))
+    for row in values:
+        sys.stdout.write("\t".join(["%.1f"] * len(row)) % tuple(row.tolist()) + "\n")
+    store.close()
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options] [coverage files]\n\n" + usage,
+                          version="%prog "+VERSION)
+    parser.add_option("-o", "--output", dest="output",
+                      type="string", metavar="FILE",
+                      help="Coverage store to create from the coverage files")
+    parser.add_option("-c", "--cref", dest="circular_references",
+                      type="string", metavar="FILE", action="append",
+                      help="FASTA file of circular reference sequence(s). "
+                           "Several files can be given if required.")
+    parser.add_option("--chunk-size", dest="chunk_size",
+                      type="int", metavar="N", default=CHUNK_SIZE,
+                      help="Number of positions in each compressed chunk "
+                           "(def. %i)" % CHUNK_SIZE)
+    parser.add_option("-i", "--input", dest="input",
+                      type="string", metavar="FILE",
+                      help="Coverage store to query")
+    parser.add_option("-r", "--region", dest="region",
+                      type="string", metavar="REGION",
+                      help="Region to query, REF:START-END")
+    parser.add_option("-s", "--sample", dest="sample",
+                      type="string", metavar="NAME",
+                      help="Sample to query (required if the store has several)")
+
+    (options, args) = parser.parse_args()
+
+    if len(sys.argv)==1:
+        parser.print_help()
+        sys.exit(1)
+
+    if options.output:
+        if options.input or options.region:
+            parser.error("Give either -o to build a store, or -i and -r to query one")
+        if not args:
+            parser.error("Expected some coverage files to build the store from")
+        if options.chunk_size < 1:
+            parser.error("Chunk size must be at least one")
+        circular_refs = set()
+        for filename in options.circular_references or []:
+            circular_refs.update(get_fasta_ids(filename))
+        build(options.output, args, circular_refs, options.chunk_size)
+    elif options.input:
+        if not options.region:
+            parser.error("Querying a store requires a region (-r)")
+        if args:
+            parser.error("No arguments expected when querying a store")
+        query(options.input, options.region, options.sample)
+    else:
+        parser.error("Give either -o to build a store, or -i and -r to query one")
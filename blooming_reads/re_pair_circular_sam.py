@@ -16,7 +16,10 @@ alignment end point would spill over).
 
 FASTQ file: Used to add missing unmapped reads, often left out
 in the SAM/BAM output of mapping tools. I want this to help
-with downstream analysis.
+with downstream analysis. By default this is indexed (using an
+SQLite database stored alongside it), but if the FASTQ file is in
+the same read name order as the SAM file the --stream-reads option
+can be used to look up the partners in a single sequential pass.
 
 Output:
 
@@ -46,24 +49,67 @@ end data, you might get two, three or even four lines in SAM
 
 import sys
 import os
+from collections import deque
 from optparse import OptionParser
+from StringIO import StringIO
 
 from Bio import SeqIO
 from Bio.SeqIO.QualityIO import _get_sanger_quality_str as qual_str
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
 def sys_exit(msg, error_level=1):
     """Print error message to stdout and quit with given error level."""
     sys.stderr.write("%s\n" % msg)
     sys.exit(error_level)
 
-VERSION = "0.0.2"
+VERSION = "0.0.3"
+
+#Number of read names per chunk in --threads mode
+CHUNK_SIZE = 10000
 
 solo0 = solo1 = solo2 = solo12 = 0
 
 
-def go(input, output, raw_reads, linear_refs, circular_refs, coverage_file):
+class FastqMergeJoin(object):
+    """Dictionary like look up of FASTQ reads, via a streaming merge-join.
 
-    if raw_reads:
+    Assumes the reads will be requested in the same order as they appear
+    in the FASTQ file (e.g. both read name sorted, or the SAM file is in
+    the mapper's input order), so rather than building an index we just
+    advance through the file skipping any reads not requested. Returns
+    (sequence, quality) string tuples, see also get_raw_read.
+    """
+    def __init__(self, filename):
+        self.handle = open(filename)
+        self.iterator = FastqGeneralIterator(self.handle)
+
+    def __getitem__(self, name):
+        for title, seq, qual in self.iterator:
+            if title.split(None, 1)[0] == name:
+                return seq, qual
+        raise KeyError("Read %s not found in FASTQ file, is it in the "
+                       "same order as the SAM file?" % name)
+
+    def close(self):
+        self.handle.close()
+
+
+def get_raw_read(raw_dict, name):
+    """Returns (sequence, Sanger quality) strings for the named raw read."""
+    if isinstance(raw_dict, FastqMergeJoin):
+        return raw_dict[name]
+    rec = raw_dict[name]
+    return str(rec.seq), qual_str(rec)
+
+
+def go(input, output, raw_reads, linear_refs, circular_refs, coverage_file,
+       stream_reads=False, threads=1):
+
+    if raw_reads and stream_reads:
+        assert os.path.isfile(raw_reads)
+        sys.stderr.write("Streaming %s (used for unmapped partners)\n" % raw_reads)
+        raw = FastqMergeJoin(raw_reads)
+    elif raw_reads:
         assert os.path.isfile(raw_reads)
         idx = raw_reads + ".idx"
         if os.path.isfile(idx):
@@ -139,13 +185,134 @@ def go(input, output, raw_reads, linear_refs, circular_refs, coverage_file):
         import numpy
         for lengths in [ref_len_linear, ref_len_circles]:
             for ref, length in lengths.iteritems():
-                coverage[ref] = numpy.zeros((5, length), numpy.float)
+                #Difference array, see add_coverage
+                coverage[ref] = numpy.zeros((5, length + 1), numpy.float)
+
+    batches = batch_by_qname(line, input_handle, ref_len_linear, ref_len_circles)
+    if threads > 1:
+        go_parallel(batches, output_handle, threads, raw_reads,
+                    ref_len_linear, ref_len_circles, coverage)
+    else:
+        for reads in batches:
+            if coverage_file:
+                count_coverage(coverage, reads)
+            flush_cache(output_handle, reads, raw, ref_len_linear, ref_len_circles)
 
+    if isinstance(input, basestring):
+        input_handle.close()
+    if isinstance(output, basestring):
+        output_handle.close()
+    if isinstance(raw, FastqMergeJoin):
+        raw.close()
+
+    if coverage_file and coverage_file.endswith(".npz"):
+        #Compact binary output, one float32 array per reference. These are
+        #named refs:0, refs:1, etc with the reference names in refs:names,
+        #as a reference name could clash with the savez file argument, or
+        #with the REF:BIN_SIZE:STAT names used for binned coverage
+        names = []
+        arrays = dict()
+        for lengths in [ref_len_linear, ref_len_circles]:
+            for ref in lengths:
+                arrays["refs:%i" % len(names)] = materialise_coverage(coverage[ref]).astype(numpy.float32)
+                names.append(ref)
+        arrays["refs:names"] = numpy.array(names)
+        numpy.savez_compressed(coverage_file, **arrays)
+    elif coverage_file:
+        handle = open(coverage_file, "w")
+        for lengths in [ref_len_linear, ref_len_circles]:
+            for ref, length in lengths.iteritems():
+                handle.write(">%s length %i\n" % (ref, length))
+                for row in materialise_coverage(coverage[ref]):
+                    assert len(row) == length
+                    #One format operation per row, much faster than per value
+                    handle.write("\t".join(["%.1f"] * len(row)) % tuple(row.tolist()) + "\n")
+        handle.close()
+    sys.stderr.write("%i singletons; %i where only /1, %i where only /2, %i where both present\n" % (solo0, solo1, solo2, solo12))
+
+
+class SamRead(object):
+    """Compact record for a SAM read line, parsed once.
+
+    Any /1 or /2 suffix is removed from the QNAME and recorded as the
+    fragment number (frag) instead, using 0 for unpaired reads. The
+    remaining fields are kept as strings (except FLAG), with the zero
+    based start and aligned length precomputed for the coverage.
+
+    Records compare equal (and hash) on their fields, so duplicates can
+    be removed with a set. They sort on QNAME, fragment, RNAME, POS (as
+    a string), FLAG, then the remaining fields.
+    """
+    __slots__ = ("qname", "frag", "flag", "rname", "pos", "mapq", "cigar",
+                 "rnext", "pnext", "tlen", "etc", "start", "alen")
+
+    def __init__(self, qname, frag, flag, rname, pos, mapq, cigar,
+                 rnext, pnext, tlen, etc):
+        self.qname = qname
+        self.frag = frag
+        self.flag = flag
+        self.rname = rname
+        self.pos = pos
+        self.mapq = mapq
+        self.cigar = cigar
+        self.rnext = rnext
+        self.pnext = pnext
+        self.tlen = tlen
+        #Remaining fields, including the trailing new line
+        self.etc = etc
+        self.start = int(pos) - 1
+        if cigar == "*":
+            self.alen = 0
+        else:
+            self.alen = cigar_alen(cigar)
+
+    def _key(self):
+        return (self.qname, self.frag, self.rname, self.pos, self.flag,
+                self.mapq, self.cigar, self.rnext, self.pnext, self.tlen,
+                self.etc)
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __eq__(self, other):
+        return self._key() == other._key()
+
+    def __ne__(self, other):
+        return self._key() != other._key()
+
+    def __lt__(self, other):
+        return self._key() < other._key()
+
+    def __repr__(self):
+        return "SamRead%r" % (self._key(),)
+
+    def copy(self):
+        new = SamRead.__new__(SamRead)
+        for attr in SamRead.__slots__:
+            setattr(new, attr, getattr(self, attr))
+        return new
+
+    def to_line(self):
+        """Returns the record as a SAM line (including the new line)."""
+        return "\t".join([self.qname, str(self.flag), self.rname, self.pos,
+                          self.mapq, self.cigar, self.rnext, self.pnext,
+                          self.tlen, self.etc])
+
+
+def batch_by_qname(line, input_handle, ref_len_linear, ref_len_circles):
+    """Yields sets of SamRead records, batching by read name.
+
+    Takes the first SAM read line (after the header), and the handle
+    to read the rest of the SAM file from. Each set holds the records
+    for one read name (with any /1 or /2 suffix removed from the QNAME,
+    and recorded as frag).
+    """
     cur_read_name = None
     reads = set()
     while line:
         #SAM read
-        qname, flag, rname, pos, rest = line.split("\t", 4)
+        qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, etc \
+            = line.split("\t", 9)
         flag = int(flag)
         if " " in qname:
             #Stupid mrfast!
@@ -172,39 +339,118 @@ def go(input, output, raw_reads, linear_refs, circular_refs, coverage_file):
             frag = 2
         else:
             frag = 0 #Assume unpaired
+        read = SamRead(qname, frag, flag, rname, pos, mapq, cigar,
+                       rnext, pnext, tlen, etc)
         if qname == cur_read_name:
-            #Cache this, as a tuple - ordered to allow sorting on position:
-            #Using a set will eliminate duplicates after adjusting POS
-            reads.add((qname, frag, rname, pos, flag, rest))
+            #Cache this, using a set will eliminate duplicates after
+            #adjusting POS (and the records sort on position)
+            reads.add(read)
         else:
-            if coverage_file:
-                count_coverage(coverage, reads)
-            flush_cache(output_handle, reads, raw, ref_len_linear, ref_len_circles)
-            reads = set([(qname, frag, rname, pos, flag, rest)])
+            if reads:
+                yield reads
+            reads = set([read])
             cur_read_name = qname
         #Next line...
         line = input_handle.readline()
-
     if reads:
-        if coverage_file:
-            count_coverage(coverage, reads)
-        flush_cache(output_handle, reads, raw, ref_len_linear, ref_len_circles)
+        yield reads
 
-    if isinstance(input, basestring):
-        input_handle.close()
-    if isinstance(output, basestring):
-        output_handle.close()
 
-    if coverage_file:
-        handle = open(coverage_file, "w")
-        for lengths in [ref_len_linear, ref_len_circles]:
-            for ref, length in lengths.iteritems():
-                handle.write(">%s length %i\n" % (ref, length))
-                for row in coverage[ref]:
-                    assert len(row) == length
-                    handle.write("\t".join("%.1f" % v for v in row) + "\n")
-        handle.close()
-    sys.stderr.write("%i singletons; %i where only /1, %i where only /2, %i where both present\n" % (solo0, solo1, solo2, solo12))
+def init_worker(raw_reads, ref_len_linear, ref_len_circles, want_coverage):
+    """Set up a worker process for the --threads mode (see process_chunk)."""
+    global worker_state
+    if raw_reads:
+        #Index will have been created by the parent process
+        raw = SeqIO.index_db(raw_reads + ".idx")
+    else:
+        raw = dict()
+    worker_state = (raw, ref_len_linear, ref_len_circles, want_coverage)
+
+
+def process_chunk(batches):
+    """Re-pair a list of read batches in a worker process.
+
+    Returns a tuple of the output SAM lines as a single string, the
+    singleton and pair counts, and a dictionary of any coverage events
+    keyed by reference (as arrays of fields, positions and weights to be
+    added into the difference arrays).
+    """
+    global solo0, solo1, solo2, solo12
+    solo0 = solo1 = solo2 = solo12 = 0
+    raw, ref_len_linear, ref_len_circles, want_coverage = worker_state
+    handle = StringIO()
+    events = dict()
+    for reads in batches:
+        if want_coverage:
+            for rname, field, start, end, weight in coverage_updates(reads):
+                if rname in ref_len_circles:
+                    length = ref_len_circles[rname]
+                elif rname in ref_len_linear:
+                    length = ref_len_linear[rname]
+                else:
+                    continue
+                try:
+                    fields, positions, weights = events[rname]
+                except KeyError:
+                    fields, positions, weights = events[rname] = [], [], []
+                for position, multiplier in coverage_events(length, start, end):
+                    fields.append(field)
+                    positions.append(position)
+                    weights.append(multiplier * weight)
+        flush_cache(handle, reads, raw, ref_len_linear, ref_len_circles)
+    import numpy
+    for rname, (fields, positions, weights) in events.items():
+        events[rname] = (numpy.array(fields, numpy.int8),
+                         numpy.array(positions, numpy.int64),
+                         numpy.array(weights, numpy.float))
+    return handle.getvalue(), (solo0, solo1, solo2, solo12), events
+
+
+def go_parallel(batches, output_handle, threads, raw_reads,
+                ref_len_linear, ref_len_circles, coverage):
+    """Re-pair the read batches using a pool of worker processes.
+
+    The batches are grouped into chunks (of whole read names), and the
+    results written in the original order. Any coverage is summed into
+    the given dictionary of difference arrays.
+    """
+    import multiprocessing
+    import numpy
+
+    def chunks():
+        chunk = []
+        for reads in batches:
+            chunk.append(reads)
+            if len(chunk) >= CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def collect(result):
+        global solo0, solo1, solo2, solo12
+        text, counts, events = result
+        output_handle.write(text)
+        solo0 += counts[0]
+        solo1 += counts[1]
+        solo2 += counts[2]
+        solo12 += counts[3]
+        for rname, (fields, positions, weights) in events.iteritems():
+            numpy.add.at(coverage[rname], (fields, positions), weights)
+
+    pool = multiprocessing.Pool(threads, init_worker,
+                                (raw_reads, ref_len_linear, ref_len_circles,
+                                 bool(coverage)))
+    #Limit how many chunks are in memory at once, keeping input order
+    pending = deque()
+    for chunk in chunks():
+        pending.append(pool.apply_async(process_chunk, (chunk,)))
+        if len(pending) >= 2 * threads:
+            collect(pending.popleft().get())
+    while pending:
+        collect(pending.popleft().get())
+    pool.close()
+    pool.join()
 
 
 def cigar_tuples(cigar_str):
@@ -238,69 +484,123 @@ def cigar_alen(cigar_str):
     return alen
 
 
-def count_coverage(coverage, reads):
-    """Update coverage (dict of arrays) using given mapping of a read/pair."""
-    reads1 = [(flag, rname, int(pos)-1, rest.split("\t",2)[1]) \
-              for (qname, frag, rname, pos, flag, rest) \
-              in reads if frag==1 and not (flag & 0x4)]
-    reads2 = [(flag, rname, int(pos)-1, rest.split("\t",2)[1]) \
-              for (qname, frag, rname, pos, flag, rest) \
-              in reads if frag==2 and not (flag & 0x4)]
-    reads0 = [(flag, rname, int(pos)-1, rest.split("\t",2)[1]) \
-              for (qname, frag, rname, pos, flag, rest) \
-              in reads if frag==0 and not (flag & 0x4)]
+def coverage_events(length, start, end):
+    """Difference array events for coverage of start:end (zero based).
+
+    Returns a list of (position, multiplier) tuples, the weight of the
+    read times the multiplier is to be added to the difference array at
+    that position (see add_coverage). Positions past the end of the
+    reference wrap round the origin (i.e. are taken modulo the length),
+    and this is done by splitting the interval in two.
+    """
+    events = []
+    laps, extra = divmod(end - start, length)
+    if laps:
+        #Read is longer than the reference, covers it all at least once
+        events.append((0, laps))
+        events.append((length, -laps))
+    start %= length
+    end = start + extra
+    events.append((start, 1))
+    if end <= length:
+        events.append((end, -1))
+    else:
+        #Spans the origin
+        events.append((length, -1))
+        events.append((0, 1))
+        events.append((end - length, -1))
+    return events
+
+
+def add_coverage(diff, field, start, end, weight):
+    """Record coverage of start:end (zero based) in a difference array.
+
+    The array diff has one more column than the reference length, and
+    the coverage itself is recovered with a cumulative sum along each row
+    (see materialise_coverage).
+    """
+    for position, multiplier in coverage_events(diff.shape[1] - 1, start, end):
+        diff[field, position] += multiplier * weight
+
+
+def materialise_coverage(diff):
+    """Turn a difference array into the coverage array (via cumsum)."""
+    import numpy
+    values = numpy.cumsum(diff, axis=1)[:, :-1]
+    #Remove any floating point noise left after cancelling weights
+    values[values < 1e-9] = 0.0
+    return values
+
+
+def coverage_updates(reads):
+    """Yields (rname, field, start, end, weight) for mapping of a read/pair.
+
+    The field is the coverage category, see count_coverage.
+    """
+    reads0 = []
+    reads1 = []
+    reads2 = []
+    fragments = {0: reads0, 1: reads1, 2: reads2}
+    for read in reads:
+        if read.flag & 0x4:
+            continue
+        fragments[read.frag].append((read.rname, read.start,
+                                     read.start + read.alen))
     if reads0:
         #Singleton
         assert not reads1 and not reads2
-        field = 0
-        for ref, values in coverage.iteritems():
-            length = values.shape[1]
-            r0 = [(pos, pos+cigar_alen(cigar)) for (flag, rname, pos, cigar) in reads0 if ref==rname and not (flag & 0x4)]
-            if len(r0) == len(reads0):
-                #All on this ref
-                field = 0
-            else:
-                #Also on other refs
-                field = 1
-            weight = 1.0 / len(reads0)
-            for start, end in r0:
-                for i in xrange(start, end):
-                    values[field, i % length] += weight
+        if len(set(rname for rname, start, end in reads0)) == 1:
+            #All on this ref
+            field = 0
+        else:
+            #Also on other refs
+            field = 1
+        weight = 1.0 / len(reads0)
+        for rname, start, end in reads0:
+            yield rname, field, start, end, weight
     else:
         #Paired
-        assert not reads0
-        for ref, values in coverage.iteritems():
-            length = values.shape[1]
-            r1 = [(pos, pos+cigar_alen(cigar)) for (flag, rname, pos, cigar) in reads1 if ref==rname and not (flag & 0x4)]
-            r2 = [(pos, pos+cigar_alen(cigar)) for (flag, rname, pos, cigar) in reads2 if ref==rname and not (flag & 0x4)]
-            if r1 and r2:
-                #Both read parts /1 and /2 map to same ref, good
-                if len(r1) == len(reads1) and len(r2) == len(reads2):
-                    #All on this ref
-                    field = 2
+        refs1 = set(rname for rname, start, end in reads1)
+        refs2 = set(rname for rname, start, end in reads2)
+        for all_reads in [reads1, reads2]:
+            if not all_reads:
+                continue
+            weight = 1.0 / len(all_reads)
+            for rname, start, end in all_reads:
+                if rname in refs1 and rname in refs2:
+                    #Both read parts /1 and /2 map to same ref, good
+                    if len(refs1) == len(refs2) == 1:
+                        #All on this ref
+                        field = 2
+                    else:
+                        field = 3
                 else:
-                    field = 3
-            else:
-                #Only one of parts maps to this ref, bad
-                field = 4
-            for reads, all_reads in [(r1, reads1), (r2, reads2)]:
-                if reads:
-                    weight = 1.0 / len(all_reads)
-                    for start, end in reads:
-                        for i in xrange(start, end):
-                            values[field, i % length] += weight
+                    #Only one of parts maps to this ref, bad
+                    field = 4
+                yield rname, field, start, end, weight
+
+
+def count_coverage(coverage, reads):
+    """Update coverage (dict of difference arrays) using given mapping of a read/pair.
+
+    Only the references the reads actually map to are touched, with each
+    alignment recorded as start/end events via add_coverage.
+    """
+    for rname, field, start, end, weight in coverage_updates(reads):
+        if rname in coverage:
+            add_coverage(coverage[rname], field, start, end, weight)
 
 
 def fixup_pairs(reads1, reads2, ref_len_linear, ref_len_circles):
-    """Modify the two lists in-situ.
+    """Returns fixed up versions of the two lists of SamRead records.
 
     TODO - Currently considers each reference in isolation!
     """
     assert reads1 and reads2
     fixed1 = []
     fixed2 = []
-    refs1 = set(rname for qname, flag, rname, pos, rest in reads1)
-    refs2 = set(rname for qname, flag, rname, pos, rest in reads2)
+    refs1 = set(read.rname for read in reads1)
+    refs2 = set(read.rname for read in reads2)
     for ref in sorted(refs1.union(refs2)):
         if ref == "*":
             circular = False
@@ -312,15 +612,15 @@ def fixup_pairs(reads1, reads2, ref_len_linear, ref_len_circles):
             assert ref in ref_len_circles
             circular = True
             ref_lengths = ref_len_circles
-        r1 = [(qname, flag, rname, pos, rest) for qname, flag, rname, pos, rest in reads1 if rname==ref]
-        r2 = [(qname, flag, rname, pos, rest) for qname, flag, rname, pos, rest in reads2 if rname==ref]
+        r1 = [read for read in reads1 if read.rname == ref]
+        r2 = [read for read in reads2 if read.rname == ref]
         if ref in refs1 and ref in refs2:
             assert r1 and r2
             f1, f2 = fixup_same_ref_pairs(r1, r2, ref_lengths[ref], circular)
             fixed1.extend(f1)
             fixed2.extend(f2)
         elif ref in refs1:
-            assert r1 and not r2 
+            assert r1 and not r2
             #So, we have read1 mapped to ref1 (and possibly elsewhere), but read2
             #only maps elsewhere. Let's just pick the first read2 as the partner:
             fixed1.extend(mark_mate(r, reads2[0]) for r in r1)
@@ -344,22 +644,21 @@ def fixup_same_ref_pairs(reads1, reads2, length, circular):
     return reads1, reads2
 
 def mark_mate(read_to_edit, mate_read, template_len=0, happy=False):
-    qname1, flag1, rname1, pos1, rest1 = read_to_edit
-    qname2, flag2, rname2, pos2, rest2 = mate_read
-
-    assert qname1 == qname2
+    """Returns a copy of the SamRead with RNEXT and PNEXT pointing at the mate."""
+    assert read_to_edit.qname == mate_read.qname
 
+    read = read_to_edit.copy()
     if happy:
         #Set the properly paired bit
-        flag1 |= 0x02
+        read.flag |= 0x02
 
-    mapq, cigar, rnext, pnext, tlen, etc = rest1.split("\t", 5)
-    if rname1==rname2:
-        rest1 = "\t".join([mapq, cigar, "=", pos2, str(template_len), etc])
+    if read.rname == mate_read.rname:
+        read.rnext = "="
     else:
-        rest1 = "\t".join([mapq, cigar, rname2, pos2, str(template_len), etc])
-
-    return [qname1, flag1, rname1, pos1, rest1]
+        read.rnext = mate_read.rname
+    read.pnext = mate_read.pos
+    read.tlen = str(template_len)
+    return read
 
 def make_mapped_pair(read1, read2, template_len=0, happy=False):
     """Fill in RNEXT and PNEXT using each other's RNAME and POS."""
@@ -367,65 +666,65 @@ def make_mapped_pair(read1, read2, template_len=0, happy=False):
     read2 = mark_mate(read2, read1, template_len, happy)
     return read1, read2
 
-def flush_cache(handle, set_of_read_tuples, raw_dict, ref_len_linear, ref_len_circles):
+def flush_cache(handle, set_of_reads, raw_dict, ref_len_linear, ref_len_circles):
     global solo0, solo1, solo2, solo12
-    reads = sorted(set_of_read_tuples)
+    reads = sorted(set_of_reads)
     if not reads:
         return
 
-    #0x41 = 0x1 + 0x40 = paired, first in pair
-    reads1 = [(qname, flag | 0x41, rname, pos, rest) \
-              for (qname, frag, rname, pos, flag, rest) \
-              in reads if frag==1]
-
-    #0x81 = 0x1 + 0x80 = paired, second in pair
-    reads2 = [(qname, flag | 0x81, rname, pos, rest) \
-              for (qname, frag, rname, pos, flag, rest) \
-              in reads if frag==2]
-
-    reads0  = [(qname, flag, rname, pos, rest) \
-              for (qname, frag, rname, pos, flag, rest) \
-              in reads if frag==0]
-
-    assert len(reads1) + len(reads2) + len(reads0) == len(reads)
+    reads0 = []
+    reads1 = []
+    reads2 = []
+    for read in reads:
+        if read.frag == 1:
+            #0x41 = 0x1 + 0x40 = paired, first in pair
+            read.flag |= 0x41
+            reads1.append(read)
+        elif read.frag == 2:
+            #0x81 = 0x1 + 0x80 = paired, second in pair
+            read.flag |= 0x81
+            reads2.append(read)
+        else:
+            reads0.append(read)
 
     if reads0:
         assert not reads1 and not reads2, reads
         #All singletons
         solo0 += 1
     else:
-        assert not reads0, reads
         assert reads1 or reads2, reads
         #Pairs
         if not reads1:
             solo2 += 1
-            #0x8 = partner unmapped
-            reads2 = [(qname, flag | 0x8, rname, pos, rest) \
-                      for (qname, flag, rname, pos, rest) in reads2]
+            for read in reads2:
+                #0x8 = partner unmapped
+                read.flag |= 0x8
             #Assume first read2 is best one
-            qname, rname, pos, flag, rest = reads2[0]
-            flag = 0x1 + 0x4 + 0x40 #Paired, this is unmapped, first in pair
-            rec = raw_dict[qname + "/1"]
-            rest = "255\t*\t%s\t%s\t0\t%s\t%s\n" % (rname, pos, rec.seq, qual_str(rec))
-            reads1 = [(qname, flag, "*", "0", rest)]
+            mate = reads2[0]
+            seq, qual = get_raw_read(raw_dict, mate.qname + "/1")
+            #Paired, this is unmapped, first in pair
+            reads1 = [SamRead(mate.qname, 1, 0x1 + 0x4 + 0x40, "*", "0",
+                              "255", "*", mate.rname, mate.pos, "0",
+                              "%s\t%s\n" % (seq, qual))]
         elif not reads2:
             solo1 += 1
-            #0x8 = partner unmapped
-            reads1 = [(qname, flag | 0x8, rname, pos, rest) \
-                      for (qname, flag, rname, pos, rest) in reads1]
+            for read in reads1:
+                #0x8 = partner unmapped
+                read.flag |= 0x8
             #Assume first read1 is best one:
-            qname, rname, pos, flag, rest = reads1[0]
-            flag = 0x1 + 0x4 + 0x80 #Paired, this is unmapped, second in pair
-            rec = raw_dict[qname + "/2"]
-            rest = "255\t*\t%s\t%s\t0\t%s\t%s\n" % (rname, pos, rec.seq, qual_str(rec))
-            reads2 = [(qname, flag, "*", "0", rest)]
+            mate = reads1[0]
+            seq, qual = get_raw_read(raw_dict, mate.qname + "/2")
+            #Paired, this is unmapped, second in pair
+            reads2 = [SamRead(mate.qname, 2, 0x1 + 0x4 + 0x80, "*", "0",
+                              "255", "*", mate.rname, mate.pos, "0",
+                              "%s\t%s\n" % (seq, qual))]
         else:
             solo12 += 1
             reads1, reads2 = fixup_pairs(reads1, reads2, ref_len_linear, ref_len_circles)
 
-    for qname, flag, rname, pos, rest in reads0+reads1+reads2:
-        #Assume that 'rest' has the trailing \n
-        handle.write("\t".join([qname, str(flag), rname, pos, rest]))
+    for read in reads0 + reads1 + reads2:
+        #Assume that etc has the trailing \n
+        handle.write(read.to_line())
 
 
 def get_fasta_ids_and_lengths(fasta_filename):
@@ -458,7 +757,9 @@ def main():
                            Several files can be given if required.""")
     parser.add_option("-v", "--coverage", dest="coverage_file",
                       type="string", metavar="FILE",
-                      help="Option file to record coverage to (JSON)."),
+                      help="Optional file to record coverage to (plain text, "
+                           "or NumPy binary format if the name ends .npz, with "
+                           "arrays refs:0, refs:1, etc named in refs:names)."),
     #Reads
     parser.add_option("-i", "--input", dest="input_reads",
                       type="string", metavar="FILE",
@@ -466,9 +767,17 @@ def main():
     parser.add_option("-r", "--reads", dest="raw_reads",
                       type="string", metavar="FILE",
                       help="Input file of FASTQ format unmapped reads (for finding unmapped partners)")
+    parser.add_option("-s", "--stream-reads", dest="stream_reads",
+                      action="store_true", default=False,
+                      help="FASTQ file is in the same read order as the SAM file, "
+                           "so find unmapped partners in a single pass rather "
+                           "than via an SQLite index")
     parser.add_option("-o","--output", dest="output_reads",
                       type="string", metavar="FILE",
                       help="Output file for processed SAM format mapping (def. stdout)")
+    parser.add_option("-t", "--threads", dest="threads",
+                      type="int", metavar="N", default=1,
+                      help="Number of worker processes to use (def. 1)")
     
     (options, args) = parser.parse_args()
 
@@ -482,10 +791,15 @@ def main():
     if args:
         parser.error("No arguments expected")
 
+    if options.threads < 1:
+        parser.error("Number of threads must be at least one")
+    if options.threads > 1 and options.stream_reads:
+        parser.error("Option --stream-reads cannot currently be combined with --threads")
+
     paired = True
     go(options.input_reads, options.output_reads, options.raw_reads,
        options.linear_references, options.circular_references,
-       options.coverage_file)
+       options.coverage_file, options.stream_reads, options.threads)
 
 if __name__ == "__main__":
     main()
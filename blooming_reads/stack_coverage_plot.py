@@ -1,21 +1,160 @@
 import sys
 import numpy as np
 from matplotlib import pyplot as plt
+from coverage_store import CoverageStore
+
+#Finest resolution to load from binned coverage files
+MAX_POINTS = 100000
 
 def load(filename):
+    """Load plain text coverage as written by sam_circular_coverage.py etc.
+
+    Each row of tab separated values is parsed in one go by NumPy. Rows
+    of "None" (all zero) use the length from the header line, if given
+    as "length N" (or the number of bins if followed by "bin size B"),
+    or that of the other rows.
+    """
     h = open(filename)
     line = h.readline()
     assert line.startswith(">")
     while line and line[0] == ">":
-        name = line[1:].split(None,1)[0]
-        values = []
+        parts = line[1:].split()
+        name = parts[0]
+        if parts[-1] == "stream":
+            raise ValueError("Coverage for %s in %s is from --stream, "
+                             "which is not supported" % (name, filename))
+        if len(parts) > 2 and parts[1] == "length":
+            length = int(parts[2])
+            if parts[3:5] == ["bin", "size"]:
+                #One value per bin, the last bin perhaps shorter
+                length = -(-length // int(parts[5]))
+        else:
+            length = None
+        rows = []
         while line:
             line = h.readline()
             if not line or line[0] == ">":
                 break
-            values.append([float(v) for v in line.rstrip("\n").split("\t")])
-        yield name, np.array(values, np.float)
+            if line.rstrip("\n") == "None":
+                rows.append(None)
+            else:
+                rows.append(np.fromstring(line, np.float, sep="\t"))
+        if length is None:
+            length = max(len(row) for row in rows if row is not None)
+        yield name, np.array([np.zeros(length) if row is None else row
+                              for row in rows], np.float)
+    h.close()
+
+def npz_shape(data, key):
+    """Shape of an array in an open .npz file, without loading the data."""
+    h = data.zip.open(key + ".npy")
+    version = np.lib.format.read_magic(h)
+    if version == (1, 0):
+        shape = np.lib.format.read_array_header_1_0(h)[0]
+    else:
+        shape = np.lib.format.read_array_header_2_0(h)[0]
     h.close()
+    return shape
+
+def load_npz(filename, max_points=None):
+    """Load binary coverage as written by sam_circular_coverage.py etc.
+
+    These .npz files hold one array (categories by positions) for each
+    reference, named refs:0, refs:1, etc with the reference names in
+    refs:names, or if using binned output one array of the mean coverage
+    per bin named refs:I:BIN_SIZE:mean (perhaps at several bin sizes).
+    Only the finest resolution giving at most max_points values is
+    loaded (or the coarsest available).
+
+    Multiple sample files hold arrays of samples by categories by
+    positions instead, with the sample names in samples:names, and
+    each sample's coverage is returned separately.
+    """
+    data = np.load(filename)
+    if "refs:names" not in data.files:
+        raise ValueError("No refs:names array in %s, not a coverage file?" % filename)
+    names = [str(name) for name in data["refs:names"]]
+    if "samples:names" in data.files:
+        samples = list(data["samples:names"])
+    else:
+        samples = None
+    resolutions = dict()
+    for key in data.files:
+        parts = key.split(":")
+        if parts[0] != "refs" or parts[1] == "names":
+            continue
+        elif len(parts) == 4:
+            if parts[3] != "mean":
+                continue
+            bin_size = int(parts[2])
+        else:
+            bin_size = 1
+        resolutions.setdefault(names[int(parts[1])], []).append((bin_size, key))
+    for name in sorted(resolutions):
+        options = sorted(resolutions[name])
+        for bin_size, key in options:
+            if max_points is None or npz_shape(data, key)[-1] <= max_points:
+                break
+        if bin_size != 1:
+            name = "%s bin size %i" % (name, bin_size)
+        if samples is None:
+            yield name, data[key].astype(np.float)
+        else:
+            values = data[key]
+            for sample, sample_values in zip(samples, values):
+                yield "%s %s" % (name, sample), sample_values.astype(np.float)
+    data.close()
+
+def load_store(name):
+    """Load coverage from a chunked store, see coverage_store.py.
+
+    Takes the store filename, optionally followed by :REF:START-END for
+    just one region (zero based, end exclusive, and for a circular
+    reference this can extend past the end to span the origin). Only
+    the chunks needed are decompressed.
+    """
+    if name.endswith(".covstore"):
+        filename = name
+        region = None
+    else:
+        filename, ref, positions = name.rsplit(":", 2)
+        start, end = [int(p) for p in positions.split("-")]
+        region = (ref, start, end)
+    store = CoverageStore(filename)
+    for sample in store.samples:
+        for ref in store.references(sample):
+            if region is None:
+                start, end = 0, store.length(ref, sample)
+                label = ref
+            elif ref == region[0]:
+                start, end = region[1:]
+                label = "%s %i-%i" % (ref, start, end)
+            else:
+                continue
+            if len(store.samples) > 1:
+                label = "%s %s" % (label, sample)
+            yield label, store.query(ref, start, end, sample=sample).astype(np.float)
+    store.close()
+
+def decimate(values, columns):
+    """Reduce (rows, positions) values to a min and max per display column.
+
+    Returns the x coordinates and the reduced values, with two points per
+    column (the min at its first position, the max at its last) so that
+    a filled plot covers the same pixels as with the full data. If there
+    are no more than two positions per column, all the data is returned.
+    """
+    length = values.shape[1]
+    if length <= 2 * columns:
+        return np.arange(length), values
+    starts = np.linspace(0, length, columns + 1).astype(int)[:-1]
+    x = np.empty(2 * columns, np.int64)
+    x[0::2] = starts
+    x[1::2] = np.append(starts[1:], length) - 1
+    y = np.empty((values.shape[0], 2 * columns), values.dtype)
+    y[:, 0::2] = np.minimum.reduceat(values, starts, axis=1)
+    y[:, 1::2] = np.maximum.reduceat(values, starts, axis=1)
+    return x, y
 
 def make_colors(start, end, steps):
     delta = (end - start) / float(steps-1)
@@ -29,6 +168,8 @@ def stack(data, filename, colors=None):
     plt.ylim([0, max_value])
 
     fig = plt.figure(figsize=(12,2*total))
+    #No point plotting more detail than the figure's pixel columns
+    columns = int(fig.get_figwidth() * fig.dpi)
     if not colors:
         #Assumes all the examples have same number of colors:
         if data[0][1].shape[0] == 3:
@@ -43,14 +184,13 @@ def stack(data, filename, colors=None):
                                  data[0][1].shape[0])
         print colors
     for i, (name, values) in enumerate(data):
-        x = range(values.shape[1])
         print i, name, values.shape, "coverage:"
         print "\t".join("%0.1f" % v for v in values.sum(axis=1))
-        y_stack = np.cumsum(values, axis=0)
+        x, y_stack = decimate(np.cumsum(values, axis=0), columns)
         ax1 = fig.add_subplot(total, 1, i+1)
         ax1.set_autoscaley_on(False)
         ax1.set_ylim([0, max_value])
-        ax1.set_title(name.split(None,1)[0], fontsize="xx-small")
+        ax1.set_title(name, fontsize="xx-small")
         ax1.fill_between(x, 0, y_stack[0,:], facecolor=colors[0], alpha=.7)
         for i in range(0, values.shape[0]-1):
             ax1.fill_between(x, y_stack[i,:], y_stack[i+1,:], facecolor=colors[i+1], alpha=.7)
@@ -60,11 +200,17 @@ def stack(data, filename, colors=None):
 
 
 for filename in sys.argv[1:]:
-    if not filename.endswith(".cov"):
+    if filename.endswith(".cov"):
+        loader = load
+    elif filename.endswith(".npz"):
+        loader = lambda f: load_npz(f, MAX_POINTS)
+    elif filename.endswith(".covstore") or ".covstore:" in filename:
+        loader = load_store
+    else:
         continue
     print "-"*60
     print filename
     print "-"*60
-    data = list(load(filename))
+    data = list(loader(filename))
     stack(data, filename+".png")
 print "Done"
@@ -0,0 +1,577 @@
+#!/usr/bin/env python
+usage = """Python module for reading and writing BGZF and BAM files.
+
+BAM files are compressed using BGZF, Blocked GNU Zip Format, a series
+of GZIP blocks each holding at most 64kb of data. Each block can be
+compressed or decompressed independently, so this is done using a
+pool of threads (zlib releases the Python GIL while working).
+
+The BAM records are converted to and from SAM format lines, so that
+the sambam scripts can process BAM files without needing samtools in
+a pipeline, e.g. rather than:
+
+$ samtools view -h original.bam | ./sam_depair.py | samtools view -S -b - > as_singles.bam
+
+you can use:
+
+$ ./sam_depair.py -i original.bam -o as_singles.bam
+
+The scripts use open_sam_input and open_sam_output, which treat any
+filename ending .bam as BAM (and anything else as SAM).
+
+This can also be run as a script to convert between SAM and BAM, e.g.
+
+$ ./bgzf_io.py -i original.bam -o original.sam -t 4
+
+Note the BAM records are encoded one by one in Python, so the
+threads only help with the compression and decompression.
+
+See also: http://samtools.sourceforge.net/
+"""
+
+import sys
+import re
+import struct
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+
+def sys_exit(msg, error_level=1):
+    """Print error message to stdout and quit with given error level."""
+    sys.stderr.write("%s\n" % msg)
+    sys.exit(error_level)
+
+VERSION = "0.0.1"
+
+#BGZF block header up to BSIZE (which is followed by the compressed data)
+BGZF_HEADER = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00"
+
+#Empty BGZF block used as an EOF marker
+BGZF_EOF = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC" + \
+           "\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+#Maximum data per BGZF block (as samtools, allowing for incompressible data)
+BGZF_BLOCK_SIZE = 0xff00
+
+#Fixed length start of a BAM record (after the block size)
+BAM_RECORD = struct.Struct("<iiBBHHHiiii")
+
+CIGAR_OPS = "MIDNSHP=X"
+CIGAR_REF_OPS = "MDN=X"
+CIGAR_PATTERN = re.compile(r"(\d+)([MIDNSHP=X])")
+SEQ_CODES = "=ACMGRSVTWYHKDBN"
+
+#Two bases for each packed SEQ byte, and the reverse
+SEQ_DECODE = [a + b for a in SEQ_CODES for b in SEQ_CODES]
+SEQ_ENCODE = dict((pair, chr(i)) for i, pair in enumerate(SEQ_DECODE))
+SEQ_ENCODE.update((a, chr(i << 4)) for i, a in enumerate(SEQ_CODES))
+#Upper case, and anything else (e.g. ".") as N
+SEQ_CLEAN = "".join(chr(i) if chr(i) in SEQ_CODES else
+                    chr(i).upper() if chr(i).upper() in SEQ_CODES else "N"
+                    for i in range(256))
+
+#Phred scores to and from the ASCII offset 33 text in SAM
+QUAL_DECODE = "".join(chr((i + 33) % 256) for i in range(256))
+QUAL_ENCODE = "".join(chr((i - 33) % 256) for i in range(256))
+
+TAG_TYPES = {"c": struct.Struct("<b"), "C": struct.Struct("<B"),
+             "s": struct.Struct("<h"), "S": struct.Struct("<H"),
+             "i": struct.Struct("<i"), "I": struct.Struct("<I"),
+             "f": struct.Struct("<f")}
+
+
+def inflate_block(data):
+    """Decompress the raw deflate data of a BGZF block, checking the CRC."""
+    crc, size = struct.unpack("<Ii", data[-8:])
+    text = zlib.decompress(data[:-8], -15)
+    if len(text) != size or zlib.crc32(text) & 0xffffffff != crc:
+        raise ValueError("Corrupt BGZF block, bad CRC or length")
+    return text
+
+
+def deflate_block(text, level=6):
+    """Returns a complete BGZF block holding the text."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    data = compressor.compress(text) + compressor.flush()
+    return BGZF_HEADER + struct.pack("<H", len(data) + 25) + data + \
+        struct.pack("<Ii", zlib.crc32(text) & 0xffffffff, len(text))
+
+
+class BgzfReader(object):
+    """Read only access to a BGZF file, with threaded decompression.
+
+    With threads, the following blocks are read ahead and decompressed
+    in parallel (at most twice as many blocks as threads are pending).
+    """
+
+    def __init__(self, handle, threads=1):
+        self.handle = handle
+        self.threads = threads
+        if threads > 1:
+            self.pool = ThreadPool(threads)
+        else:
+            self.pool = None
+        self.pending = deque()
+        self.buffer = ""
+        self.offset = 0
+        self.eof = False
+
+    def _raw_block(self):
+        """Returns the compressed data, CRC and size of the next block."""
+        header = self.handle.read(12)
+        if not header:
+            return None
+        if len(header) < 12 or header[:4] != BGZF_HEADER[:4]:
+            raise ValueError("Not a BGZF file, or truncated")
+        extra = self.handle.read(struct.unpack("<H", header[10:12])[0])
+        block_size = None
+        i = 0
+        while i + 4 <= len(extra):
+            length = struct.unpack("<H", extra[i + 2:i + 4])[0]
+            if extra[i:i + 2] == "BC" and length == 2:
+                block_size = struct.unpack("<H", extra[i + 4:i + 6])[0] + 1
+            i += 4 + length
+        if block_size is None:
+            raise ValueError("Not a BGZF file, GZIP block without BSIZE")
+        data = self.handle.read(block_size - 12 - len(extra))
+        if len(data) != block_size - 12 - len(extra):
+            raise ValueError("Truncated BGZF block")
+        return data
+
+    def _load_block(self):
+        """Move on to the next (non-empty) block, returns False at EOF."""
+        while True:
+            while not self.eof and (not self.pending or
+                                    len(self.pending) < 2 * self.threads):
+                data = self._raw_block()
+                if data is None:
+                    self.eof = True
+                elif self.pool:
+                    self.pending.append(self.pool.apply_async(inflate_block, (data,)))
+                else:
+                    self.pending.append(data)
+            if not self.pending:
+                self.buffer = ""
+                self.offset = 0
+                return False
+            if self.pool:
+                self.buffer = self.pending.popleft().get()
+            else:
+                self.buffer = inflate_block(self.pending.popleft())
+            self.offset = 0
+            if self.buffer:
+                return True
+
+    def read(self, size):
+        """Read up to size bytes of decompressed data."""
+        parts = []
+        while size > 0:
+            if self.offset >= len(self.buffer) and not self._load_block():
+                break
+            data = self.buffer[self.offset:self.offset + size]
+            self.offset += len(data)
+            size -= len(data)
+            parts.append(data)
+        return "".join(parts)
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+        self.handle.close()
+
+
+class BgzfWriter(object):
+    """Write a BGZF file, with threaded compression.
+
+    With threads, the blocks are compressed in parallel (and written
+    in order). The EOF marker block is added by close.
+    """
+
+    def __init__(self, handle, threads=1, level=6):
+        self.handle = handle
+        self.threads = threads
+        self.level = level
+        if threads > 1:
+            self.pool = ThreadPool(threads)
+        else:
+            self.pool = None
+        self.pending = deque()
+        self.buffer = []
+        self.size = 0
+
+    def _write_blocks(self, text):
+        for start in range(0, len(text), BGZF_BLOCK_SIZE):
+            block = text[start:start + BGZF_BLOCK_SIZE]
+            if not self.pool:
+                self.handle.write(deflate_block(block, self.level))
+                continue
+            self.pending.append(self.pool.apply_async(deflate_block, (block, self.level)))
+            if len(self.pending) >= 2 * self.threads:
+                self.handle.write(self.pending.popleft().get())
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= BGZF_BLOCK_SIZE:
+            text = "".join(self.buffer)
+            #Keep any partial block for later
+            full = len(text) - len(text) % BGZF_BLOCK_SIZE
+            self._write_blocks(text[:full])
+            self.buffer = [text[full:]]
+            self.size = len(text) - full
+
+    def flush(self):
+        """Compress and write any pending data (ending the current block)."""
+        self._write_blocks("".join(self.buffer))
+        self.buffer = []
+        self.size = 0
+        while self.pending:
+            self.handle.write(self.pending.popleft().get())
+        self.handle.flush()
+
+    def close(self):
+        self.flush()
+        self.handle.write(BGZF_EOF)
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+        self.handle.close()
+
+
+def decode_tags(data, offset):
+    """Returns the SAM text for the optional tags in a BAM record."""
+    tags = []
+    while offset < len(data):
+        tag = data[offset:offset + 2]
+        value_type = data[offset + 2]
+        offset += 3
+        if value_type in TAG_TYPES:
+            fmt = TAG_TYPES[value_type]
+            value = fmt.unpack_from(data, offset)[0]
+            offset += fmt.size
+            if value_type == "f":
+                tags.append("%s:f:%g" % (tag, value))
+            else:
+                tags.append("%s:i:%i" % (tag, value))
+        elif value_type == "A":
+            tags.append("%s:A:%s" % (tag, data[offset]))
+            offset += 1
+        elif value_type in "ZH":
+            end = data.index("\0", offset)
+            tags.append("%s:%s:%s" % (tag, value_type, data[offset:end]))
+            offset = end + 1
+        elif value_type == "B":
+            sub_type = data[offset]
+            count = struct.unpack_from("<i", data, offset + 1)[0]
+            fmt = "<%i%s" % (count, TAG_TYPES[sub_type].format[-1])
+            values = struct.unpack_from(fmt, data, offset + 5)
+            offset += 5 + struct.calcsize(fmt)
+            if sub_type == "f":
+                values = ["%g" % v for v in values]
+            else:
+                values = [str(v) for v in values]
+            tags.append("%s:B:%s" % (tag, ",".join([sub_type] + values)))
+        else:
+            raise ValueError("Unknown BAM tag type %r" % value_type)
+    return "\t".join(tags)
+
+
+def decode_record(data, references):
+    """Returns a SAM line (with new line) from a BAM record (without block size)."""
+    ref_id, pos, l_read_name, mapq, bin, n_cigar, flag, l_seq, \
+        next_ref_id, next_pos, tlen = BAM_RECORD.unpack_from(data)
+    offset = BAM_RECORD.size
+    qname = data[offset:offset + l_read_name - 1]
+    offset += l_read_name
+    if n_cigar:
+        cigar = "".join(["%i%s" % (c >> 4, CIGAR_OPS[c & 0xf]) for c in
+                         struct.unpack_from("<%iI" % n_cigar, data, offset)])
+        offset += 4 * n_cigar
+    else:
+        cigar = "*"
+    if l_seq:
+        seq = "".join([SEQ_DECODE[b] for b in
+                       bytearray(data[offset:offset + (l_seq + 1) // 2])])[:l_seq]
+        offset += (l_seq + 1) // 2
+        qual = data[offset:offset + l_seq]
+        if qual[0] == "\xff":
+            qual = "*"
+        else:
+            qual = qual.translate(QUAL_DECODE)
+        offset += l_seq
+    else:
+        seq = qual = "*"
+    if ref_id < 0:
+        rname = "*"
+    else:
+        rname = references[ref_id]
+    if next_ref_id < 0:
+        rnext = "*"
+    elif next_ref_id == ref_id:
+        rnext = "="
+    else:
+        rnext = references[next_ref_id]
+    fields = [qname, str(flag), rname, str(pos + 1), str(mapq), cigar,
+              rnext, str(next_pos + 1), str(tlen), seq, qual]
+    if offset < len(data):
+        fields.append(decode_tags(data, offset))
+    return "\t".join(fields) + "\n"
+
+
+def reg2bin(beg, end):
+    """BAM index bin for zero based region beg:end (as in the SAM spec)."""
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+def encode_tag(tag):
+    """Returns the BAM encoding of a SAM optional tag, e.g. NM:i:0"""
+    name, value_type, value = tag.split(":", 2)
+    if value_type == "i":
+        value = int(value)
+        if value < 0:
+            for code in "csi":
+                try:
+                    return name + code + TAG_TYPES[code].pack(value)
+                except struct.error:
+                    pass
+        else:
+            for code in "CSI":
+                try:
+                    return name + code + TAG_TYPES[code].pack(value)
+                except struct.error:
+                    pass
+        raise ValueError("Integer tag out of range: %s" % tag)
+    elif value_type == "f":
+        return name + "f" + TAG_TYPES["f"].pack(float(value))
+    elif value_type == "A":
+        return name + "A" + value
+    elif value_type in "ZH":
+        return name + value_type + value + "\0"
+    elif value_type == "B":
+        values = value.split(",")
+        sub_type = values.pop(0)
+        if sub_type == "f":
+            values = [float(v) for v in values]
+        else:
+            values = [int(v) for v in values]
+        return name + "B" + sub_type + struct.pack("<i", len(values)) + \
+            struct.pack("<%i%s" % (len(values), TAG_TYPES[sub_type].format[-1]), *values)
+    raise ValueError("Unknown SAM tag type in %s" % tag)
+
+
+def encode_record(line, ref_ids):
+    """Returns a BAM record (including block size) for a SAM line."""
+    fields = line.rstrip("\n").split("\t")
+    if len(fields) < 11:
+        raise ValueError("Bad SAM line, only %i fields:\n%s" % (len(fields), line))
+    qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual = fields[:11]
+    flag = int(flag)
+    if rname == "*":
+        ref_id = -1
+    else:
+        try:
+            ref_id = ref_ids[rname]
+        except KeyError:
+            raise ValueError("Reference %s not in SAM header:\n%s" % (rname, line))
+    if rnext == "=":
+        next_ref_id = ref_id
+    elif rnext == "*":
+        next_ref_id = -1
+    else:
+        try:
+            next_ref_id = ref_ids[rnext]
+        except KeyError:
+            raise ValueError("Reference %s not in SAM header:\n%s" % (rnext, line))
+    pos = int(pos) - 1
+    if cigar == "*":
+        ops = []
+    else:
+        ops = [(int(n), op) for n, op in CIGAR_PATTERN.findall(cigar)]
+    end = pos + sum(n for n, op in ops if op in CIGAR_REF_OPS)
+    if flag & 0x4 or end == pos:
+        end = pos + 1
+    if seq == "*":
+        l_seq = 0
+        seq = qual = ""
+    else:
+        l_seq = len(seq)
+        seq = seq.translate(SEQ_CLEAN)
+        seq = "".join([SEQ_ENCODE[seq[i:i + 2]] for i in xrange(0, l_seq, 2)])
+        if qual == "*":
+            qual = "\xff" * l_seq
+        else:
+            qual = qual.translate(QUAL_ENCODE)
+    data = BAM_RECORD.pack(ref_id, pos, len(qname) + 1, int(mapq),
+                           reg2bin(pos, end), len(ops), flag, l_seq,
+                           next_ref_id, int(pnext) - 1, int(tlen)) + qname + "\0" + \
+        struct.pack("<%iI" % len(ops), *[n << 4 | CIGAR_OPS.index(op) for n, op in ops]) + \
+        seq + qual + "".join([encode_tag(t) for t in fields[11:] if t])
+    return struct.pack("<i", len(data)) + data
+
+
+class BamReader(object):
+    """Read a BAM file as SAM format lines (header first), for iteration."""
+
+    def __init__(self, handle, threads=1):
+        self.bgzf = BgzfReader(handle, threads)
+        if self.bgzf.read(4) != "BAM\1":
+            raise ValueError("Not a BAM file, missing magic string")
+        text = self.bgzf.read(struct.unpack("<i", self.bgzf.read(4))[0])
+        self.references = []
+        self.lengths = []
+        for i in range(struct.unpack("<i", self.bgzf.read(4))[0]):
+            name = self.bgzf.read(struct.unpack("<i", self.bgzf.read(4))[0])[:-1]
+            self.references.append(name)
+            self.lengths.append(struct.unpack("<i", self.bgzf.read(4))[0])
+        self.header = [line + "\n" for line in text.rstrip("\0").splitlines()]
+        if not any(line.startswith("@SQ\t") for line in self.header):
+            #As samtools, use the binary reference list
+            self.header.extend("@SQ\tSN:%s\tLN:%i\n" % (name, length)
+                               for name, length in zip(self.references, self.lengths))
+
+    def __iter__(self):
+        for line in self.header:
+            yield line
+        read = self.bgzf.read
+        references = self.references
+        while True:
+            data = read(4)
+            if not data:
+                break
+            size = struct.unpack("<i", data)[0]
+            data = read(size)
+            if len(data) != size:
+                raise ValueError("Truncated BAM record")
+            yield decode_record(data, references)
+
+    def close(self):
+        self.bgzf.close()
+
+
+class BamWriter(object):
+    """Write a BAM file given SAM format text (header first).
+
+    Like a file handle, write takes any text (of complete lines or not).
+    The BAM header is written once the first read is seen (or by close),
+    with the references taken from the @SQ lines.
+    """
+
+    def __init__(self, handle, threads=1, level=6):
+        self.bgzf = BgzfWriter(handle, threads, level)
+        self.header = []
+        self.ref_ids = None
+        self.partial = ""
+
+    def _write_header(self):
+        references = []
+        for line in self.header:
+            if line.startswith("@SQ\t"):
+                rname = length = None
+                for part in line.rstrip("\n").split("\t")[1:]:
+                    if part.startswith("SN:"):
+                        rname = part[3:]
+                    elif part.startswith("LN:"):
+                        length = int(part[3:])
+                if rname is None or length is None:
+                    raise ValueError("Bad @SQ line:\n%s" % line)
+                references.append((rname, length))
+        text = "".join(self.header)
+        self.bgzf.write("BAM\1" + struct.pack("<i", len(text)) + text +
+                        struct.pack("<i", len(references)))
+        for rname, length in references:
+            self.bgzf.write(struct.pack("<i", len(rname) + 1) + rname + "\0" +
+                            struct.pack("<i", length))
+        self.ref_ids = dict((rname, i) for i, (rname, length) in enumerate(references))
+
+    def write(self, text):
+        lines = (self.partial + text).split("\n")
+        self.partial = lines.pop()
+        records = []
+        for line in lines:
+            if self.ref_ids is None:
+                if line[:1] == "@":
+                    self.header.append(line + "\n")
+                    continue
+                self._write_header()
+            records.append(encode_record(line, self.ref_ids))
+        if records:
+            self.bgzf.write("".join(records))
+
+    def close(self):
+        if self.partial:
+            self.write("\n")
+        if self.ref_ids is None:
+            self._write_header()
+        self.bgzf.close()
+
+
+def open_sam_input(filename=None, threads=1):
+    """Returns an iterable of SAM lines, from a SAM or BAM file (def. stdin).
+
+    Files are treated as BAM if the filename ends with .bam, and these
+    are decompressed using the given number of threads.
+    """
+    if not filename:
+        return sys.stdin
+    if filename.endswith(".bam"):
+        return BamReader(open(filename, "rb"), threads)
+    return open(filename)
+
+
+def open_sam_output(filename=None, threads=1):
+    """Returns a handle to write SAM lines to a SAM or BAM file (def. stdout).
+
+    Files are treated as BAM if the filename ends with .bam, and these
+    are compressed using the given number of threads.
+    """
+    if not filename:
+        return sys.stdout
+    if filename.endswith(".bam"):
+        return BamWriter(open(filename, "wb"), threads)
+    return open(filename, "w")
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options]\n\n" + usage,
+                          version="%prog "+VERSION)
+    parser.add_option("-i", "--input", dest="input_reads",
+                      type="string", metavar="FILE",
+                      help="Input SAM or BAM file (def. SAM on stdin)")
+    parser.add_option("-o", "--output", dest="output_reads",
+                      type="string", metavar="FILE",
+                      help="Output SAM or BAM file (def. SAM on stdout)")
+    parser.add_option("-t", "--threads", dest="threads",
+                      type="int", metavar="N", default=1,
+                      help="Number of threads for BGZF compression (def. 1)")
+
+    (options, args) = parser.parse_args()
+
+    if args:
+        parser.error("No arguments expected")
+    if options.threads < 1:
+        parser.error("Number of threads must be at least one")
+
+    input_handle = open_sam_input(options.input_reads, options.threads)
+    output_handle = open_sam_output(options.output_reads, options.threads)
+    try:
+        for line in input_handle:
+            output_handle.write(line)
+    except ValueError, err:
+        sys_exit(str(err))
+    if options.input_reads:
+        input_handle.close()
+    if options.output_reads:
+        output_handle.close()
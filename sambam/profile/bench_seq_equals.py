@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+usage = """Benchmark the reference based compression modes of sam_seq_equals.py
+
+Takes a SAM or BAM file and the reference (FASTA or 2bit), and runs
+sam_seq_equals.py in each mode (add, remove, full and pack). For each
+output this records the time taken (and reads per second), the size of
+the SAM output plain, gzipped, BGZF compressed (like bgzip) and as BAM,
+and checks the round trip:
+
+* add - running remove on the output gives the same as remove on the input
+* remove - running add on the output gives the same as add on the input
+* full - matches the add output, except reads with SEQ and QUAL set to *
+  which must have had SEQ all = in the add output (and a CIGAR with =)
+* pack - unpacking the container gives the input exactly
+
+The same is done for the input itself (as mode raw) for comparison.
+The report gives the timings of each phase for each mode, either as
+JSON (if the output filename ends .json) or a tab separated table,
+e.g.
+
+$ ./bench_seq_equals.py -r reference.2bit -o report.json original.bam
+"""
+
+import sys
+import os
+import gzip
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+from optparse import OptionParser
+
+#The sambam scripts and modules are in the parent directory
+sambam = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, sambam)
+from bgzf_io import BgzfWriter, open_sam_input, open_sam_output
+
+def sys_exit(msg, error_level=1):
+    """Print error message to stdout and quit with given error level."""
+    sys.stderr.write("%s\n" % msg)
+    sys.exit(error_level)
+
+VERSION = "0.0.1"
+
+MODES = ["add", "remove", "full", "pack"]
+
+#Columns for the tab separated report
+TSV_FIELDS = ["mode", "reads", "encode_s", "reads_per_s", "sam_bytes",
+              "gzip_bytes", "bgzf_bytes", "bam_bytes", "vs_raw_gzip",
+              "gzip_s", "bgzf_s", "bam_s", "roundtrip", "roundtrip_s"]
+
+
+def run_mode(reference, mode, input_filename, output_filename, threads):
+    """Run sam_seq_equals.py in the given mode, returns the time taken."""
+    script = os.path.join(sambam, "sam_seq_equals.py")
+    cmd = [sys.executable, script, "-t", str(threads), reference, mode]
+    if mode == "pack":
+        cmd[2:2] = ["-o", output_filename]
+    elif mode == "unpack":
+        cmd[2:2] = ["-i", input_filename]
+    start = time.time()
+    input_handle = open(input_filename)
+    if mode == "pack":
+        output_handle = open(os.devnull, "w")
+    else:
+        output_handle = open(output_filename, "w")
+    stderr_handle = open(output_filename + ".log", "w")
+    return_code = subprocess.call(cmd, stdin=input_handle,
+                                  stdout=output_handle, stderr=stderr_handle)
+    input_handle.close()
+    output_handle.close()
+    stderr_handle.close()
+    taken = time.time() - start
+    if return_code:
+        #The temporary directory is removed, so show the end of the log
+        log = open(output_filename + ".log").read().splitlines()[-10:]
+        sys_exit("sam_seq_equals.py %s failed (return code %i):\n%s"
+                 % (mode, return_code, "\n".join(log)))
+    return taken
+
+
+def compressed_sizes(filename, threads):
+    """Returns gzip, BGZF and BAM sizes of a SAM file, and the time for each."""
+    sizes = dict()
+    timings = dict()
+    temp = filename + ".tmp"
+
+    start = time.time()
+    handle = gzip.open(temp, "wb")
+    shutil.copyfileobj(open(filename, "rb"), handle)
+    handle.close()
+    timings["gzip"] = time.time() - start
+    sizes["gzip"] = os.path.getsize(temp)
+
+    start = time.time()
+    handle = BgzfWriter(open(temp, "wb"), threads)
+    shutil.copyfileobj(open(filename, "rb"), handle)
+    handle.close()
+    timings["bgzf"] = time.time() - start
+    sizes["bgzf"] = os.path.getsize(temp)
+
+    start = time.time()
+    input_handle = open_sam_input(filename)
+    output_handle = open_sam_output(temp + ".bam", threads)
+    for line in input_handle:
+        output_handle.write(line)
+    input_handle.close()
+    output_handle.close()
+    timings["bam"] = time.time() - start
+    sizes["bam"] = os.path.getsize(temp + ".bam")
+
+    os.remove(temp)
+    os.remove(temp + ".bam")
+    return sizes, timings
+
+
+def compare_files(filename_a, filename_b, full=False):
+    """Returns the number of lines which differ (and reports the first).
+
+    With full=True the first file is from the full mode, and the second
+    from the add mode, where a read with SEQ * in the first may have SEQ
+    all = in the second (with QUAL dropped, and the CIGAR M as =).
+    """
+    bad = 0
+    handle_a = open(filename_a)
+    handle_b = open(filename_b)
+    for line_number, (a, b) in enumerate(zip(handle_a, handle_b)):
+        if a == b:
+            continue
+        if full and a[0] != "@":
+            #Strip the line ending, else QUAL is "*\n" if there are no tags
+            a = a.rstrip("\n").split("\t", 11)
+            b = b.rstrip("\n").split("\t", 11)
+            if a[9] == "*" and a[10] == "*" and b[9] == "=" * len(b[9]) \
+            and a[5] == b[5].replace("M", "=") and a[:5] == b[:5] and a[6:9] == b[6:9] \
+            and a[11:] == b[11:]:
+                continue
+        if not bad:
+            sys.stderr.write("First difference at line %i:\n%s\n%s\n"
+                             % (line_number + 1, str(a).rstrip(), str(b).rstrip()))
+        bad += 1
+    #Any extra lines?
+    for handle in [handle_a, handle_b]:
+        for line in handle:
+            bad += 1
+    handle_a.close()
+    handle_b.close()
+    return bad
+
+
+def benchmark(input_filename, reference, threads, temp_dir):
+    report = {"input": input_filename, "reference": reference, "modes": dict()}
+
+    #Work from SAM text (timing any conversion from BAM)
+    raw = os.path.join(temp_dir, "raw.sam")
+    start = time.time()
+    input_handle = open_sam_input(input_filename, threads)
+    output_handle = open(raw, "w")
+    reads = 0
+    for line in input_handle:
+        if line[0] != "@":
+            reads += 1
+        output_handle.write(line)
+    input_handle.close()
+    output_handle.close()
+    report["reads"] = reads
+    outputs = {"raw": raw}
+    timings = {"raw": {"read": time.time() - start}}
+    sys.stderr.write("Loaded %i reads from %s\n" % (reads, input_filename))
+
+    for mode in MODES:
+        outputs[mode] = os.path.join(temp_dir, mode + ".out")
+        timings[mode] = {"encode": run_mode(reference, mode, raw, outputs[mode],
+                                            threads)}
+        sys.stderr.write("Mode %s took %0.1fs\n" % (mode, timings[mode]["encode"]))
+
+    #Round trips, see above
+    checks = {"add": ("remove", "remove"), "remove": ("add", "add"),
+              "full": (None, "add"), "pack": ("unpack", "raw")}
+    for mode in MODES:
+        undo, expected = checks[mode]
+        if undo:
+            filename = os.path.join(temp_dir, mode + ".roundtrip")
+            timings[mode]["roundtrip"] = run_mode(reference, undo, outputs[mode],
+                                                  filename, threads)
+        else:
+            filename = outputs[mode]
+            timings[mode]["roundtrip"] = 0.0
+        start = time.time()
+        bad = compare_files(filename, outputs[expected], mode == "full")
+        timings[mode]["roundtrip"] += time.time() - start
+        report["modes"][mode] = {"roundtrip": not bad, "roundtrip_differences": bad}
+        sys.stderr.write("Mode %s round trip %s\n" % (mode, "OK" if not bad else "FAILED"))
+    report["modes"]["raw"] = {"roundtrip": True, "roundtrip_differences": 0}
+
+    for mode in ["raw"] + MODES:
+        results = report["modes"][mode]
+        results["sam_bytes"] = os.path.getsize(outputs[mode])
+        if mode == "pack":
+            #Already compressed
+            results["gzip_bytes"] = results["bgzf_bytes"] = results["bam_bytes"] = None
+        else:
+            sizes, compress_timings = compressed_sizes(outputs[mode], threads)
+            for key in sizes:
+                results[key + "_bytes"] = sizes[key]
+            timings[mode].update(compress_timings)
+        results["timings"] = timings[mode]
+        taken = timings[mode].get("encode", timings[mode].get("read"))
+        results["reads_per_second"] = reads / max(taken, 1e-6)
+    raw_gzip = report["modes"]["raw"]["gzip_bytes"]
+    for mode in ["raw"] + MODES:
+        results = report["modes"][mode]
+        best = results["gzip_bytes"] or results["sam_bytes"]
+        results["vs_raw_gzip"] = float(best) / max(raw_gzip, 1)
+    return report
+
+
+def write_report(report, output_handle, as_json):
+    if as_json:
+        json.dump(report, output_handle, sort_keys=True, indent=1)
+        output_handle.write("\n")
+        return
+    output_handle.write("#%s\n" % "\t".join(TSV_FIELDS))
+    for mode in ["raw"] + MODES:
+        results = report["modes"][mode]
+        timings = results["timings"]
+        values = [mode, report["reads"], timings.get("encode", timings.get("read")),
+                  results["reads_per_second"], results["sam_bytes"],
+                  results["gzip_bytes"], results["bgzf_bytes"], results["bam_bytes"],
+                  results["vs_raw_gzip"], timings.get("gzip"), timings.get("bgzf"),
+                  timings.get("bam"), results["roundtrip"], timings.get("roundtrip")]
+        output_handle.write("\t".join("-" if v is None else
+                                      "%0.3f" % v if isinstance(v, float) else
+                                      str(v) for v in values) + "\n")
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options] input.sam|input.bam\n\n" + usage,
+                          version="%prog "+VERSION)
+    parser.add_option("-r", "--reference", dest="reference",
+                      type="string", metavar="FILE",
+                      help="Reference FASTA or 2bit file (required)")
+    parser.add_option("-o", "--output", dest="output",
+                      type="string", metavar="FILE",
+                      help="Report file (def. stdout), JSON if the extension "
+                           "is .json, otherwise tab separated")
+    parser.add_option("-t", "--threads", dest="threads",
+                      type="int", metavar="N", default=1,
+                      help="Number of threads for BGZF and BAM compression, "
+                           "and worker processes for sam_seq_equals.py (def. 1)")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("Expected one SAM or BAM file")
+    if not options.reference:
+        parser.error("Reference file (-r) required")
+    if options.threads < 1:
+        parser.error("Number of threads must be at least one")
+
+    temp_dir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        report = benchmark(args[0], os.path.abspath(options.reference),
+                           options.threads, temp_dir)
+    finally:
+        shutil.rmtree(temp_dir)
+    if options.output:
+        output_handle = open(options.output, "w")
+    else:
+        output_handle = sys.stdout
+    write_report(report, output_handle,
+                 bool(options.output) and options.output.endswith(".json"))
+    if options.output:
+        output_handle.close()
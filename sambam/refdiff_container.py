@@ -0,0 +1,305 @@
+"""Python module for an experimental reference-diff SAM container.
+
+This is used by the pack and unpack modes of sam_seq_equals.py, as a
+demonstration of reference based compression beyond putting equals
+signs in SAM files. Rather than SAM text, each read's SEQ is stored as
+just the bases which differ from the reference (the read offset gap
+from the previous difference, and the base), with the CIGAR operators
+as packed integers (as in BAM), and everything else in separate columns.
+
+The reads are grouped into blocks (by default 10000 reads), and within
+each block every column is compressed separately with zlib. Similar
+values compress much better together (e.g. the qualities), and the
+positions are stored as differences from the previous read, which are
+small for coordinate sorted input. An index records where each column
+of each block is, and the first and last reference and position in each
+block, so that a block can be read on its own (random access).
+
+The file format is an eight byte magic string, SAMRDIFF, and the offset
+of the index (unsigned 64 bit little endian integer), followed by the
+compressed columns, with the index as JSON at the end (also holding the
+SAM header and the reference names).
+
+Decoding needs the same reference sequences, and gives back the same
+SAM lines (lossless, for SAM with the integer fields written normally).
+To check this, the index also records the length and MD5 checksum of
+each reference used (of the upper case sequence, as in the M5 field of
+SAM @SQ lines), see the checksums attribute.
+Any SEQ which cannot be described relative to the reference (unmapped
+reads, CIGAR not matching the SEQ length, etc) is stored as is, as are
+any read bases not matching the reference exactly (e.g. lower case, or
+equals signs already present).
+"""
+
+import json
+import struct
+import zlib
+import numpy as np
+
+VERSION = "0.0.1"
+
+MAGIC = "SAMRDIFF"
+
+#Default number of reads per block
+BLOCK_READS = 10000
+
+CIGAR_OPS = "MIDNSHP=X"
+
+#Column names and NumPy data types (None for text), in file order
+COLUMNS = [("qname", None), ("flag", "<u2"), ("rname", "<i4"),
+           ("pos", "<i4"), ("mapq", "<u1"), ("cigar_count", "<u4"),
+           ("cigar", "<u4"), ("rnext", "<i4"), ("pnext", "<i4"),
+           ("tlen", "<i4"), ("seq_kind", "<u1"), ("seq_len", "<u4"),
+           ("literal", None), ("diff_count", "<u4"), ("diff_gap", "<u4"),
+           ("diff_base", None), ("qual", None), ("tags", None)]
+
+#Values of seq_kind
+SEQ_DIFF = 0
+SEQ_LITERAL = 1
+
+#Values of rname and rnext (other than reference numbers)
+REF_NONE = -1
+REF_SAME = -2
+
+
+def encode_cigar(cigar):
+    """Returns a list of BAM style integer CIGAR operations."""
+    if cigar == "*":
+        return []
+    answer = []
+    count = 0
+    for letter in cigar:
+        if letter.isdigit():
+            count = count * 10 + int(letter)
+        else:
+            answer.append(count << 4 | CIGAR_OPS.index(letter))
+            count = 0
+    return answer
+
+
+def decode_cigar(values):
+    """Returns the CIGAR string from BAM style integer operations."""
+    if not len(values):
+        return "*"
+    return "".join(["%i%s" % (v >> 4, CIGAR_OPS[v & 0xf]) for v in values])
+
+assert decode_cigar(encode_cigar("14S15M1P1D3P54M1D34M5S")) == "14S15M1P1D3P54M1D34M5S"
+
+
+class RefDiffWriter(object):
+    """Creates a reference-diff container file, one read at a time.
+
+    Append any SAM header lines to the header list before closing, and
+    call add for each read. The length and MD5 of each reference used
+    for the reads stored as differences should be recorded in the
+    checksums dictionary (reference name to a [length, md5] list).
+    """
+
+    def __init__(self, filename, block_reads=BLOCK_READS):
+        self.handle = open(filename, "wb")
+        self.block_reads = block_reads
+        self.header = []
+        self.checksums = dict()
+        self.references = []
+        self.ref_ids = dict()
+        self.blocks = []
+        #Compressed and uncompressed size of each column
+        self.sizes = dict((name, [0, 0]) for name, dtype in COLUMNS)
+        self._new_block()
+        #Index offset is filled in by close
+        self.handle.write(MAGIC + struct.pack("<Q", 0))
+
+    def _new_block(self):
+        self.columns = dict((name, []) for name, dtype in COLUMNS)
+        self.count = 0
+
+    def _ref_id(self, rname):
+        if rname == "*":
+            return REF_NONE
+        try:
+            return self.ref_ids[rname]
+        except KeyError:
+            self.ref_ids[rname] = len(self.references)
+            self.references.append(rname)
+            return self.ref_ids[rname]
+
+    def add(self, fields, tags, aligned=None):
+        """Add a read, given its first 11 SAM fields and the tags (if any).
+
+        The tags are a string (without the new line), or None if the
+        SAM line had only 11 fields. If the SEQ is to be stored relative
+        to the reference, aligned should be a byte array of the reference
+        base for each read base (zero for clipped or inserted bases).
+        """
+        qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual = fields
+        columns = self.columns
+        columns["qname"].append(qname)
+        columns["flag"].append(int(flag))
+        columns["rname"].append(self._ref_id(rname))
+        columns["pos"].append(int(pos))
+        columns["mapq"].append(int(mapq))
+        cigar = encode_cigar(cigar)
+        columns["cigar_count"].append(len(cigar))
+        columns["cigar"].extend(cigar)
+        if rnext == "=":
+            columns["rnext"].append(REF_SAME)
+        else:
+            columns["rnext"].append(self._ref_id(rnext))
+        columns["pnext"].append(int(pnext) - int(pos))
+        columns["tlen"].append(int(tlen))
+        columns["seq_len"].append(len(seq))
+        if aligned is None:
+            columns["seq_kind"].append(SEQ_LITERAL)
+            columns["literal"].append(seq)
+        else:
+            read = np.frombuffer(seq, np.uint8)
+            offsets = np.flatnonzero(read != aligned)
+            columns["seq_kind"].append(SEQ_DIFF)
+            columns["diff_count"].append(len(offsets))
+            if len(offsets):
+                columns["diff_gap"].append(np.diff(offsets, prepend=0))
+                columns["diff_base"].append(read[offsets].tobytes())
+        columns["qual"].append(qual)
+        if tags is None:
+            columns["tags"].append("")
+        else:
+            columns["tags"].append("\t" + tags)
+        self.count += 1
+        if self.count >= self.block_reads:
+            self.flush()
+
+    def flush(self):
+        """Compress and write the current block (if any reads)."""
+        if not self.count:
+            return
+        columns = self.columns
+        first = (columns["rname"][0], columns["pos"][0])
+        last = (columns["rname"][-1], columns["pos"][-1])
+        #Store positions as differences from the previous read
+        columns["pos"] = np.diff(columns["pos"], prepend=0)
+        entries = dict()
+        for name, dtype in COLUMNS:
+            values = columns[name]
+            if name in ["qname", "qual", "tags"]:
+                data = "\n".join(values)
+            elif dtype is None:
+                data = "".join(values)
+            elif name == "diff_gap":
+                data = np.concatenate(values or [[]]).astype(dtype).tostring()
+            else:
+                data = np.array(values, dtype).tostring()
+            compressed = zlib.compress(data)
+            entries[name] = [self.handle.tell(), len(compressed)]
+            self.handle.write(compressed)
+            self.sizes[name][0] += len(compressed)
+            self.sizes[name][1] += len(data)
+        self.blocks.append({"reads": self.count, "first": first, "last": last,
+                            "columns": entries})
+        self._new_block()
+
+    def close(self):
+        """Write any remaining reads and the index, and close the file."""
+        self.flush()
+        offset = self.handle.tell()
+        json.dump({"version": 1, "header": "".join(self.header),
+                   "references": self.references, "checksums": self.checksums,
+                   "blocks": self.blocks},
+                  self.handle)
+        self.handle.seek(len(MAGIC))
+        self.handle.write(struct.pack("<Q", offset))
+        self.handle.close()
+
+
+class RefDiffReader(object):
+    """Read access to a reference-diff container file.
+
+    Needs a function taking the RNAME, zero based POS, CIGAR and read
+    length, returning the aligned reference bases as given to the
+    RefDiffWriter (this is called for each read stored as differences).
+    Check the reference matches the one used for packing against the
+    checksums dictionary (reference name to a [length, md5] list).
+    """
+
+    def __init__(self, filename, aligned_reference):
+        self.handle = open(filename, "rb")
+        if self.handle.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a reference-diff container" % filename)
+        offset = struct.unpack("<Q", self.handle.read(8))[0]
+        self.handle.seek(offset)
+        index = json.loads(self.handle.read())
+        self.header = str(index["header"])
+        self.references = [str(r) for r in index["references"]]
+        self.checksums = dict((str(name), (length, str(md5))) for name, (length, md5)
+                              in index.get("checksums", {}).items())
+        self.blocks = index["blocks"]
+        self.aligned_reference = aligned_reference
+
+    def _column(self, entry, name, dtype):
+        offset, size = entry["columns"][name]
+        self.handle.seek(offset)
+        data = zlib.decompress(self.handle.read(size))
+        if dtype is None:
+            return data
+        return np.fromstring(data, dtype).tolist()
+
+    def block(self, number):
+        """Returns the SAM lines (as a list of strings) for the given block."""
+        entry = self.blocks[number]
+        columns = dict((name, self._column(entry, name, dtype)) for name, dtype in COLUMNS)
+        qnames = columns["qname"].split("\n")
+        quals = columns["qual"].split("\n")
+        tags = columns["tags"].split("\n")
+        pos = np.cumsum(columns["pos"]).tolist()
+        references = self.references
+        cigar_values = columns["cigar"]
+        literal = columns["literal"]
+        diff_gaps = np.array(columns["diff_gap"], np.int64)
+        diff_bases = np.fromstring(columns["diff_base"], np.uint8)
+        cigar_offset = literal_offset = diff_offset = diff_read = 0
+        lines = []
+        for i in range(entry["reads"]):
+            rname = columns["rname"][i]
+            if rname == REF_NONE:
+                rname = "*"
+            else:
+                rname = references[rname]
+            rnext = columns["rnext"][i]
+            if rnext == REF_SAME:
+                rnext = "="
+            elif rnext == REF_NONE:
+                rnext = "*"
+            else:
+                rnext = references[rnext]
+            count = columns["cigar_count"][i]
+            cigar = decode_cigar(cigar_values[cigar_offset:cigar_offset + count])
+            cigar_offset += count
+            seq_len = columns["seq_len"][i]
+            if columns["seq_kind"][i] == SEQ_LITERAL:
+                seq = literal[literal_offset:literal_offset + seq_len]
+                literal_offset += seq_len
+            else:
+                read = np.array(self.aligned_reference(rname, pos[i] - 1, cigar, seq_len), np.uint8)
+                count = columns["diff_count"][diff_read]
+                diff_read += 1
+                if count:
+                    offsets = np.cumsum(diff_gaps[diff_offset:diff_offset + count])
+                    read[offsets] = diff_bases[diff_offset:diff_offset + count]
+                    diff_offset += count
+                seq = read.tobytes()
+            lines.append("%s\t%i\t%s\t%i\t%i\t%s\t%s\t%i\t%i\t%s\t%s%s\n"
+                         % (qnames[i], columns["flag"][i], rname, pos[i],
+                            columns["mapq"][i], cigar, rnext,
+                            pos[i] + columns["pnext"][i], columns["tlen"][i],
+                            seq, quals[i], tags[i]))
+        return lines
+
+    def __iter__(self):
+        """Yields the SAM header lines, then the reads from each block."""
+        for line in self.header.splitlines(True):
+            yield line
+        for number in range(len(self.blocks)):
+            for line in self.block(number):
+                yield line
+
+    def close(self):
+        self.handle.close()
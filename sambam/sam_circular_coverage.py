@@ -6,6 +6,11 @@ circular reference spill over (aligned end exceeds length), or
 are directly from mapping against a doubled-reference - and thus
 caculates coverage at each position modulo the circle length.
 
+Internally each alignment is recorded as a start and end event in a
+difference array (splitting alignments over the origin in two), so
+the cost per read does not depend on the read length. The coverage
+itself is then given by a cumulative sum.
+
 Currently calculates coverage split into these five categories:
 - Single reads all mapped to same reference
 - Single reads mapped to multiple references
@@ -18,11 +23,115 @@ followed by five lines of space separated coverage scores (one
 value for each base in the associated reference sequence). If
 all the entries for a category are zero "None" is record instead.
 
-TODO: Switch to JSON output?
+Alternatively, if the output filename ends .npz the coverage is saved
+in NumPy's compressed binary format instead, with one float32 array
+of shape (5, length) for each reference. These are named refs:0,
+refs:1, etc with the reference names (in the same order) in the array
+refs:names, as the names themselves need not be valid array names.
+This is far smaller and quicker to write and load than the plain text,
+e.g. with numpy.load or the stack_coverage_plot.py script.
+
+For plotting and QC of large references per-base values are often
+unnecessary, so with --bin-size N the output instead summarises each
+window of N bases. The plain text output then gives the mean coverage
+in each bin (five rows as above), while the binary output records the
+mean, max and min per bin as arrays named refs:I:N:mean, refs:I:N:max
+and refs:I:N:min (for reference number I). Adding --pyramid (binary
+output only) records several zoom levels, using bin sizes N, 4N, 16N,
+etc (until a single bin covers the whole reference), so that a
+plotting tool can load just the resolution it needs.
+
+Normally the input is SAM format grouped by read name (typical of the
+raw output of mapping tools), which is processed in a single process.
+Alternatively, given a coordinate sorted and indexed BAM file (with the
+.bai index alongside), each reference is split into regions which are
+processed in parallel with --threads (this requires pysam). This makes
+two passes over the BAM file, the first counting the alignments of each
+read name (so the multi-mapping categories can be assigned as above),
+and the second recording the coverage for reads starting in each region
+as a difference array. This needs memory for the per-read name counts.
+
+For coordinate sorted SAM (or BAM, which need not be indexed) input,
+the --stream option avoids both the read name grouping and holding the
+whole genome in memory. Coverage is accumulated in a rolling window of
+difference values ahead of the current read, and positions behind it
+are written out as the input is read. Memory depends on the --window
+size (which must exceed the aligned length of the reads) rather than
+the genome size. Here the output gives a ">identifier length stream"
+line for each reference (so it can be told apart from the layout
+above), followed by a tab separated line for each position with any
+coverage, giving the one based position and the five coverage values.
+For circular references the first --window bases are written last,
+after any reads spanning the origin have been seen. If the @SQ header
+gives double the FASTA length (i.e. the reads were mapped against a
+doubled reference), alignments to the second copy can fall anywhere on
+the circle, so all its coverage is held back until the end of the
+reference (needing memory for the circle's length). Without such a
+header, alignments to the second copy must fall within the first
+--window bases. Note in this mode the categories are assigned from
+each alignment alone, using its FLAG and RNEXT (single reads are
+always counted as the first category, paired reads as partner unmapped
+if FLAG 0x8 is set or RNEXT is "*", and otherwise as both mapped to
+the same reference if RNEXT is "=" or the same as RNAME), with the
+weight taken from the NH tag (if present).
+
+To process many samples (libraries) against the same references, give
+their SAM (grouped by read name) or indexed BAM files as arguments
+instead of using -i. These are processed in parallel with --threads
+(one sample per worker process), and the output (which must be .npz)
+holds one float32 array of shape (samples, 5, length) per reference
+(named as above), plus arrays samples:names (the filenames, in order)
+and samples:reads (for each sample the number of singletons, reads
+where only /1 or /2 mapped, and where both mapped). A table of these per-sample totals and
+the mean depth on each reference is also printed to stderr.
+
+If only summary statistics are needed, use an output filename ending
+.json for a small JSON report instead of per-base values. This gives
+for each reference and category (plus their total) the mean and max
+depth, the percentage of bases covered at or above each of the depths
+given with --thresholds, and a depth histogram. The histogram has a
+bin for each whole number depth up to 100, then bins doubling in size
+(100 to 128, 128 to 256, and so on up to 2^20, plus a final bin for
+anything deeper), with any thresholds as extra bin boundaries. Entry i
+counts the bases with depth at least histogram_edges[i] but less than
+the next edge. These are calculated block by block from the difference
+arrays, so the coverage itself is never held in full. Note only with
+--stream is the memory used then independent of the genome size,
+otherwise the difference arrays for every reference are still needed
+(held in memory or memory mapped as described below).
+
+By default the coverage is accumulated in float64 arrays held in memory
+(5 values per base, for each reference). With --fixed-point this uses
+int32 arrays counting in units of 1/1000 of a read instead (half the
+memory, and exact sums), giving float32 coverage. The units for a read
+mapped N times are shared out as evenly as possible (e.g. 334, 333 and
+333 for N=3), so each read adds exactly 1000 units in total, although
+one alignment may be out by up to a unit from 1/N of a read (with N
+taken from the NH tags when using --stream). If the arrays would
+exceed --max-memory they are backed by memory mapped files (np.memmap)
+in a temporary directory, or always if --memmap-dir is given in which
+case the files are left behind for use by other tools. These are named
+REF.float64 or REF.float32, raw arrays of shape (5, length + 1) in the
+native byte order, where the final column is always zero.
+
+For long runs on SAM input grouped by read name, --checkpoint FILE
+saves the state every --checkpoint-every read names: the difference
+arrays, the number of bytes of input processed, and the read counts
+(written to a temporary file and renamed, so a crash while saving
+leaves the previous checkpoint intact). After a crash, run the same
+command again adding --resume to load the checkpoint and continue from
+that point in the input. If the input is a file this seeks straight
+there, while stdin has to be read and discarded up to that point. The
+checkpoint file is removed once the run completes.
 """
 
 import sys
 import os
+import shutil
+import tempfile
+import multiprocessing
+import json
+from itertools import izip
 from optparse import OptionParser
 import numpy as np
 
@@ -31,9 +140,28 @@ def sys_exit(msg, error_level=1):
     sys.stderr.write("%s\n" % msg)
     sys.exit(error_level)
 
-VERSION = "0.0.2"
+VERSION = "0.0.6"
+
+#Units per read for --fixed-point coverage values
+FIXED_POINT_SCALE = 1000
+
+#Ratio between bin sizes in successive levels of --pyramid output
+PYRAMID_FACTOR = 4
+
+#Number of bases per block when summarising coverage for .json output
+SUMMARY_BLOCK = 1000000
+
+#Depth histogram for .json output has a bin per whole number up to
+#HISTOGRAM_EXACT, then bins doubling in size up to HISTOGRAM_MAX (and
+#a final bin for anything deeper)
+HISTOGRAM_EXACT = 100
+HISTOGRAM_MAX = 2 ** 20
+
+#Names of the five coverage categories in .json output (see above)
+CATEGORY_NAMES = ["single", "single_multiple_refs", "paired",
+                  "paired_multiple_refs", "partner_unmapped"]
 
-parser = OptionParser(usage="usage: %prog [options]\n\n" + usage,
+parser = OptionParser(usage="usage: %prog [options] [SAM/BAM files]\n\n" + usage,
                       version="%prog "+VERSION)
 #References
 parser.add_option("-l", "--lref", dest="linear_references",
@@ -47,10 +175,69 @@ parser.add_option("-c", "--cref", dest="circular_references",
 #Reads
 parser.add_option("-i", "--input", dest="input_reads",
                   type="string", metavar="FILE",
-                  help="Input file of SAM format mapped reads to be processed (def. stdin)")
+                  help="Input file of SAM format mapped reads to be processed (def. stdin), "
+                       "or an indexed coordinate sorted BAM file (extension .bam, "
+                       "no index needed with --stream)")
+parser.add_option("-t", "--threads", dest="threads",
+                  type="int", metavar="N", default=1,
+                  help="Number of worker processes for indexed BAM input, "
+                       "or for multiple input files (def. 1)")
+parser.add_option("--region-size", dest="region_size",
+                  type="int", metavar="N", default=1000000,
+                  help="Size of each region for indexed BAM input (def. 1000000)")
+parser.add_option("--stream", dest="stream",
+                  action="store_true", default=False,
+                  help="Stream coordinate sorted input, writing out the "
+                       "coverage of each position once passed (see above)")
+parser.add_option("--window", dest="window",
+                  type="int", metavar="N", default=1000000,
+                  help="Size of the rolling window for --stream, which must "
+                       "exceed the aligned length of any read, and any "
+                       "end on the second copy of a doubled circular "
+                       "reference without an @SQ header (def. 1000000)")
+#Storage
+parser.add_option("--fixed-point", dest="fixed_point",
+                  action="store_true", default=False,
+                  help="Accumulate coverage as int32 fixed point values, "
+                       "giving float32 output (def. float64)")
+parser.add_option("--max-memory", dest="max_memory",
+                  type="int", metavar="MB", default=2048,
+                  help="Use memory mapped files for the coverage arrays if "
+                       "they would need more than this (def. 2048 MB)")
+parser.add_option("--memmap-dir", dest="memmap_dir",
+                  type="string", metavar="DIR",
+                  help="Directory for (and keep) memory mapped coverage "
+                       "arrays, named REF.float64 or REF.float32")
+#Checkpoints
+parser.add_option("--checkpoint", dest="checkpoint",
+                  type="string", metavar="FILE",
+                  help="Periodically save progress to this file (SAM input "
+                       "grouped by read name only), see --resume")
+parser.add_option("--checkpoint-every", dest="checkpoint_every",
+                  type="int", metavar="N", default=1000000,
+                  help="Save a checkpoint after every N read names (def. 1000000)")
+parser.add_option("--resume", dest="resume",
+                  action="store_true", default=False,
+                  help="Continue from the --checkpoint file (if present)")
 parser.add_option("-o","--output", dest="coverage_file",
                   type="string", metavar="FILE",
-                  help="Output file for coverage report (def. stdout)")
+                  help="Output file for coverage report (def. stdout), "
+                       "use the extension .npz for binary output, or "
+                       ".json for summary statistics only")
+parser.add_option("--thresholds", dest="thresholds",
+                  type="string", metavar="LIST", default="1,5,10,20,50,100",
+                  help="Comma separated depths, for the percentage of bases "
+                       "covered at or above each in .json output "
+                       "(def. 1,5,10,20,50,100)")
+parser.add_option("-b", "--bin-size", dest="bin_size",
+                  type="int", metavar="N", default=0,
+                  help="Summarise coverage in bins of N bases, rather "
+                       "than giving per-base values (def. 0, no binning)")
+parser.add_option("--pyramid", dest="pyramid",
+                  action="store_true", default=False,
+                  help="Record several zoom levels of binned coverage, "
+                       "starting from --bin-size and increasing by a factor "
+                       "of %i (requires binary .npz output)" % PYRAMID_FACTOR)
 
 (options, args) = parser.parse_args()
 
@@ -61,10 +248,79 @@ if len(sys.argv)==1:
 if (not options.linear_references) and (not options.circular_references):
     parser.error("You must supply some linear and/or circular references")
 if args:
-    parser.error("No arguments expected")
+    if options.input_reads:
+        parser.error("Give multiple input files as arguments, without -i")
+    if not (options.coverage_file and options.coverage_file.endswith(".npz")):
+        parser.error("Multiple input files require binary output (.npz filename)")
+    if options.stream or options.bin_size:
+        parser.error("Multiple input files require per-base coverage, "
+                     "without --stream or --bin-size")
+    if options.memmap_dir:
+        parser.error("Option --memmap-dir cannot be used with multiple input files")
+if options.bin_size < 0:
+    parser.error("Bin size cannot be negative")
+if options.threads < 1:
+    parser.error("Number of threads must be at least one")
+if options.region_size < 1:
+    parser.error("Region size must be at least one")
+bam_input = bool(options.input_reads) and options.input_reads.endswith(".bam")
+if options.threads > 1 and not (bam_input or args):
+    parser.error("Option --threads requires indexed BAM input or multiple input files")
+if options.stream:
+    if options.threads > 1:
+        parser.error("Option --stream cannot be used with --threads")
+    if options.bin_size:
+        parser.error("Option --stream cannot be used with --bin-size")
+    if options.coverage_file and options.coverage_file.endswith(".npz"):
+        parser.error("Option --stream gives plain text or .json output only")
+    if options.window < 2:
+        parser.error("Window size must be at least two")
+summary_output = bool(options.coverage_file) \
+                 and options.coverage_file.endswith(".json")
+if summary_output and options.bin_size:
+    parser.error("Option --bin-size cannot be used with summary output (.json filename)")
+try:
+    depth_thresholds = [int(t) for t in options.thresholds.split(",")]
+except ValueError:
+    parser.error("Thresholds should be comma separated integers")
+if min(depth_thresholds) < 0:
+    parser.error("Thresholds cannot be negative")
+#Lower bound of each histogram bin, including the thresholds so the
+#percentage at or above each can be taken from the histogram
+histogram_edges = range(HISTOGRAM_EXACT + 1)
+while histogram_edges[-1] < HISTOGRAM_MAX:
+    histogram_edges.append(2 ** histogram_edges[-1].bit_length())
+histogram_edges = np.array(sorted(set(histogram_edges + depth_thresholds)), np.int64)
+if options.memmap_dir and not os.path.isdir(options.memmap_dir):
+    parser.error("Memory map directory %s does not exist" % options.memmap_dir)
+if options.checkpoint:
+    if bam_input or options.stream or args:
+        parser.error("Option --checkpoint requires SAM input grouped by read name")
+    if options.checkpoint_every < 1:
+        parser.error("Checkpoint interval must be at least one")
+if options.resume and not options.checkpoint:
+    parser.error("Option --resume requires --checkpoint")
+if options.pyramid:
+    if not options.bin_size:
+        parser.error("Option --pyramid requires --bin-size")
+    if not (options.coverage_file and options.coverage_file.endswith(".npz")):
+        parser.error("Option --pyramid requires binary output (.npz filename)")
+
+if bam_input or [f for f in args if f.endswith(".bam")]:
+    try:
+        from pysam import AlignmentFile
+    except ImportError:
+        sys_exit("Missing 'pysam' module, required for BAM input")
 
 solo0 = solo1 = solo2 = solo12 = 0
 
+#Difference array data type, and directory for any memory mapped arrays
+if options.fixed_point:
+    diff_dtype = np.int32
+else:
+    diff_dtype = np.float64
+memmap_dir = None
+
 
 def go(input_handle, output_handle, linear_refs, circular_refs):
 
@@ -77,11 +333,21 @@ def go(input_handle, output_handle, linear_refs, circular_refs):
     global coverage
     coverage = dict()
 
-    for lengths in [ref_len_linear, ref_len_circles]:
-        for ref, length in lengths.iteritems():
-            coverage[ref] = np.zeros((5, length), np.float)
+    allocate_coverage(coverage)
+
+    #Bytes of input processed, and the number of batches (read names)
+    offset = batches = 0
+    if options.resume:
+        offset, batches = resume_checkpoint(options.checkpoint, input_handle, coverage)
+    resumed = batches
 
     for batch in batch_by_qname(input_handle):
+        if options.checkpoint and batches != resumed \
+        and batches % options.checkpoint_every == 0:
+            #Everything before this batch has been counted
+            save_checkpoint(options.checkpoint, coverage, offset, batches)
+        offset += sum(len(line) for line in batch)
+        batches += 1
         if not batch:
             continue
         if batch[0][0] == "@":
@@ -89,29 +355,9 @@ def go(input_handle, output_handle, linear_refs, circular_refs):
             for line in batch:
                 assert line[0] == "@"
                 if line[0:4] == "@SQ\t":
-                    parts = line[4:].strip().split("\t")
-                    rname = None
-                    length = None
-                    for p in parts:
-                        if p.startswith("SN:"):
-                            rname = p[3:]
-                        if p.startswith("LN:"):
-                            length = int(p[3:])
+                    rname, length = parse_sq_line(line)
                     sam_len_references[rname] = length
-                    if rname in ref_len_linear:
-                        assert length == ref_len_linear[rname]
-                        #print "Found @SQ line for linear reference %s" % rname
-                    elif rname in ref_len_circles:
-                        if length == 2 * ref_len_circles[rname]:
-                        #We will use the length from the FASTA file
-                            sys.stderr.write("WARNING: @SQ line for %s gives length %i, double %i in FASTA\n"
-                                             % (rname, length, ref_len_circles[rname]))
-                        else:
-                            assert length == ref_len_circles[rname]
-                    elif rname is None or length is None:
-                        sys_exit("Bad @SQ line:\n%s" % line)
-                    else:
-                        sys_exit("This reference was not given!:\n%s" % line)
+                    check_reference(rname, length, line)
             #End of header
             continue
 
@@ -142,8 +388,8 @@ def go(input_handle, output_handle, linear_refs, circular_refs):
                 field = 0
             else:
                 field = 1
-            weight = 1.0 / len(r0)
-            for rname, pos, cigar in r0:
+            for index, (rname, pos, cigar) in enumerate(sorted(r0)):
+                weight = read_weight(len(r0), index)
                 count_coverage(coverage, field, weight, rname, pos, cigar)
         elif r1 or r2:
             # This QNAME is a paired read
@@ -161,30 +407,830 @@ def go(input_handle, output_handle, linear_refs, circular_refs):
                 field = 4
             else:
                 assert False, "Error sorting %s by fragment" % qname
-            if r1:
-                weight = 1.0 / len(r1)
-                for rname, pos, cigar in r1:
-                    count_coverage(coverage, field, weight, rname, pos, cigar)
-            if r2:
-                weight = 1.0 / len(r2)
-                for rname, pos, cigar in r2:
-                    count_coverage(coverage, field, weight, rname, pos, cigar)
+            for index, (rname, pos, cigar) in enumerate(sorted(r1)):
+                weight = read_weight(len(r1), index)
+                count_coverage(coverage, field, weight, rname, pos, cigar)
+            for index, (rname, pos, cigar) in enumerate(sorted(r2)):
+                weight = read_weight(len(r2), index)
+                count_coverage(coverage, field, weight, rname, pos, cigar)
        
+    if summary_output:
+        write_summary(output_handle, summarise_coverage(coverage))
+        sys.stderr.write("%i singletons; %i where only /1, %i where only /2, %i where both mapped\n" % (solo0, solo1, solo2, solo12))
+        return
+
+    for ref in coverage:
+        coverage[ref] = materialise_coverage(ref, coverage[ref])
+
+    if output_handle is None:
+        #Multiple sample mode, see sample_coverage
+        return
+    write_coverage(output_handle, coverage, binary_output,
+                   options.bin_size, options.pyramid)
+    sys.stderr.write("%i singletons; %i where only /1, %i where only /2, %i where both mapped\n" % (solo0, solo1, solo2, solo12))
+
+
+def indexed_arrays(arrays):
+    """Returns the arrays for each reference keyed refs:0, refs:1, etc.
+
+    Takes a dictionary of reference names to arrays, and adds the names
+    (in the same order) as the array refs:names. This is used for all
+    the .npz files, as a reference name could clash with the file
+    argument of np.savez, or with the other names using colons.
+    """
+    names = sorted(arrays)
+    answer = dict(("refs:%i" % i, arrays[ref]) for i, ref in enumerate(names))
+    answer["refs:names"] = np.array(names)
+    return answer
+
+
+def save_checkpoint(filename, coverage, offset, batches):
+    """Save the difference arrays and progress so far, see resume_checkpoint."""
+    arrays = indexed_arrays(coverage)
+    arrays["checkpoint:offset"] = np.array(offset, np.int64)
+    arrays["checkpoint:batches"] = np.array(batches, np.int64)
+    arrays["checkpoint:counts"] = np.array([solo0, solo1, solo2, solo12], np.int64)
+    arrays["checkpoint:input"] = np.array(options.input_reads or "-")
+    #Write to a temporary file first, so any old checkpoint stays valid
+    handle = open(filename + ".tmp", "wb")
+    np.savez(handle, **arrays)
+    handle.close()
+    os.rename(filename + ".tmp", filename)
+    sys.stderr.write("Checkpoint after %i read names, %i bytes of input\n"
+                     % (batches, offset))
+
+
+def resume_checkpoint(filename, input_handle, coverage):
+    """Load a checkpoint into the difference arrays, and skip processed input.
+
+    Returns the offset (bytes of input processed) and the number of
+    batches (read names), or zeros if there is no checkpoint file yet.
+    """
+    global solo0, solo1, solo2, solo12
+    if not os.path.isfile(filename):
+        sys.stderr.write("WARNING: Checkpoint %s not found, starting from the beginning\n"
+                         % filename)
+        return 0, 0
+    data = np.load(filename)
+    if str(data["checkpoint:input"]) != (options.input_reads or "-"):
+        sys_exit("Checkpoint %s was for input %s, not %s"
+                 % (filename, data["checkpoint:input"], options.input_reads or "-"))
+    if "refs:names" in data.files:
+        names = dict((str(ref), i) for i, ref in enumerate(data["refs:names"]))
+    else:
+        names = dict()
+    for ref in coverage:
+        if ref not in names:
+            sys_exit("Checkpoint %s has no coverage for %s" % (filename, ref))
+        saved = data["refs:%i" % names[ref]]
+        if saved.shape != coverage[ref].shape or saved.dtype != coverage[ref].dtype:
+            sys_exit("Checkpoint %s has %s coverage for %s of shape %r, expected %s %r "
+                     "(check the references and --fixed-point setting)"
+                     % (filename, saved.dtype, ref, saved.shape,
+                        coverage[ref].dtype, coverage[ref].shape))
+        coverage[ref][:] = saved
+    offset = int(data["checkpoint:offset"])
+    batches = int(data["checkpoint:batches"])
+    solo0, solo1, solo2, solo12 = [int(n) for n in data["checkpoint:counts"]]
+    data.close()
+    if input_handle is sys.stdin:
+        #Can't seek, so read and discard what was already processed
+        skipped = 0
+        while skipped < offset:
+            line = input_handle.readline()
+            if not line:
+                sys_exit("Input ended after %i bytes, but checkpoint was at %i"
+                         % (skipped, offset))
+            skipped += len(line)
+        if skipped != offset:
+            sys_exit("Checkpoint offset %i is not at the end of a line" % offset)
+    else:
+        input_handle.seek(offset)
+    sys.stderr.write("Resuming after %i read names, %i bytes of input\n"
+                     % (batches, offset))
+    return offset, batches
+
+
+def parse_sq_line(line):
+    """Returns the reference name and length from an @SQ header line."""
+    parts = line[4:].strip().split("\t")
+    rname = None
+    length = None
+    for p in parts:
+        if p.startswith("SN:"):
+            rname = p[3:]
+        if p.startswith("LN:"):
+            length = int(p[3:])
+    return rname, length
+
+
+def check_reference(rname, length, line):
+    """Check the reference name and length from the SAM/BAM header."""
+    if rname in ref_len_linear:
+        assert length == ref_len_linear[rname]
+        #print "Found @SQ line for linear reference %s" % rname
+    elif rname in ref_len_circles:
+        if length == 2 * ref_len_circles[rname]:
+            #We will use the length from the FASTA file
+            doubled_circles.add(rname)
+            sys.stderr.write("WARNING: @SQ line for %s gives length %i, double %i in FASTA\n"
+                             % (rname, length, ref_len_circles[rname]))
+        else:
+            assert length == ref_len_circles[rname]
+    elif rname is None or length is None:
+        sys_exit("Bad @SQ line:\n%s" % line)
+    else:
+        sys_exit("This reference was not given!:\n%s" % line)
+
+
+def region_alignments(bam_filename, rname, start, end):
+    """Yields (qname, frag, pos, cigar) for mapped reads starting in the region.
+
+    Uses zero based POS, and fragment 0 for unpaired reads. Reads which
+    overlap the region but start before it are ignored (they belong to
+    the previous region), and like the SAM mode duplicated alignments
+    (same read name, fragment, position and CIGAR) are only counted once.
+    """
+    bam = AlignmentFile(bam_filename, "rb")
+    last_pos = None
+    seen = set()
+    for read in bam.fetch(rname, start, end):
+        pos = read.pos
+        if read.flag & 0x4 or pos < start:
+            continue
+        if pos != last_pos:
+            #Input is sorted, so any duplicates share the same POS
+            seen = set()
+            last_pos = pos
+        frag = get_frag(read.flag) or 0
+        key = (read.qname, frag, read.cigarstring)
+        if key in seen:
+            continue
+        seen.add(key)
+        yield read.qname, frag, pos, read.cigarstring
+    bam.close()
+
+
+def tally_region(region):
+    """First pass over a region of the BAM file, counting read alignments.
+
+    Returns a dictionary of read names to lists [n0, n1, n2, rname],
+    the number of alignments as an unpaired read, as the first part and
+    as the second part of a pair, and the reference name.
+    """
+    bam_filename, rname, start, end = region
+    tallies = dict()
+    for qname, frag, pos, cigar in region_alignments(bam_filename, rname, start, end):
+        try:
+            tally = tallies[qname]
+        except KeyError:
+            tally = tallies[qname] = [0, 0, 0, rname]
+        tally[frag] += 1
+    return tallies
+
+
+def cover_region(region):
+    """Second pass over a region of the BAM file, recording coverage.
+
+    Uses the global tallies from the first pass to assign the category
+    and weight of each read. Returns the reference name and a list of
+    (offset, array) dense blocks to add to its difference array (the
+    region itself, and any part wrapping round the origin).
+    """
+    bam_filename, rname, start, end = region
+    if rname in ref_len_circles:
+        length = ref_len_circles[rname]
+    else:
+        length = ref_len_linear[rname]
+    fields = []
+    positions = []
+    weights = []
+    #Index of each read's alignments (for --fixed-point, see read_weight)
+    indexes = dict()
+    for qname, frag, pos, cigar in region_alignments(bam_filename, rname, start, end):
+        n0, n1, n2, ref = tallies[qname]
+        if frag == 0:
+            if ref is not None:
+                field = 0
+            else:
+                field = 1
+        else:
+            if n1 and n2:
+                if ref is not None:
+                    field = 2
+                else:
+                    field = 3
+            else:
+                field = 4
+        index = 0
+        if options.fixed_point and (n0, n1, n2)[frag] > 1:
+            key = (rname, start, qname, frag)
+            index = indexes.get(key, tally_offsets.get(key, 0))
+            indexes[key] = index + 1
+        weight = read_weight((n0, n1, n2)[frag], index)
+        for position, multiplier in coverage_events(length, pos, pos + cigar_alen(cigar)):
+            fields.append(field)
+            positions.append(position)
+            weights.append(multiplier * weight)
+    fields = np.array(fields, np.int8)
+    positions = np.array(positions, np.int64)
+    weights = np.array(weights, diff_dtype)
+    blocks = []
+    for wanted in [positions >= start, positions < start]:
+        if wanted.any():
+            offset = positions[wanted].min()
+            block = np.zeros((5, positions[wanted].max() - offset + 1), diff_dtype)
+            np.add.at(block, (fields[wanted], positions[wanted] - offset), weights[wanted])
+            blocks.append((offset, block))
+    return rname, blocks
+
+
+def go_bam(bam_filename, output_handle, threads, region_size):
+    """Calculate coverage from an indexed coordinate sorted BAM file.
+
+    Each reference is split into regions, which are processed in two
+    passes (see tally_region and cover_region), using a pool of worker
+    processes if more than one thread is requested.
+    """
+    global solo0, solo1, solo2, solo12
+    solo0 = solo1 = solo2 = solo12 = 0
+    global coverage, tallies, tally_offsets
+
+    bam = AlignmentFile(bam_filename, "rb")
+    regions = []
+    for rname, length in zip(bam.references, bam.lengths):
+        check_reference(rname, length, "@SQ\tSN:%s\tLN:%i" % (rname, length))
+        for start in range(0, length, region_size):
+            regions.append((bam_filename, rname, start, min(start + region_size, length)))
+    bam.close()
+
+    coverage = dict()
+    allocate_coverage(coverage)
+
+    #First pass, count the alignments for each read
+    tallies = dict()
+    #For --fixed-point, the number of alignments of a read (and fragment)
+    #in earlier regions, keyed by region start, read name and fragment
+    tally_offsets = dict()
+    if threads > 1:
+        pool = multiprocessing.Pool(threads)
+        results = pool.imap(tally_region, regions)
+    else:
+        results = (tally_region(r) for r in regions)
+    for region, region_tallies in izip(regions, results):
+        for qname, (n0, n1, n2, ref) in region_tallies.iteritems():
+            try:
+                tally = tallies[qname]
+            except KeyError:
+                tallies[qname] = [n0, n1, n2, ref]
+                continue
+            if options.fixed_point:
+                for frag, n in enumerate([n0, n1, n2]):
+                    if n and tally[frag]:
+                        tally_offsets[region[1:3] + (qname, frag)] = tally[frag]
+            tally[0] += n0
+            tally[1] += n1
+            tally[2] += n2
+            if tally[3] != ref:
+                #Mapped to multiple references
+                tally[3] = None
+    if threads > 1:
+        pool.close()
+        pool.join()
+    for qname, (n0, n1, n2, ref) in tallies.iteritems():
+        if n0:
+            assert not n1 and not n2, \
+                "Inconsistent FLAG for %s, is it paired or unpaired?" % qname
+            solo0 += 1
+        elif n1 and n2:
+            solo12 += 1
+        elif n1:
+            solo1 += 1
+        else:
+            solo2 += 1
+
+    #Second pass, record the coverage (workers see the tallies via fork)
+    if threads > 1:
+        pool = multiprocessing.Pool(threads)
+        results = pool.imap(cover_region, regions)
+    else:
+        results = (cover_region(r) for r in regions)
+    for rname, blocks in results:
+        for offset, block in blocks:
+            coverage[rname][:, offset:offset + block.shape[1]] += block
+    if threads > 1:
+        pool.close()
+        pool.join()
+    del tallies, tally_offsets
+
+    if summary_output:
+        write_summary(output_handle, summarise_coverage(coverage))
+        sys.stderr.write("%i singletons; %i where only /1, %i where only /2, %i where both mapped\n" % (solo0, solo1, solo2, solo12))
+        return
+
+    for ref in coverage:
+        coverage[ref] = materialise_coverage(ref, coverage[ref])
+    if output_handle is None:
+        #Multiple sample mode, see sample_coverage
+        return
+    write_coverage(output_handle, coverage, binary_output,
+                   options.bin_size, options.pyramid)
+    sys.stderr.write("%i singletons; %i where only /1, %i where only /2, %i where both mapped\n" % (solo0, solo1, solo2, solo12))
+
+
+class CoverageWindow(object):
+    """Rolling difference array for one reference, used with --stream.
+
+    Holds the difference values from the offset onwards (relative to the
+    running total, carry, just before the offset). Once the input has
+    moved past a position its coverage is final, and flush writes it out.
+    For circular references the coverage of the first hold bases is kept
+    back (with a separate difference array for reads spanning the origin)
+    until finish is called at the end of the reference, all of it if the
+    input was mapped to a doubled reference. If given a DepthSummary, the
+    coverage is added to that instead of written out.
+    """
+
+    def __init__(self, ref, length, circular, size, output_handle, summary=None,
+                 doubled=False):
+        self.ref = ref
+        self.length = length
+        self.size = size
+        self.output_handle = output_handle
+        self.summary = summary
+        self.offset = 0
+        self.carry = np.zeros(5, diff_dtype)
+        self.diff = np.zeros((5, size + 1), diff_dtype)
+        self.max_depth = 0
+        if circular:
+            if doubled:
+                #Reads on the second copy may cover any of the circle
+                self.hold = length
+            else:
+                self.hold = min(size, length)
+            self.head = np.zeros((5, self.hold), diff_dtype)
+            self.head_diff = np.zeros((5, self.hold + 1), diff_dtype)
+        else:
+            self.hold = 0
+        if summary is None:
+            output_handle.write(">%s length %i stream\n" % (ref, length))
+
+    def add(self, field, start, end, weight):
+        """Record an alignment (zero based, must not start before offset).
+
+        Alignments starting past the end of a circular reference (i.e.
+        mapped to the second copy of a doubled reference) are taken
+        modulo the length, like any part spanning the origin, and must
+        fall within the bases held back. Alignments longer than the
+        reference require all of it to be held back.
+        """
+        if end - start >= self.size:
+            sys_exit("Alignment of length %i on %s exceeds the --window size %i"
+                     % (end - start, self.ref, self.size))
+        if start - self.offset >= self.size // 2 or end - self.offset >= self.size:
+            #Everything before this read is final
+            self.flush(min(start, self.length))
+        laps, extra = divmod(end - start, self.length)
+        if laps:
+            #Covers the whole reference at least once
+            if self.hold < self.length:
+                sys_exit("Alignment of length %i on %s is longer than the reference, "
+                         "this needs a --window size over %i"
+                         % (end - start, self.ref, self.length))
+            self.head_diff[field, 0] += laps * weight
+            self.head_diff[field, self.length] -= laps * weight
+            end = start + extra
+        if start >= self.length:
+            start -= self.length
+            end -= self.length
+        if end <= self.length:
+            parts = [(start, end)]
+        else:
+            #Spans the origin
+            parts = [(start, self.length), (0, end - self.length)]
+        for part_start, part_end in parts:
+            if part_start < self.offset:
+                #Already flushed, so must be within the bases held back
+                held_end = min(part_end, self.offset)
+                if not self.hold:
+                    sys_exit("Alignment at %i on linear reference %s runs past its end"
+                             % (start + 1, self.ref))
+                if held_end > self.hold:
+                    sys_exit("Alignment of length %i on %s wraps round beyond the "
+                             "--window size %i (for a doubled reference give the @SQ "
+                             "header with the doubled length)"
+                             % (end - start, self.ref, self.size))
+                self.head_diff[field, part_start] += weight
+                self.head_diff[field, held_end] -= weight
+                part_start = held_end
+            if part_start < part_end:
+                self.diff[field, part_start - self.offset] += weight
+                self.diff[field, part_end - self.offset] -= weight
+
+    def flush(self, upto):
+        """Write out the coverage for positions from the offset up to upto."""
+        while self.offset < upto:
+            n = min(upto - self.offset, self.size)
+            values = self.carry[:, np.newaxis] + np.cumsum(self.diff[:, :n], axis=1)
+            self.carry = values[:, -1].copy()
+            #Slide the window along
+            self.diff[:, :-n] = self.diff[:, n:].copy()
+            self.diff[:, -n:] = 0
+            if self.offset < self.hold:
+                #Keep back the start of a circular reference
+                kept = min(self.hold - self.offset, n)
+                self.head[:, self.offset:self.offset + kept] = values[:, :kept]
+                self.write(self.offset + kept, values[:, kept:])
+            else:
+                self.write(self.offset, values)
+            self.offset += n
 
+    def finish(self):
+        """Write out the rest of the coverage, including any held back."""
+        self.flush(self.length)
+        if self.hold:
+            self.head += np.cumsum(self.head_diff, axis=1)[:, :-1]
+            self.write(0, self.head)
+        sys.stderr.write("%s length %i max depth %i\n"
+                         % (self.ref, self.length, self.max_depth))
+
+    def write(self, start, values):
+        if not values.shape[1]:
+            return
+        values = final_values(values)
+        self.max_depth = max(self.max_depth, values.max())
+        if self.summary is not None:
+            self.summary.add(values)
+            return
+        covered = values.any(axis=0)
+        if covered.any():
+            positions = np.arange(start + 1, start + 1 + values.shape[1])[covered]
+            np.savetxt(self.output_handle,
+                       np.column_stack([positions, values[:, covered].T]),
+                       fmt="%i" + "\t%.1f" * 5)
+
+
+def sam_sorted_alignments(input_handle):
+    """Yields (qname, flag, rname, pos, cigar, rnext, nh) from SAM input.
+
+    Uses zero based POS, and checks any @SQ header lines. Unmapped reads
+    are ignored, and NH defaults to one if the tag is missing.
+    """
+    for line in input_handle:
+        if line[0] == "@":
+            if line[0:4] == "@SQ\t":
+                rname, length = parse_sq_line(line)
+                check_reference(rname, length, line)
+            continue
+        qname, flag, rname, pos, mapq, cigar, rnext, rest = line.split("\t", 7)
+        flag = int(flag)
+        if flag & 0x4 or rname == "*":
+            continue
+        nh = 1
+        i = rest.find("\tNH:i:")
+        if i != -1:
+            nh = int(rest[i + 6:].split("\t", 1)[0])
+        yield qname, flag, rname, int(pos) - 1, cigar, rnext, nh
+
+
+def bam_sorted_alignments(bam_filename):
+    """Yields (qname, flag, rname, pos, cigar, rnext, nh) from BAM input.
+
+    As sam_sorted_alignments, but reading the whole BAM file in order
+    (so no index is needed).
+    """
+    bam = AlignmentFile(bam_filename, "rb")
+    references = bam.references
+    for rname, length in zip(references, bam.lengths):
+        check_reference(rname, length, "@SQ\tSN:%s\tLN:%i" % (rname, length))
+    for read in bam.fetch(until_eof=True):
+        if read.flag & 0x4 or read.tid < 0:
+            continue
+        if read.rnext == read.tid:
+            rnext = "="
+        elif read.rnext < 0:
+            rnext = "*"
+        else:
+            rnext = references[read.rnext]
+        if read.has_tag("NH"):
+            nh = read.get_tag("NH")
+        else:
+            nh = 1
+        yield (read.qname, read.flag, references[read.tid], read.pos,
+               read.cigarstring, rnext, nh)
+    bam.close()
+
+
+def go_stream(alignments, output_handle, window):
+    """Calculate coverage from coordinate sorted alignments, streaming.
+
+    Takes an iterator of alignments (see sam_sorted_alignments), and
+    uses a CoverageWindow for the current reference. Like the other
+    modes, duplicated alignments (same read name, fragment, position and
+    CIGAR) are only counted once.
+    """
+    counts = [0, 0, 0, 0, 0]
+    current = None
+    finished = set()
+    summaries = dict()
+    last_pos = None
+    seen = set()
+    #Alignments so far of multiply mapped reads (for --fixed-point, see
+    #read_weight), removed once all NH of them have been seen
+    indexes = dict()
+    for qname, flag, rname, pos, cigar, rnext, nh in alignments:
+        if current is None or rname != current.ref:
+            if current is not None:
+                current.finish()
+                finished.add(current.ref)
+            if rname in finished:
+                sys_exit("Input not coordinate sorted, found %s again at read %s"
+                         % (rname, qname))
+            if rname in ref_len_circles:
+                length = ref_len_circles[rname]
+            elif rname in ref_len_linear:
+                length = ref_len_linear[rname]
+            else:
+                sys_exit("Read %s mapped to %s, this reference was not given!"
+                         % (qname, rname))
+            if summary_output:
+                summaries[rname] = DepthSummary(length)
+            current = CoverageWindow(rname, length, rname in ref_len_circles,
+                                     window, output_handle, summaries.get(rname),
+                                     rname in doubled_circles)
+            last_pos = None
+        elif pos < last_pos:
+            sys_exit("Input not coordinate sorted, read %s at %s:%i after %i"
+                     % (qname, rname, pos + 1, last_pos + 1))
+        if pos != last_pos:
+            #Input is sorted, so any duplicates share the same POS
+            seen = set()
+            last_pos = pos
+        frag = get_frag(flag) or 0
+        key = (qname, frag, cigar)
+        if key in seen:
+            continue
+        seen.add(key)
+        if not flag & 0x1:
+            field = 0
+        elif flag & 0x8 or rnext == "*":
+            field = 4
+        elif rnext == "=" or rnext == rname:
+            field = 2
+        else:
+            field = 3
+        index = 0
+        if options.fixed_point and nh > 1:
+            key = (qname, frag)
+            index = indexes.pop(key, 0)
+            if index + 1 < nh:
+                indexes[key] = index + 1
+        current.add(field, pos, pos + cigar_alen(cigar), read_weight(nh, index))
+        counts[field] += 1
+    if current is not None:
+        current.finish()
+        finished.add(current.ref)
+    if summary_output:
+        write_summary(output_handle, summaries)
+    else:
+        for lengths in [ref_len_linear, ref_len_circles]:
+            for ref, length in lengths.iteritems():
+                if ref not in finished:
+                    output_handle.write(">%s length %i stream\n" % (ref, length))
+    sys.stderr.write("%i single alignments; %i paired to the same reference, "
+                     "%i paired to another, %i with partner unmapped\n"
+                     % (counts[0], counts[2], counts[3], counts[4]))
+
+
+def sample_coverage(filename):
+    """Worker for multiple input files, calculates coverage for one sample.
+
+    Returns the filename, a dictionary of float32 coverage arrays (one
+    per reference), and the counts of singletons, reads where only /1
+    or /2 mapped, and where both mapped.
+    """
+    global memmap_dir
+    if filename.endswith(".bam"):
+        go_bam(filename, None, 1, options.region_size)
+    else:
+        input_handle = open(filename)
+        go(input_handle, None, ref_len_linear, ref_len_circles)
+        input_handle.close()
+    arrays = dict()
+    for ref in coverage:
+        arrays[ref] = np.array(coverage[ref], np.float32)
+        coverage[ref] = None
+    if memmap_dir:
+        #Remove this sample's temporary memory mapped arrays
+        shutil.rmtree(memmap_dir)
+        memmap_dir = None
+    return filename, arrays, (solo0, solo1, solo2, solo12)
+
+
+def go_samples(filenames, output_handle, threads):
+    """Calculate coverage for multiple samples, giving stacked arrays.
+
+    Each input file (SAM grouped by read name, or indexed BAM) is handled
+    by sample_coverage, using a pool of worker processes if more than one
+    thread is requested. Writes NumPy binary output with an array of
+    shape (samples, 5, length) for each reference, plus the sample names
+    and read counts (see usage).
+    """
+    stacked = dict()
     for lengths in [ref_len_linear, ref_len_circles]:
         for ref, length in lengths.iteritems():
-            output_handle.write(">%s length %i\n" % (ref, length))
-            m = 0
-            for row in coverage[ref]:
-                assert len(row) == length
-                row_max = max(row)
-                if row_max:
-                    output_handle.write("\t".join("%.1f" % v for v in row) + "\n")
+            stacked[ref] = np.zeros((len(filenames), 5, length), np.float32)
+    reads = np.zeros((len(filenames), 4), np.int64)
+
+    if threads > 1:
+        pool = multiprocessing.Pool(threads)
+        results = pool.imap(sample_coverage, filenames)
+    else:
+        results = (sample_coverage(f) for f in filenames)
+    for i, (filename, arrays, counts) in enumerate(results):
+        assert filename == filenames[i]
+        for ref, values in arrays.iteritems():
+            stacked[ref][i] = values
+        reads[i] = counts
+        sys.stderr.write("Sample %i of %i done, %s\n" % (i + 1, len(filenames), filename))
+    if threads > 1:
+        pool.close()
+        pool.join()
+
+    refs = sorted(stacked)
+    sys.stderr.write("#sample\tsingletons\tonly /1\tonly /2\tboth\t%s\n"
+                     % "\t".join("%s mean depth" % ref for ref in refs))
+    for i, filename in enumerate(filenames):
+        sys.stderr.write("%s\t%s\t%s\n"
+                         % (filename, "\t".join(str(n) for n in reads[i]),
+                            "\t".join("%0.2f" % stacked[ref][i].sum(axis=0).mean()
+                                      for ref in refs)))
+    stacked = indexed_arrays(stacked)
+    stacked["samples:names"] = np.array(filenames)
+    stacked["samples:reads"] = reads
+    np.savez_compressed(output_handle, **stacked)
+
+
+def bin_coverage(values, bin_size):
+    """Returns the mean, max and min coverage in each bin (as arrays).
+
+    Takes a (categories, length) array of per-base coverage, and returns
+    three arrays of shape (categories, bins). If the length is not a
+    multiple of the bin size, the final bin is shorter than the rest.
+    """
+    length = values.shape[1]
+    starts = np.arange(0, length, bin_size)
+    sizes = np.diff(np.append(starts, length))
+    return (np.add.reduceat(values, starts, axis=1) / sizes,
+            np.maximum.reduceat(values, starts, axis=1),
+            np.minimum.reduceat(values, starts, axis=1))
+
+
+def pyramid_bin_sizes(length, bin_size):
+    """Returns the bin sizes for the zoom levels of --pyramid output."""
+    sizes = [bin_size]
+    while sizes[-1] < length:
+        sizes.append(sizes[-1] * PYRAMID_FACTOR)
+    return sizes
+
+
+def write_coverage(output_handle, coverage, binary, bin_size=0, pyramid=False):
+    """Write out the coverage arrays (plain text or NumPy binary format).
+
+    If the bin size is zero, per-base coverage is written. Otherwise it
+    is summarised in bins of that size (see bin_coverage).
+    """
+    arrays = dict()
+    #Binary output names the arrays by reference number, see indexed_arrays
+    numbers = dict((ref, i) for i, ref in enumerate(sorted(coverage)))
+    for lengths in [ref_len_linear, ref_len_circles]:
+        for ref, length in lengths.iteritems():
+            values = coverage[ref]
+            assert values.shape[1] == length
+            sys.stderr.write("%s length %i max depth %i\n"
+                             % (ref, length, values.max()))
+            if binary and not bin_size:
+                #Compact binary output, one float32 array per reference
+                arrays["refs:%i" % numbers[ref]] = values.astype(np.float32)
+            elif binary:
+                if pyramid:
+                    sizes = pyramid_bin_sizes(length, bin_size)
                 else:
-                    output_handle.write("None\n")
-                m = max(m, row_max)
-            sys.stderr.write("%s length %i max depth %i\n" % (ref, length, m))
-    sys.stderr.write("%i singletons; %i where only /1, %i where only /2, %i where both mapped\n" % (solo0, solo1, solo2, solo12))
+                    sizes = [bin_size]
+                for size in sizes:
+                    for stat, binned in zip(["mean", "max", "min"],
+                                            bin_coverage(values, size)):
+                        arrays["refs:%i:%i:%s" % (numbers[ref], size, stat)] \
+                            = binned.astype(np.float32)
+            else:
+                if bin_size:
+                    output_handle.write(">%s length %i bin size %i\n"
+                                        % (ref, length, bin_size))
+                    values = bin_coverage(values, bin_size)[0]
+                else:
+                    output_handle.write(">%s length %i\n" % (ref, length))
+                for row in values:
+                    if row.max():
+                        #One format operation per row, much faster than per value
+                        output_handle.write("\t".join(["%.1f"] * len(row)) % tuple(row.tolist()) + "\n")
+                    else:
+                        output_handle.write("None\n")
+    if binary:
+        arrays["refs:names"] = np.array(sorted(coverage))
+        np.savez_compressed(output_handle, **arrays)
+
+
+def final_values(values):
+    """Coverage values as floats, from a block of the cumulative sums."""
+    if options.fixed_point:
+        return values * (1.0 / FIXED_POINT_SCALE)
+    values = values.copy()
+    #Remove any floating point noise left after cancelling weights
+    values[values < 1e-9] = 0.0
+    return values
+
+
+class DepthSummary(object):
+    """Depth statistics for one reference, accumulated block by block.
+
+    For each of the five categories and their total, records the sum
+    and max of the coverage, and a histogram of the depth using the bins
+    in histogram_edges (which gives the percentage of bases covered at
+    or above each threshold). Any bases not added (e.g. for a reference
+    with no reads) are counted as having zero coverage.
+    """
+
+    def __init__(self, length):
+        self.length = length
+        self.counted = 0
+        self.totals = np.zeros(6)
+        self.max_depth = np.zeros(6)
+        self.histograms = np.zeros((6, len(histogram_edges)), np.int64)
+
+    def add(self, values):
+        """Add a block of final coverage values, shape (5, bases)."""
+        values = np.vstack([values, values.sum(axis=0)])
+        self.counted += values.shape[1]
+        self.totals += values.sum(axis=1)
+        self.max_depth = np.maximum(self.max_depth, values.max(axis=1))
+        for i, row in enumerate(values):
+            #Allow for floating point error, e.g. 3 * (1/3) giving 0.999...
+            bins = np.searchsorted(histogram_edges, row + 1e-6, "right") - 1
+            self.histograms[i] += np.bincount(bins, minlength=len(histogram_edges))
+
+    def report(self, thresholds):
+        """Returns a dictionary of the statistics, for the JSON output."""
+        assert self.counted <= self.length
+        categories = dict()
+        for name, total, max_depth, histogram in zip(CATEGORY_NAMES + ["all"],
+                                                     self.totals, self.max_depth,
+                                                     self.histograms):
+            histogram = histogram.copy()
+            histogram[0] += self.length - self.counted
+            at_least = dict()
+            for threshold in thresholds:
+                wanted = histogram_edges.searchsorted(threshold)
+                at_least[str(threshold)] = round(100.0 * histogram[wanted:].sum()
+                                                 / self.length, 3)
+            categories[name] = {"mean_depth": round(total / self.length, 3),
+                                "max_depth": round(float(max_depth), 3),
+                                "percent_at_least": at_least,
+                                "histogram": histogram.tolist()}
+        return {"length": self.length, "categories": categories,
+                "histogram_edges": histogram_edges.tolist()}
+
+
+def summarise_coverage(coverage):
+    """Returns a DepthSummary for each of the difference arrays.
+
+    The cumulative sum is done a block at a time, so the coverage is
+    never materialised in full.
+    """
+    summaries = dict()
+    for ref, diff in coverage.iteritems():
+        length = diff.shape[1] - 1
+        summary = DepthSummary(length)
+        carry = np.zeros(5, diff.dtype)
+        for start in range(0, length, SUMMARY_BLOCK):
+            block = carry[:, np.newaxis] \
+                    + np.cumsum(diff[:, start:min(start + SUMMARY_BLOCK, length)], axis=1)
+            carry = block[:, -1].copy()
+            summary.add(final_values(block))
+        summaries[ref] = summary
+    return summaries
+
+
+def write_summary(output_handle, summaries):
+    """Write the JSON report of depth statistics for each reference."""
+    report = dict()
+    for lengths in [ref_len_linear, ref_len_circles]:
+        for ref, length in lengths.iteritems():
+            summary = summaries.get(ref, DepthSummary(length))
+            report[ref] = summary.report(depth_thresholds)
+            sys.stderr.write("%s length %i mean depth %0.2f\n"
+                             % (ref, length, report[ref]["categories"]["all"]["mean_depth"]))
+    json.dump(report, output_handle, sort_keys=True)
+    output_handle.write("\n")
 
 
 def cigar_tuples(cigar_str):
@@ -218,12 +1264,118 @@ def cigar_alen(cigar_str):
     return alen
 
 
+def coverage_events(length, start, end):
+    """Difference array events for coverage of start:end (zero based).
+
+    Returns a list of (position, multiplier) tuples, the weight of the
+    read times the multiplier is to be added to the difference array at
+    that position. Positions past the end of the reference wrap round
+    the origin (i.e. are taken modulo the length), and this is done by
+    splitting the interval in two.
+    """
+    events = []
+    laps, extra = divmod(end - start, length)
+    if laps:
+        #Read is longer than the reference, covers it all at least once
+        events.append((0, laps))
+        events.append((length, -laps))
+    start %= length
+    end = start + extra
+    events.append((start, 1))
+    if end <= length:
+        events.append((end, -1))
+    else:
+        #Spans the origin
+        events.append((length, -1))
+        events.append((0, 1))
+        events.append((end - length, -1))
+    return events
+
+
 def count_coverage(coverage, field, weight, rname, pos, cigar):
-    pos = int(pos) - 1
+    """Record the alignment in the difference array for this reference.
+
+    The arrays have one more column than the reference length, and the
+    coverage itself is recovered with materialise_coverage.
+    """
+    start = int(pos) - 1
     values = coverage[rname]
-    length = values.shape[1]
-    for i in xrange(pos, pos + cigar_alen(cigar)):
-        values[field, i % length] += weight
+    length = values.shape[1] - 1
+    for position, multiplier in coverage_events(length, start,
+                                                start + cigar_alen(cigar)):
+        values[field, position] += multiplier * weight
+
+
+def read_weight(alignments, index=0):
+    """Weight for an alignment of a read mapped this many times.
+
+    Normally this is a float, but with --fixed-point it is an integer
+    number of units (where FIXED_POINT_SCALE units is one read). Then
+    the remainder is spread over the first few alignments (by index,
+    counting from zero), so the weights for each read add up to exactly
+    FIXED_POINT_SCALE units.
+    """
+    if options.fixed_point:
+        weight, extra = divmod(FIXED_POINT_SCALE, alignments)
+        if index < extra:
+            return weight + 1
+        return weight
+    return 1.0 / alignments
+
+
+def new_array(name, length, dtype):
+    """Returns a zeroed (5, length + 1) array, memory mapped if required."""
+    if memmap_dir:
+        filename = os.path.join(memmap_dir, "%s.%s"
+                                % (name.replace(os.path.sep, "_"), np.dtype(dtype).name))
+        #New files are zero filled
+        return np.memmap(filename, dtype=dtype, mode="w+", shape=(5, length + 1))
+    return np.zeros((5, length + 1), dtype)
+
+
+def allocate_coverage(coverage):
+    """Add a difference array for each reference to the coverage dictionary.
+
+    See count_coverage, these have one more column than the reference
+    length, and are converted in situ by materialise_coverage.
+    """
+    global memmap_dir
+    total = 0
+    for lengths in [ref_len_linear, ref_len_circles]:
+        for length in lengths.itervalues():
+            total += 5 * (length + 1) * np.dtype(diff_dtype).itemsize
+    if options.memmap_dir:
+        memmap_dir = options.memmap_dir
+    elif total > options.max_memory * 1024 * 1024:
+        memmap_dir = tempfile.mkdtemp(prefix="coverage-")
+        sys.stderr.write("Coverage arrays need %i MB, using memory mapped files in %s\n"
+                         % (total // (1024 * 1024), memmap_dir))
+    for lengths in [ref_len_linear, ref_len_circles]:
+        for ref, length in lengths.iteritems():
+            coverage[ref] = new_array(ref, length, diff_dtype)
+
+
+def materialise_coverage(ref, diff):
+    """Turn a difference array into the coverage array (via cumsum).
+
+    This is done in situ for float64 values, while fixed point values
+    are converted into a new float32 array (and the int32 difference
+    array discarded).
+    """
+    np.cumsum(diff, axis=1, out=diff)
+    if diff.dtype == np.int32:
+        values = new_array(ref, diff.shape[1] - 1, np.float32)
+        for field in range(5):
+            np.multiply(diff[field], 1.0 / FIXED_POINT_SCALE, out=values[field],
+                        casting="unsafe")
+        if isinstance(diff, np.memmap):
+            os.remove(diff.filename)
+        del diff
+    else:
+        values = diff
+        #Remove any floating point noise left after cancelling weights
+        values[values < 1e-9] = 0.0
+    return values[:, :-1]
 
 def get_frag(flag):
     f = int(flag)
@@ -271,6 +1423,8 @@ if options.circular_references:
     for f in options.circular_references:
         ref_len_circles.update(get_fasta_ids_and_lengths(f))
     sys.stderr.write("Lengths of %i circular references loaded\n" % len(ref_len_circles))
+#Circular references with a doubled length in the @SQ header, see check_reference
+doubled_circles = set()
 
 
 def batch_by_qname(input_handle):
@@ -305,21 +1459,43 @@ def batch_by_qname(input_handle):
 
 
 #Open handles
-if options.input_reads:
+if bam_input:
+    input_handle = None
+elif options.input_reads:
     input_handle = open(options.input_reads)
 else:
     input_handle = sys.stdin
-if options.coverage_file:
+binary_output = bool(options.coverage_file) \
+                and options.coverage_file.endswith(".npz")
+if binary_output:
+    output_handle = open(options.coverage_file, "wb")
+elif options.coverage_file:
     output_handle = open(options.coverage_file, "w")
 else:
     output_handle = sys.stdout
 
 
-go(input_handle, output_handle, ref_len_circles, ref_len_circles)
+if args:
+    go_samples(args, output_handle, options.threads)
+elif options.stream and bam_input:
+    go_stream(bam_sorted_alignments(options.input_reads), output_handle, options.window)
+elif options.stream:
+    go_stream(sam_sorted_alignments(input_handle), output_handle, options.window)
+elif bam_input:
+    go_bam(options.input_reads, output_handle, options.threads, options.region_size)
+else:
+    go(input_handle, output_handle, ref_len_circles, ref_len_circles)
 
 
 #Close handles
-if options.input_reads:
+if options.input_reads and not bam_input:
     input_handle.close()
 if options.coverage_file:
     output_handle.close()
+if memmap_dir and not options.memmap_dir:
+    #Remove temporary memory mapped arrays
+    del coverage
+    shutil.rmtree(memmap_dir)
+if options.checkpoint and os.path.isfile(options.checkpoint):
+    #Run completed, no longer needed
+    os.remove(options.checkpoint)
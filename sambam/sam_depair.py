@@ -8,7 +8,9 @@ FLAG.
 
 This script is designed to be used as part of a Unix pipeline. It
 takes no command line arguments. It reads SAM format data from stdin,
-and writes SAM format data to stdout.
+and writes SAM format data to stdout. Alternatively give filenames with
+-i and -o, where any ending .bam are read or written as BAM directly
+(see bgzf_io.py), using -t threads for the compression.
 
 The only change made to the FLAG field, clearing the following bits:
 * 0x1 template having multiple segments in sequencing
@@ -25,22 +27,45 @@ Simple usage with BAM files with conversion to/from SAM via samtools:
 
 $ samtools view -h original.bam | ./sam_depair.py | samtools view -S -b - > as_singles.bam
 
+Or without samtools:
+
+$ ./sam_depair.py -i original.bam -o as_singles.bam
+
 Copyright Peter Cock 2014. All rights reserved. See:
 https://github.com/peterjc/picobio
 """
 
 import sys
+from optparse import OptionParser
+from bgzf_io import open_sam_input, open_sam_output
 
-if len(sys.argv) != 1:
+parser = OptionParser(usage="usage: %prog [options]\n\n" + usage)
+parser.add_option("-i", "--input", dest="input_reads",
+                  type="string", metavar="FILE",
+                  help="Input SAM file (def. stdin), or BAM if the extension is .bam")
+parser.add_option("-o", "--output", dest="output_reads",
+                  type="string", metavar="FILE",
+                  help="Output SAM file (def. stdout), or BAM if the extension is .bam")
+parser.add_option("-t", "--threads", dest="threads",
+                  type="int", metavar="N", default=1,
+                  help="Number of threads for BAM compression (def. 1)")
+(options, args) = parser.parse_args()
+
+if args:
     sys.stderr.write("ERROR: Bad arguments.\n\n")
     sys.stderr.write("Expects SAM on stdin, and writes SAM to stdout.\n")
     sys.exit(1)
+if options.threads < 1:
+    parser.error("Number of threads must be at least one")
+
+input_handle = open_sam_input(options.input_reads, options.threads)
+output_handle = open_sam_output(options.output_reads, options.threads)
 
 count = 0
 tweaked = 0
 mask = 0x1 | 0x8 | 0x20 | 0x40 | 0x80
 flip_mask = ~mask
-for line in sys.stdin:
+for line in input_handle:
     if line[0]!="@":
         #Should be a read
         count += 1
@@ -51,5 +76,9 @@ for line in sys.stdin:
             flag = flag & flip_mask
             tweaked += 1
             line = "%s\t%i\t%s" % (qname, flag, rest)
-    sys.stdout.write(line)
+    output_handle.write(line)
+if options.input_reads:
+    input_handle.close()
+if options.output_reads:
+    output_handle.close()
 sys.stderr.write("Tweaked %i out of %i reads\n" % (tweaked, count))
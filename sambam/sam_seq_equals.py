@@ -27,30 +27,89 @@ $ samtools view -h original.bam | ./sam_seq_equals reference.fasta [mode] | samt
 If your SAM/BAM files lack @SQ headers, you may need to give
 samtools the reference FASTA file as well.
 
+Alternatively, give input and/or output filenames with -i and -o, where
+any ending .bam are read or written as BAM directly (see bgzf_io.py),
+using -t threads for the compression:
+
+$ ./sam_seq_equals -i original.bam -o equals.bam -t 4 reference.fasta [mode]
+
+Here -t also sets the number of worker processes for the add, remove
+and full modes. The reads are sent to the workers in chunks, and written
+out in their original order. For coordinate sorted input each chunk
+covers a contiguous region of the reference, which works best with a
+2bit reference (see below) as each worker then only decodes the part
+of the reference it needs.
+
+For large genomes, especially with name sorted or unsorted reads, it is
+faster to first convert the reference FASTA file into a memory mapped
+2bit file (see twobit_reference.py), and give this instead:
+
+$ ./twobit_reference.py -o reference.2bit reference.fasta
+$ ./sam_seq_equals reference.2bit [mode] < original.sam > equals.sam
+
+The experimental mode "pack" instead writes a binary container (given
+with -o), storing just the bases which differ from the reference for
+each read, the CIGAR as integers, and the other SAM fields as separately
+compressed columns (see refdiff_container.py). This gives a report of
+the size compared to the input SAM (and the SAM gzipped), and of the
+size of each column. Mode "unpack" turns this back into the original
+SAM, given the same reference (the container records the length and
+MD5 of each reference used, and unpack refuses to use one which does
+not match):
+
+$ ./sam_seq_equals -o packed.rdiff reference.fasta pack < original.sam
+$ ./sam_seq_equals -i packed.rdiff reference.fasta unpack > original.sam
+
 Copyright Peter Cock 2012. All rights reserved. See:
 https://github.com/peterjc/picobio
 http://blastedbio.blogspot.co.uk/2012/02/reference-based-sambam-compression.html
 """
 
 import sys
+import os
+import time
+import zlib
+import hashlib
+import multiprocessing
+from collections import deque
+from optparse import OptionParser
+from bgzf_io import open_sam_input, open_sam_output
 
-if len(sys.argv) == 2:
-    reference_filename = sys.argv[1]
+parser = OptionParser(usage="usage: %prog [options] reference.fasta [mode]\n\n" + usage)
+parser.add_option("-i", "--input", dest="input_reads",
+                  type="string", metavar="FILE",
+                  help="Input SAM file (def. stdin), or BAM if the extension is .bam")
+parser.add_option("-o", "--output", dest="output_reads",
+                  type="string", metavar="FILE",
+                  help="Output SAM file (def. stdout), or BAM if the extension is .bam")
+parser.add_option("-t", "--threads", dest="threads",
+                  type="int", metavar="N", default=1,
+                  help="Number of worker processes (for modes add, remove and "
+                       "full), and threads for any BAM compression (def. 1)")
+(options, args) = parser.parse_args()
+if options.threads < 1:
+    parser.error("Number of threads must be at least one")
+
+if len(args) == 1:
+    reference_filename = args[0]
     add_equals = True
     drop_seq = False
-elif len(sys.argv) ==3:
-    reference_filename = sys.argv[1]
-    if sys.argv[2].lower() == "add":
+elif len(args) ==2:
+    reference_filename = args[0]
+    if args[1].lower() == "add":
         add_equals = True
         drop_seq = False
-    elif sys.argv[2].lower() == "remove":
+    elif args[1].lower() == "remove":
         add_equals = False
         drop_seq = False
-    elif sys.argv[2].lower() == "full":
+    elif args[1].lower() == "full":
         add_equals = True
         drop_seq = True
+    elif args[1].lower() in ["pack", "unpack"]:
+        add_equals = drop_seq = None
     else:
-        sys.stderr.write("ERROR: Second (optional) argument must be 'add' (default) or 'remove' (no quotes)\n\n")
+        sys.stderr.write("ERROR: Second (optional) argument must be 'add' (default), 'remove', "
+                         "'full', 'pack' or 'unpack' (no quotes)\n\n")
         sys.stderr.write(usage)
         sys.exit(1)
 else:
@@ -60,12 +119,42 @@ else:
     sys.stderr.write("argument of the mode (add, drop, or full).\n\n")
     sys.stderr.write("Read the start of the script for more details.\n")
     sys.exit(1)
+if len(args) == 2:
+    mode = args[1].lower()
+else:
+    mode = "add"
+if mode == "pack" and (not options.output_reads or options.output_reads.endswith(".bam")):
+    sys.stderr.write("ERROR: Mode 'pack' requires an output container filename (-o)\n")
+    sys.exit(1)
+if mode == "unpack" and (not options.input_reads or options.input_reads.endswith(".bam")):
+    sys.stderr.write("ERROR: Mode 'unpack' requires an input container filename (-i)\n")
+    sys.exit(1)
 
 try:
-    from Bio import SeqIO
+    import numpy as np
 except ImportError:
-    sys.stderr.write("Required Biopython\n")
+    sys.stderr.write("Required NumPy\n")
     sys.exit(1)
+if mode in ["pack", "unpack"]:
+    from refdiff_container import RefDiffReader, RefDiffWriter
+if reference_filename.endswith(".2bit"):
+    from twobit_reference import TwoBitReference
+else:
+    try:
+        from Bio import SeqIO
+    except ImportError:
+        sys.stderr.write("Required Biopython\n")
+        sys.exit(1)
+
+#Byte values for "=" in SEQ, and "?" as padding past the reference end
+EQUALS = np.uint8(ord("="))
+QUERY = np.uint8(ord("?"))
+
+#Reads per chunk sent to the worker processes (up to four times this,
+#for coordinate sorted input a chunk ends where the reads move into a
+#new window of this many bases, or onto another reference)
+CHUNK_SIZE = 10000
+CHUNK_WINDOW = 65536
 
 def decode_cigar(cigar):
     """Returns a list of 2-tuples, integer count and operator char."""
@@ -83,60 +172,77 @@ def decode_cigar(cigar):
 
 assert decode_cigar("14S15M1P1D3P54M1D34M5S") == [(14,'S'),(15,'M'),(1,'P'),(1,'D'),(3,'P'),(54,'M'),(1,'D'),(34,'M'),(5,'S')]
 
-def add_or_remove_equals(ref_seq, read_seq, pos, cigar, add=True, drop=False):
-    """Returns read_seq with equals signs for matched bases.
+def aligned_reference(ref_seq, read_len, pos, cigar):
+    """Returns the reference bases lined up with the read, as a byte array.
 
-    Assumes both ref_seq and read_seq are using the same case.
+    Soft clipped or inserted read bases are given as zero. Also returns
+    a list of any X or = blocks as (offset in read, length, operator).
     """
     if pos >= len(ref_seq):
         raise ValueError("Bad POS %i for a reference of length %i" \
                          % (pos, len(ref_seq)))
-    offset = pos
-    pending = read_seq
-    answer = ""
-    cigar_ops = decode_cigar(cigar)
-    while cigar_ops:
-        op_len, op = cigar_ops.pop(0)
+    if isinstance(ref_seq, str):
+        ref = np.frombuffer(ref_seq, np.uint8)
+    else:
+        #e.g. TwoBitSequence, slices are decoded as arrays on demand
+        ref = ref_seq
+    parts = []
+    checks = []
+    offset = 0
+    for op_len, op in decode_cigar(cigar):
         if op == "H":
             pass
-        elif op == "S":
-            answer += pending[:op_len]
-            pending = pending[op_len:]
+        elif op in "SI":
+            parts.append(np.zeros(op_len, np.uint8))
+            offset += op_len
         elif op in "MX=":
-            #print "%i%s - %s vs %s" % (op_len, op, ref_seq[pos:pos+op_len],pending[:op_len])
-            if op_len > len(pending):
-                raise RuntimeError("Only %i bases left for %i%s" % (len(pending), op_len, op))
+            if offset + op_len > read_len:
+                raise RuntimeError("Only %i bases left for %i%s" % (read_len - offset, op_len, op))
+            parts.append(ref[pos:pos + op_len])
             if pos + op_len - 1 >= len(ref_seq):
                 #TODO - Treat this as an error and terminate?
                 sys.stderr.write("Warning, ran off end of %i bp reference by %i bp, pos %i, CIGAR %s\n" \
                                  % (len(ref_seq), pos + op_len - len(ref_seq), pos, cigar))
                 #e.g. NA12878.chromMT.SLX.maq.SRP000032.2009_07.bam read SRR010937.2897481
-                ref_seq += "?" * op_len #Hack
-            #for ref_base, read_base in zip(ref_seq[pos:pos+op_len],pending[:op_len]):
-            for i in range(op_len):
-                read_base = pending[i]
-                ref_base = ref_seq[pos+i]
-                if ref_base==read_base or read_base=="=":
-                    assert op != "X", "Bad CIGAR %s for %s" % (cigar, read_seq)
-                    if add:
-                        answer += "="
-                    else:
-                        #Remove any equals sign,
-                        answer += ref_base
-                else:
-                    assert op != "=", "Bad CIGAR %s for %s" % (cigar, read_seq)
-                    answer += read_base
-            pending = pending[op_len:]
+                parts.append(np.repeat(QUERY, op_len - len(parts[-1]))) #Hack
+            if op != "M":
+                checks.append((offset, op_len, op))
+            offset += op_len
             pos += op_len
-        elif op == "I":
-            answer += pending[:op_len]
-            pending = pending[op_len:]
         elif op in "DN":
             pos += op_len
         else:
             raise ValueError("Unsupported CIGAR operator %s in %s" % (op, cigar))
-    if pending:
-        raise RunTimeError("Still had %i bases left" % len(pending))
+    if offset < read_len:
+        raise RuntimeError("Still had %i bases left" % (read_len - offset))
+    if len(parts) == 1:
+        return parts[0], checks
+    return np.concatenate(parts or [np.zeros(0, np.uint8)]), checks
+
+
+def add_or_remove_equals(ref_seq, read_seq, pos, cigar, add=True, drop=False):
+    """Returns read_seq with equals signs for matched bases.
+
+    Assumes both ref_seq and read_seq are using the same case.
+
+    The read is lined up with a byte array of the reference bases (see
+    aligned_reference) so that all the bases are compared at once with
+    NumPy, and the new SEQ built with a single np.where.
+    """
+    read = np.frombuffer(read_seq, np.uint8)
+    aligned, checks = aligned_reference(ref_seq, len(read), pos, cigar)
+    #Clipped and inserted bases are zero, so never match
+    matched = (aligned == read) | ((read == EQUALS) & (aligned != 0))
+    for offset, op_len, op in checks:
+        if op == "X":
+            assert not matched[offset:offset + op_len].any(), "Bad CIGAR %s for %s" % (cigar, read_seq)
+        else:
+            assert matched[offset:offset + op_len].all(), "Bad CIGAR %s for %s" % (cigar, read_seq)
+    if add:
+        answer = np.where(matched, EQUALS, read).tobytes()
+    else:
+        #Remove any equals sign,
+        answer = np.where(matched, aligned, read).tobytes()
     assert len(answer) == len(read_seq), "%s -> %s with %s" % (read_seq, answer, cigar)
     if drop and answer == "=" * len(answer) and len(answer) > 1:
         #Don't need the sequence at all!
@@ -177,52 +283,266 @@ assert ("========C======T==T======C=============T", "33M2D7M") == temp, temp
 del temp_mt, temp
 
 
+def open_reference():
+    """Open the reference (also called in each worker process).
+
+    Each worker has its own memory map of a 2bit file (the pages are
+    shared by the operating system), or its own FASTA index.
+    """
+    global reference
+    if reference_filename.endswith(".2bit"):
+        reference = TwoBitReference(reference_filename)
+    else:
+        try:
+            import sqlite3
+            reference = SeqIO.index_db(reference_filename+".idx", reference_filename, "fasta")
+        except ImportError:
+            reference = SeqIO.index(reference_filename, "fasta")
+
 sys.stderr.write("Loading reference sequences from %s\n" % reference_filename)
-try:
-    import sqlite3
-    reference = SeqIO.index_db(reference_filename+".idx", reference_filename, "fasta")
-except ImportError:
-    reference = SeqIO.index(reference_filename, "fasta")
+open_reference()
 if not reference:
     sys.stderr.write("No sequences found in FASTA reference file %s\n" % reference_filename)
     sys.exit(1)
 sys.stderr.write("Sequences for %i reference(s) available\n" % len(reference))
                                 
 
+def load_reference(rname):
+    """Returns the (upper case) reference sequence, caching the last one.
+
+    Raises a KeyError with a suitable message if the reference is not
+    found (rather than calling sys.exit, as this may be in a worker
+    process).
+    """
+    global ref_name, ref_seq
+    if rname != ref_name:
+        try:
+            if reference_filename.endswith(".2bit"):
+                #Decoded on demand, see add_or_remove_equals
+                ref_seq = reference[rname]
+            else:
+                ref_seq = str(reference[rname].seq).upper()
+        except KeyError:
+            raise KeyError("Reference %s not in %s" % (rname, reference_filename))
+        ref_name = rname
+    return ref_seq
+
+
+def reference_checksum(rname):
+    """Returns the length and MD5 of the (upper case) reference sequence."""
+    ref_seq = load_reference(rname)
+    md5 = hashlib.md5()
+    for start in range(0, len(ref_seq), 1000000):
+        part = ref_seq[start:start + 1000000]
+        if not isinstance(part, str):
+            #e.g. TwoBitSequence gives an array
+            part = part.tostring()
+        md5.update(part)
+    return len(ref_seq), md5.hexdigest()
+
+
+def pack(input_handle, container_filename):
+    """Write the reads to a reference-diff container, and report the sizes."""
+    count = diffs = sam_size = 0
+    gzipped = zlib.compressobj()
+    gzip_size = 0
+    start = time.time()
+    writer = RefDiffWriter(container_filename)
+    for line in input_handle:
+        sam_size += len(line)
+        gzip_size += len(gzipped.compress(line))
+        if line[0] == "@":
+            writer.header.append(line)
+            continue
+        count += 1
+        fields = line.rstrip("\n").split("\t", 11)
+        if len(fields) == 12:
+            tags = fields.pop()
+        else:
+            tags = None
+        qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual = fields
+        aligned = None
+        if rname != "*" and not int(flag) & 0x4 and seq != "*" and cigar != "*":
+            try:
+                aligned = aligned_reference(load_reference(rname), len(seq), int(pos) - 1, cigar)[0]
+                diffs += 1
+            except (ValueError, RuntimeError):
+                #Store this SEQ as it is
+                pass
+            else:
+                if rname not in writer.checksums:
+                    writer.checksums[rname] = reference_checksum(rname)
+        writer.add(fields, tags, aligned)
+    writer.close()
+    gzip_size += len(gzipped.flush())
+    taken = time.time() - start
+    size = os.path.getsize(container_filename)
+    sys.stderr.write("Packed %i reads (%i relative to the reference) in %i blocks, "
+                     "%0.1fs (%i reads/s)\n" % (count, diffs, len(writer.blocks),
+                                                taken, count / max(taken, 1e-6)))
+    sys.stderr.write("SAM %i bytes, gzipped %i bytes, container %i bytes "
+                     "(%0.1f%% of gzipped SAM)\n"
+                     % (sam_size, gzip_size, size, 100.0 * size / max(gzip_size, 1)))
+    sys.stderr.write("Column\tCompressed\tRaw\n")
+    for name, sizes in sorted(writer.sizes.items(), key=lambda x: -x[1][0]):
+        sys.stderr.write("%s\t%i\t%i\n" % (name, sizes[0], sizes[1]))
+
+
+def unpack(container_filename, output_handle):
+    """Write out the reads from a reference-diff container as SAM."""
+    count = 0
+    start = time.time()
+    reader = RefDiffReader(container_filename, lambda rname, pos, cigar, length:
+                           aligned_reference(load_reference(rname), length, pos, cigar)[0])
+    for rname, (length, md5) in sorted(reader.checksums.items()):
+        if reference_checksum(rname) != (length, md5):
+            sys.stderr.write("ERROR: Reference %s in %s does not match the one used "
+                             "for packing (length %i, MD5 %s)\n"
+                             % (rname, reference_filename, length, md5))
+            sys.exit(1)
+    for line in reader:
+        if line[0] != "@":
+            count += 1
+        output_handle.write(line)
+    reader.close()
+    taken = time.time() - start
+    sys.stderr.write("Unpacked %i reads in %0.1fs (%i reads/s)\n"
+                     % (count, taken, count / max(taken, 1e-6)))
+
+
 ref_name = ""
 ref_seq = ""
+if mode == "pack":
+    input_handle = open_sam_input(options.input_reads, options.threads)
+    try:
+        pack(input_handle, options.output_reads)
+    except KeyError, err:
+        sys.stderr.write("%s\n" % err.args[0])
+        sys.exit(2)
+    if options.input_reads:
+        input_handle.close()
+    sys.exit(0)
+elif mode == "unpack":
+    output_handle = open_sam_output(options.output_reads, options.threads)
+    try:
+        unpack(options.input_reads, output_handle)
+    except KeyError, err:
+        sys.stderr.write("%s\n" % err.args[0])
+        sys.exit(2)
+    if options.output_reads:
+        output_handle.close()
+    sys.exit(0)
+
+def process_line(line):
+    """Returns the SAM line with equals signs added or removed (see mode)."""
+    global mod, bases
+    if line[0] == "@":
+        return line
+    fields = line.split("\t", 11)
+    if len(fields) == 11:
+        #No optional tags, so QUAL has the trailing new line
+        fields[10] = fields[10].rstrip("\n")
+        fields.append(None)
+    qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual, rest = fields
+    if seq != "*":
+        bases += len(seq)
+        #TODO - Look at CIGAR or qual if SEQ is missing?
+    if rname != "*" and not int(flag) & 0x4:
+        #Mapped read
+        ref_seq = load_reference(rname)
+        #Add/remove equals signs in the read's sequence:
+        try:
+            seq, cigar = add_or_remove_equals(ref_seq, seq, int(pos)-1, cigar, add_equals, drop_seq)
+            if seq == "*":
+                #According to spec, if omit SEQ must also omit QUAL (and samtools complains)
+                qual = "*"
+        except:
+            sys.stderr.write(line)
+            raise
+        mod += 1
+        fields = [qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual]
+        if rest is None:
+            line = "\t".join(fields) + "\n"
+        else:
+            line = "\t".join(fields + [rest])
+    return line
+
+
+def process_chunk(chunk):
+    """Process a list of SAM lines, returns the new text and counts.
+
+    Used in the worker processes, so the counts for this chunk are
+    returned (see processed_chunks) rather than kept in the global
+    variables.
+    """
+    global mod, bases
+    mod = bases = 0
+    lines = [process_line(line) for line in chunk]
+    return "".join(lines), sum(1 for line in chunk if line[0] != "@"), mod, bases
+
+
+def processed_chunks(input_handle):
+    """Yields the results of process_chunk for chunks of the input, in order.
+
+    For coordinate sorted input, each chunk ends where the reads move
+    to a new reference or window of the reference (see CHUNK_WINDOW, the
+    same size as the 2bit decoding windows), so each worker only needs a
+    contiguous region of the reference.
+    """
+    if options.threads > 1:
+        #Limit how many chunks are in memory at once, keeping input order
+        pending = deque()
+    chunk = []
+    last = None
+    for line in input_handle:
+        if line[0] != "@":
+            #Reference and window of this read
+            fields = line.split("\t", 4)
+            key = (fields[2], int(fields[3]) // CHUNK_WINDOW)
+            if len(chunk) >= 4 * CHUNK_SIZE or (len(chunk) >= CHUNK_SIZE and key != last):
+                if options.threads > 1:
+                    pending.append(pool.apply_async(process_chunk, (chunk,)))
+                    if len(pending) >= 2 * options.threads:
+                        yield pending.popleft().get()
+                else:
+                    yield process_chunk(chunk)
+                chunk = []
+            last = key
+        chunk.append(line)
+    if options.threads > 1:
+        if chunk:
+            pending.append(pool.apply_async(process_chunk, (chunk,)))
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+        pool.join()
+    elif chunk:
+        yield process_chunk(chunk)
+
+
+if options.threads > 1:
+    #Start the worker processes before any BAM compression threads
+    pool = multiprocessing.Pool(options.threads, open_reference)
+
+input_handle = open_sam_input(options.input_reads, options.threads)
+output_handle = open_sam_output(options.output_reads, options.threads)
+
+#Totals (mod and bases are used for each chunk, see process_chunk)
 count = 0
-mod = 0
-bases = 0
-for line in sys.stdin:
-    if line[0]!="@":
-        #Should be a read
-        count += 1
-        qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual, rest = line.split("\t", 11)
-        if seq != "*":
-            bases += len(seq)
-            #TODO - Look at CIGAR or qual if SEQ is missing?
-        if rname != "*" and not int(flag) & 0x4:
-            #Mapped read
-            if rname != ref_name:
-                try:
-                    ref_seq = str(reference[rname].seq).upper()
-                except KeyError:
-                    sys.stderr.write("Reference %s for read %s not in %s\n" \
-                                     % (rname, qname, reference_filename))
-                    sys.exit(2)
-                ref_name = rname
-            #Add/remove equals signs in the read's sequence:
-            try:
-                seq, cigar = add_or_remove_equals(ref_seq, seq, int(pos)-1, cigar, add_equals, drop_seq)
-                if seq == "*":
-                    #According to spec, if omit SEQ must also omit QUAL (and samtools complains)
-                    qual = "*"
-            except:
-                sys.stderr.write(line)
-                raise
-            mod += 1
-            line = "\t".join([qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual, rest])
-    sys.stdout.write(line)
-sys.stderr.write("Modified %i out of %i reads\n" % (mod, count))
-sys.stderr.write("In total %i bases in all %i reads\n" % (bases, count))
+total_mod = 0
+total_bases = 0
+try:
+    for text, reads, mod, bases in processed_chunks(input_handle):
+        output_handle.write(text)
+        count += reads
+        total_mod += mod
+        total_bases += bases
+except KeyError, err:
+    sys.stderr.write("%s\n" % err.args[0])
+    sys.exit(2)
+if options.input_reads:
+    input_handle.close()
+if options.output_reads:
+    output_handle.close()
+sys.stderr.write("Modified %i out of %i reads\n" % (total_mod, count))
+sys.stderr.write("In total %i bases in all %i reads\n" % (total_bases, count))
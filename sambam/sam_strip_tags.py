@@ -17,6 +17,12 @@ $ samtools view -h original.bam | ./sam_strip_tags.py RG | samtools view -S -b -
 If your SAM/BAM files lack @SQ headers, you may need to give
 samtools the reference FASTA file as well.
 
+Alternatively give filenames with -i and -o, where any ending .bam are
+read or written as BAM directly (see bgzf_io.py), using -t threads for
+the compression:
+
+$ ./sam_strip_tags.py -i original.bam -o only_RG.bam RG
+
 To remove particular tags (a black list rather than a white list)
 include the switch -v (for invert, like the grep option). For example,
 to remove any original quality (OC) tags, use:
@@ -32,24 +38,50 @@ https://github.com/peterjc/picobio
 """
 
 import sys
+from optparse import OptionParser
+from bgzf_io import open_sam_input, open_sam_output
+
+parser = OptionParser(usage="usage: %prog [options] [tags]\n\n" + __doc__)
+parser.add_option("-v", dest="invert",
+                  action="store_true", default=False,
+                  help="Remove the given tags (rather than keeping only them)")
+parser.add_option("-i", "--input", dest="input_reads",
+                  type="string", metavar="FILE",
+                  help="Input SAM file (def. stdin), or BAM if the extension is .bam")
+parser.add_option("-o", "--output", dest="output_reads",
+                  type="string", metavar="FILE",
+                  help="Output SAM file (def. stdout), or BAM if the extension is .bam")
+parser.add_option("-t", "--threads", dest="threads",
+                  type="int", metavar="N", default=1,
+                  help="Number of threads for BAM compression (def. 1)")
+(options, args) = parser.parse_args()
+if options.threads < 1:
+    parser.error("Number of threads must be at least one")
+
+input_handle = open_sam_input(options.input_reads, options.threads)
+output_handle = open_sam_output(options.output_reads, options.threads)
 
-if "-v" in sys.argv[1:]:
-    black_list = set(x.strip() for x in sys.argv[1:] if x!="-v")
+if options.invert:
+    black_list = set(x.strip() for x in args)
     sys.stderr.write("Removing these tags: %s\n" % ", ".join(black_list))
-    for line in sys.stdin:
+    for line in input_handle:
         if line[0]!="@":
             #Should be a read
             qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual, tags = line.rstrip().split("\t", 11)
             tags = "\t".join(t for t in tags.split("\t") if t[:2] not in black_list)
             line = "\t".join([qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual, tags]) + "\n"
-        sys.stdout.write(line)
+        output_handle.write(line)
 else:
-    white_list = set(x.strip() for x in sys.argv[1:])
+    white_list = set(x.strip() for x in args)
     sys.stderr.write("Keeping only these tags: %s\n" % ", ".join(white_list))
-    for line in sys.stdin:
+    for line in input_handle:
         if line[0]!="@":
             #Should be a read
             qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual, tags = line.rstrip().split("\t", 11)
             tags = "\t".join(t for t in tags.split("\t") if t[:2] in white_list)
             line = "\t".join([qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual, tags]) + "\n"
-        sys.stdout.write(line)
+        output_handle.write(line)
+if options.input_reads:
+    input_handle.close()
+if options.output_reads:
+    output_handle.close()
@@ -8,6 +8,24 @@ remove any artifact duplicated mappings.
 
 This script is designed to be used as part of a Unix pipeline. It reads
 SAM format data from stdin, and writes SAM format data to stdout.
+Alternatively use -i and -o with filenames, where any ending .bam are
+read or written as BAM directly (see bgzf_io.py), e.g.
+
+$ ./sam_undouble_circles.py -c circles.fasta -i doubled.bam -o undoubled.bam
+
+Each read name (QNAME) is processed independently, so with --threads
+the reads are sent in chunks to a pool of worker processes, with the
+output written in the original order (and identical to running with
+a single thread).
+
+Normally all the lines for a read name are held in memory, and the
+de-duplicated alignments are output sorted by fragment, RNAME, POS and
+strand. With BWA-MEM's -a option, a read on a repetitive reference may
+have many thousands of alignments. Use --max-batch N to cap the memory
+used for such reads: once a read name has more than N (unique) lines
+those so far are output sorted, and further lines are output as they
+are read (in input order), keeping only the de-duplication keys in
+memory.
 
 This script is designed to be used on the BWA-MEM output where it seems
 with the -a option additional alignments are reported with the SEQ and
@@ -36,14 +54,20 @@ https://github.com/peterjc/picobio
 
 import sys
 import os
+import multiprocessing
+from collections import deque
 from optparse import OptionParser
+from bgzf_io import open_sam_input, open_sam_output
 
 def sys_exit(msg, error_level=1):
     """Print error message to stdout and quit with given error level."""
     sys.stderr.write("%s\n" % msg)
     sys.exit(error_level)
 
-VERSION = "0.0.1"
+VERSION = "0.0.4"
+
+#Number of read names per chunk in --threads mode
+CHUNK_SIZE = 10000
 
 parser = OptionParser(usage="usage: %prog [options]\n\n" + usage,
                       version="%prog "+VERSION)
@@ -60,10 +84,20 @@ parser.add_option("-c", "--cref", dest="circular_references",
 #Reads
 parser.add_option("-i", "--input", dest="input_reads",
                   type="string", metavar="FILE",
-                  help="Input file of SAM format mapped reads to be processed (def. stdin)")
+                  help="Input file of SAM format mapped reads to be processed (def. stdin), "
+                       "or BAM format if the extension is .bam")
 parser.add_option("-o","--output", dest="output_reads",
                   type="string", metavar="FILE",
-                  help="Output file for processed SAM format mapping (def. stdout)")
+                  help="Output file for processed SAM format mapping (def. stdout), "
+                       "or BAM format if the extension is .bam")
+parser.add_option("-t", "--threads", dest="threads",
+                  type="int", metavar="N", default=1,
+                  help="Number of worker processes, and threads for any BAM "
+                       "compression (def. 1)")
+parser.add_option("--max-batch", dest="max_batch",
+                  type="int", metavar="N", default=0,
+                  help="Stream the alignments for any read name with more than "
+                       "N lines, see above (def. 0, no limit)")
 
 (options, args) = parser.parse_args()
 
@@ -75,6 +109,10 @@ if (not options.linear_references) and (not options.circular_references):
     parser.error("You must supply some linear and/or circular references")
 if args:
     parser.error("No arguments expected")
+if options.threads < 1:
+    parser.error("Number of threads must be at least one")
+if options.max_batch < 0:
+    parser.error("Maximum batch size cannot be negative")
 
 
 def decode_cigar(cigar):
@@ -150,14 +188,18 @@ if options.circular_references:
     sys.stderr.write("Lengths of %i circular references loaded\n" % len(ref_len_circles))
 
 
-def batch_by_qname(input_handle):
-    """Yields lists of SAM lines, batching by read name.
+def batch_by_qname(input_handle, max_lines=0):
+    """Yields tuples of a list of SAM lines and a boolean, batching by read name.
 
     If there is a SAM header, that is returned first.
 
     There after you get all the SAM lines for read name one, then
     for read name two, etc. This assumes the SAM file is sorted
     or at least grouped by read name (typical of alignment output).
+
+    The boolean is True if the list is complete. If max_lines is given,
+    read names with more lines than this are returned in parts of at
+    most max_lines lines, with all but the last part marked incomplete.
     """
     batch = []
     batch_qname = None
@@ -171,136 +213,218 @@ def batch_by_qname(input_handle):
             # SAM read
             qname, rest = line.split("\t", 1)
             if batch_qname == qname:
+                if max_lines and len(batch) >= max_lines:
+                    yield batch, False
+                    batch = []
                 batch.append(line)
             else:
-                yield batch
+                yield batch, True
                 batch = [line]
                 batch_qname = qname
     # End of file
     if batch:
-        yield batch
+        yield batch, True
+
+
+def undouble_pos(pos, length, line):
+    """Returns POS (as a string) moved into the first copy of a doubled circle.
+
+    Returns None if POS is already within the first copy (or is zero).
+    """
+    int_pos = int(pos) - 1
+    if int_pos != -1 and length <= int_pos:
+        assert int_pos < length*2, \
+            "Have POS %s yet length is %i or %i when doubled!\n%r" \
+            % (pos, length, length*2, line)
+        return str(int_pos - length + 1)
+    return None
 
 
-def restore_seq(sam_lines):
-    """Process a batch/list of SAM lines restoring missing SEQ.
+class ReadProcessor(object):
+    """Restore SEQ, undouble and de-duplicate the SAM lines for one QNAME.
 
-    Designed for use on BWA MEM output where only the first read
-    has the SEQ and QUAL recorded, additional alignments are just
+    The lines are given to add (in one or more parts), and the kept lines
+    are returned sorted (by fragment, RNAME, POS and strand) by finish.
+    Each line is split into its fields once, and only lines which are
+    altered are joined back together again.
+
+    Restoring SEQ: Designed for use on BWA MEM output where only the first
+    read has the SEQ and QUAL recorded, additional alignments are just
     recorded with SEQ * and QUAL * instead.
+
+    Undoubling: POS and PNEXT for circular references are moved into the
+    range 1 to circle length (invalidating TLEN).
+
+    De-duplicating: Given a set of duplicates (same fragment, RNAME, POS
+    and strand after undoubling) the first line is preserved.
+    TODO - Look at the 0x100 FLAG for secondary alignment here?
+
+    If max_reads is non-zero, once there are more unique lines than this
+    those so far are returned sorted by add, and any later unique lines
+    are returned by add as they arrive. Only their keys are kept.
     """
-    global seq_mod
-    last_name = None
-    last_frag = None
-    for line in sam_lines:
-        qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual, rest = line.split("\t", 11)
-        if seq == "*":
-            if qname == last_name and get_frag(flag) == last_frag:
-                assert last_seq
-                exp_len = cigar_seq_len(cigar)
-                if exp_len < len(last_seq) and "H" in cigar:
-                    # Ought to work if record it as soft trimming...
-                    cigar = cigar.replace("H", "S")
+
+    def __init__(self, max_reads=0):
+        self.max_reads = max_reads
+        self.reads = {}
+        #Set of keys, once streaming
+        self.seen = None
+        self.last_frag = None
+        self.last_seq = None
+        self.last_qual = None
+
+    def add(self, sam_lines):
+        """Process some SAM lines, returns a list of any to output now."""
+        global seq_mod, dup_reads_removed
+        reads = self.reads
+        seen = self.seen
+        last_frag = self.last_frag
+        last_seq = self.last_seq
+        last_qual = self.last_qual
+        output = []
+        for line in sam_lines:
+            fields = line.split("\t", 11)
+            if len(fields) == 11:
+                #No optional tags, so QUAL has the trailing new line
+                fields[10] = fields[10].rstrip("\n")
+                fields.append(None)
+            qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual, rest = fields
+            int_flag = int(flag)
+            frag = get_frag(int_flag)
+            changed = False
+
+            #Restore SEQ (and QUAL) from the cached values for this fragment
+            if seq == "*":
+                if last_seq is not None and frag == last_frag:
                     exp_len = cigar_seq_len(cigar)
-                assert exp_len == len(last_seq), \
-                    "Cached SEQ %r length %i, but this read CIGAR expects length %i:\n%s" \
-                    % (last_seq, len(last_seq), cigar_seq_len(cigar), line)
-                seq = last_seq
-                if qual == "*":
-                    qual = last_qual
-                seq_mod += 1
-                line = "\t".join([qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual, rest])
-        elif "H" not in cigar:
-            #Cache the SEQ
-            last_name = qname
-            last_frag = get_frag(flag)
-            last_seq = seq
-            last_qual = qual
-        yield line
-
-def undouble_circle_mappings(sam_lines):
-    """Iterates over SAM lines updating POS for those mapped to circles."""
-    global ref_len_circles
-    for line in sam_lines:
-        qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, rest = line.split("\t", 9)
-        if rname in ref_len_circles:
-            length = ref_len_circles[rname]
-            int_pos= int(pos) - 1
-            if int_pos != -1 and length <= int_pos:
-                assert int_pos < length*2, \
-                    "Have POS %s yet length is %i or %i when doubled!\n%r" \
-                    % (pos, length, length*2, line)
-                int_pos -= length
-                pos = str(int_pos + 1)
-                tlen = "0" # old value invalidated
-        if rnext in ref_len_circles:
-            length = ref_len_circles[rnext]
-            int_pnext = int(pnext) - 1
-            if int_pnext != -1 and length <= int_pnext:
-                assert int_pnext < length*2, \
-                    "Have PNEXT %s yet length is %i or %i when doubled!\n%r" \
-                    % (pnext, length, length*2, line)
-                int_pnext -= length
-                pnext = str(int_pnext + 1)
-                tlen = "0" # old value invalidated
-        elif rnext == "=" and rname in ref_len_circles:
-            length = ref_len_circles[rname]
-            int_pnext = int(pnext) - 1
-            if int_pnext != -1 and length <= int_pnext:
-                assert int_pnext < length*2, \
-                    "Have PNEXT %s (%s) yet length is %i or %i when doubled!\n%r" \
-                    % (pnext, rname, length, length*2, line)
-                int_pnext -= length
-                pnext = str(int_pnext + 1)
+                    if exp_len < len(last_seq) and "H" in cigar:
+                        # Ought to work if record it as soft trimming...
+                        cigar = cigar.replace("H", "S")
+                        exp_len = cigar_seq_len(cigar)
+                    assert exp_len == len(last_seq), \
+                        "Cached SEQ %r length %i, but this read CIGAR expects length %i:\n%s" \
+                        % (last_seq, len(last_seq), cigar_seq_len(cigar), line)
+                    seq = last_seq
+                    if qual == "*":
+                        qual = last_qual
+                    seq_mod += 1
+                    changed = True
+            elif "H" not in cigar:
+                #Cache the SEQ
+                last_frag = frag
+                last_seq = seq
+                last_qual = qual
+
+            #Undouble POS and PNEXT
+            if rname in ref_len_circles:
+                new_pos = undouble_pos(pos, ref_len_circles[rname], line)
+                if new_pos is not None:
+                    pos = new_pos
+                    tlen = "0" # old value invalidated
+                    changed = True
+            if rnext == "=" and rname in ref_len_circles:
+                new_pnext = undouble_pos(pnext, ref_len_circles[rname], line)
+            elif rnext in ref_len_circles:
+                new_pnext = undouble_pos(pnext, ref_len_circles[rnext], line)
+            else:
+                new_pnext = None
+            if new_pnext is not None:
+                pnext = new_pnext
                 tlen = "0" # old value invalidated
-        yield "\t".join([qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, rest])
+                changed = True
+
+            #De-duplicate
+            key = (frag, rname, int(pos) - 1, bool(int_flag & 0x10))
+            if key in reads or (seen is not None and key in seen):
+                dup_reads_removed += 1
+                continue
+            if changed:
+                fields = [qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual]
+                if rest is None:
+                    line = "\t".join(fields) + "\n"
+                else:
+                    line = "\t".join(fields + [rest])
+            if seen is not None:
+                seen.add(key)
+                output.append(line)
+                continue
+            reads[key] = line
+            if self.max_reads and len(reads) > self.max_reads:
+                #Pathological read, output what we have and switch to streaming
+                output.extend(reads[key] for key in sorted(reads))
+                seen = self.seen = set(reads)
+                reads.clear()
+        self.last_frag = last_frag
+        self.last_seq = last_seq
+        self.last_qual = last_qual
+        return output
+
+    def finish(self):
+        """Returns the remaining lines to output, sorted."""
+        reads = self.reads
+        return [reads[key] for key in sorted(reads)]
+
+
+def process_batch(sam_lines):
+    """Restore SEQ, undouble and de-duplicate a batch of SAM lines for one QNAME.
+
+    Returns the lines to output, sorted. See ReadProcessor.
+    """
+    processor = ReadProcessor()
+    lines = processor.add(sam_lines)
+    return lines + processor.finish()
 
-def dedup_batch(sam_lines):
-    """De-duplicates and sorts a list of SAM lines for a single QNAME.
+#Check a tag-less line (only 11 fields) with SEQ and QUAL restored is
+#joined back together with just the new line after QUAL
+seq_mod = dup_reads_removed = 0
+temp = process_batch(["q1\t0\tcheck\t100\t30\t10M\t*\t0\t0\tACGTACGTAC\tIIIIIIIIII\n",
+                      "q1\t256\tcheck\t200\t30\t10M\t*\t0\t0\t*\t*\n"])
+assert temp[1] == "q1\t256\tcheck\t200\t30\t10M\t*\t0\t0\tACGTACGTAC\tIIIIIIIIII\n", temp
+del temp
 
-    Currently given a set of duplicates the first line is preserved.
-    TODO - Look at the 0x100 FLAG for secondary alignment here?
+
+def process_chunk(batches):
+    """Process a list of read batches in a worker process (see --threads).
+
+    Returns a tuple of the output SAM lines as a single string, the
+    number of reads output, and the number of reads with SEQ restored
+    and duplicates removed.
     """
-    global dup_reads_removed
-    reads = {}
-    batch_count = 0
-    #sys.stderr.write("-"*80 + "\n")
-    for line in sam_lines:
-        batch_count += 1
-        qname, flag, rname, pos, rest = line.split("\t", 4)
-        int_flag = int(flag)
-        frag = get_frag(int_flag)
-        int_pos = int(pos) - 1
-        rev_strand = bool(int_flag & 0x10)
-        key = (qname, frag, rname, int_pos, rev_strand)
-        if key in reads:
-            dup_reads_removed += 1
-            #sys.stderr.write("%s -Drop- %s" % (key, line))
-        else:
-            reads[key] = line
-            #sys.stderr.write("%s -KEEP- %s" % (key, line))
-    for key in sorted(reads):
-        yield reads[key]
-    #sys.stderr.write("%s %i --> %i\n" % (qname, batch_count, len(reads)))
+    global seq_mod, dup_reads_removed
+    seq_mod = dup_reads_removed = 0
+    lines = []
+    for batch in batches:
+        lines.extend(process_batch(batch))
+    return "".join(lines), len(lines), seq_mod, dup_reads_removed
+
+
+def collect(result):
+    """Write out and count the results from process_chunk."""
+    global count, seq_mod, dup_reads_removed
+    text, reads, restored, removed = result
+    output_handle.write(text)
+    count += reads
+    seq_mod += restored
+    dup_reads_removed += removed
 
 
-#Open handles
-if options.input_reads:
-    input_handle = open(options.input_reads)
-else:
-    input_handle = sys.stdin
-if options.output_reads:
-    output_handle = open(options.output_reads, "w")
-else:
-    output_handle = sys.stdout
-
-last_seq = None
-last_qual = None
-last_name = None
-last_frag = 0
 count = 0
 seq_mod = 0
 dup_reads_removed = 0
-for batch in batch_by_qname(input_handle):
+if options.threads > 1:
+    #Start the worker processes before any BAM compression threads
+    pool = multiprocessing.Pool(options.threads)
+    #Limit how many chunks are in memory at once, keeping input order
+    pending = deque()
+    chunk = []
+#ReadProcessor for a read name being processed in parts (see --max-batch)
+huge = None
+
+#Open handles
+input_handle = open_sam_input(options.input_reads, options.threads)
+output_handle = open_sam_output(options.output_reads, options.threads)
+
+for batch, complete in batch_by_qname(input_handle, options.max_batch):
     #sys.stderr.write("%s\nBatch of %i lines:\n%s%s\n" % ("-" * 80, len(batch), "".join(batch), "-" * 80))
     if not batch:
         continue
@@ -332,9 +456,44 @@ for batch in batch_by_qname(input_handle):
             output_handle.write(line)
         continue
     # Should be a batch of reads...
-    for line in dedup_batch(undouble_circle_mappings(restore_seq(batch))):
-        count += 1
-        output_handle.write(line)
+    if huge is not None or not complete:
+        #Part of a huge read name, handled here rather than in a worker
+        if huge is None:
+            if options.threads > 1:
+                #Output the preceding reads first
+                if chunk:
+                    pending.append(pool.apply_async(process_chunk, (chunk,)))
+                    chunk = []
+                while pending:
+                    collect(pending.popleft().get())
+            huge = ReadProcessor(options.max_batch)
+            sys.stderr.write("Read %s has over %i lines, streaming it\n"
+                             % (batch[0].split("\t", 1)[0], options.max_batch))
+        lines = huge.add(batch)
+        if complete:
+            lines.extend(huge.finish())
+            huge = None
+        count += len(lines)
+        output_handle.write("".join(lines))
+        continue
+    if options.threads > 1:
+        chunk.append(batch)
+        if len(chunk) >= CHUNK_SIZE:
+            pending.append(pool.apply_async(process_chunk, (chunk,)))
+            chunk = []
+            if len(pending) >= 2 * options.threads:
+                collect(pending.popleft().get())
+        continue
+    lines = process_batch(batch)
+    count += len(lines)
+    output_handle.write("".join(lines))
+if options.threads > 1:
+    if chunk:
+        pending.append(pool.apply_async(process_chunk, (chunk,)))
+    while pending:
+        collect(pending.popleft().get())
+    pool.close()
+    pool.join()
 
 #Close handles
 if options.input_reads:
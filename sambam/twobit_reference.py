@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+usage = """Python module for memory mapped 2-bit reference genomes.
+
+Tools like sam_seq_equals.py need random access to the reference bases
+for each read. Loading a whole chromosome as a Python string for each
+change of reference is slow (especially for name sorted or unsorted
+input) and needs a lot of memory. Instead, the reference can first be
+converted to the UCSC 2bit format (four bases per byte, plus a list of
+N blocks), which is then memory mapped. Windows of bases are decoded
+on demand, and the most recently used windows are cached.
+
+To build a 2bit file from a FASTA file:
+
+$ ./twobit_reference.py -o reference.2bit reference.fasta
+
+Files made by UCSC's faToTwoBit can also be used. Note the 2bit format
+only holds A, C, G, T and N, so any other IUPAC ambiguity codes in the
+FASTA file are stored as N (this gives a warning). Lower case (soft
+masked) bases are stored as upper case.
+
+This can also be used as a Python module, see the TwoBitReference class
+(e.g. used by sam_seq_equals.py).
+
+See also: http://genome.ucsc.edu/FAQ/FAQformat.html#format7
+"""
+
+import sys
+import struct
+from collections import OrderedDict
+from optparse import OptionParser
+import numpy as np
+
+def sys_exit(msg, error_level=1):
+    """Print error message to stdout and quit with given error level."""
+    sys.stderr.write("%s\n" % msg)
+    sys.exit(error_level)
+
+VERSION = "0.0.1"
+
+SIGNATURE = 0x1A412743
+
+#Number of bases per decoded window
+WINDOW_SIZE = 65536
+
+#Number of decoded windows to keep (each using WINDOW_SIZE bytes)
+CACHE_WINDOWS = 256
+
+#ASCII codes of the bases for each 2-bit value, and the reverse
+BASES = np.fromstring("TCAG", np.uint8)
+CODES = np.zeros(256, np.uint8)
+CODES[BASES] = np.arange(4)
+ACGT = np.zeros(256, np.bool_)
+ACGT[BASES] = True
+N = ord("N")
+
+
+class TwoBitSequence(object):
+    """One reference from a TwoBitReference, sliced like a string.
+
+    Slicing returns a NumPy array of the (upper case) ASCII codes for
+    those bases, e.g. reference["chrX"][1000:1100].tostring()
+    """
+
+    def __init__(self, parent, name, length, offset, n_starts, n_ends):
+        self.parent = parent
+        self.name = name
+        self.length = length
+        #Offset of the packed bases in the file
+        self.offset = offset
+        self.n_starts = n_starts
+        self.n_ends = n_ends
+
+    def __len__(self):
+        return self.length
+
+    def _window(self, number):
+        """Decode the given window of bases."""
+        start = number * WINDOW_SIZE
+        end = min(self.length, start + WINDOW_SIZE)
+        packed = np.asarray(self.parent.data[self.offset + start // 4:self.offset + (end + 3) // 4])
+        codes = np.empty((len(packed), 4), np.uint8)
+        codes[:, 0] = packed >> 6
+        codes[:, 1] = (packed >> 4) & 3
+        codes[:, 2] = (packed >> 2) & 3
+        codes[:, 3] = packed & 3
+        bases = BASES[codes.ravel()[:end - start]]
+        #Any N blocks overlapping this window
+        for i in range(np.searchsorted(self.n_ends, start, "right"),
+                       np.searchsorted(self.n_starts, end, "left")):
+            bases[max(0, self.n_starts[i] - start):self.n_ends[i] - start] = N
+        return bases
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step not in (None, 1):
+            raise TypeError("Only simple slices are supported")
+        start, end, step = index.indices(self.length)
+        if end <= start:
+            return np.zeros(0, np.uint8)
+        parts = []
+        for number in range(start // WINDOW_SIZE, (end - 1) // WINDOW_SIZE + 1):
+            window = self.parent.cached_window(self, number)
+            offset = number * WINDOW_SIZE
+            parts.append(window[max(start, offset) - offset:end - offset])
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    def __str__(self):
+        return self[0:self.length].tostring()
+
+
+class TwoBitReference(object):
+    """Read only memory mapped access to a UCSC 2bit file.
+
+    Acts like a dictionary of reference names to TwoBitSequence objects.
+    """
+
+    def __init__(self, filename):
+        self.data = np.memmap(filename, np.uint8, "r")
+        signature = struct.unpack("<I", self.data[:4].tostring())[0]
+        if signature == SIGNATURE:
+            self.endian = "<"
+        elif signature == struct.unpack(">I", struct.pack("<I", SIGNATURE))[0]:
+            self.endian = ">"
+        else:
+            raise ValueError("%s is not a 2bit file" % filename)
+        version, count = self._unpack("II", 4)
+        if version != 0:
+            raise ValueError("Unsupported 2bit version %i in %s" % (version, filename))
+        self.sequences = OrderedDict()
+        offset = 16
+        for i in range(count):
+            size = self.data[offset]
+            name = self.data[offset + 1:offset + 1 + size].tostring()
+            self.sequences[name] = self._unpack("I", offset + 1 + size)[0]
+            offset += 5 + size
+        self._cache = OrderedDict()
+
+    def _unpack(self, fmt, offset):
+        fmt = self.endian + fmt
+        return struct.unpack(fmt, self.data[offset:offset + struct.calcsize(fmt)].tostring())
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def __iter__(self):
+        return iter(self.sequences)
+
+    def __contains__(self, name):
+        return name in self.sequences
+
+    def __getitem__(self, name):
+        offset = self.sequences[name]
+        if isinstance(offset, TwoBitSequence):
+            return offset
+        length, n_count = self._unpack("II", offset)
+        offset += 8
+        n_starts = np.array(self._unpack("%iI" % n_count, offset), np.int64)
+        n_ends = n_starts + self._unpack("%iI" % n_count, offset + 4 * n_count)
+        offset += 8 * n_count
+        mask_count = self._unpack("I", offset)[0]
+        #Skip the (soft) mask blocks, and reserved field
+        offset += 8 + 8 * mask_count
+        sequence = TwoBitSequence(self, name, length, offset, n_starts, n_ends)
+        self.sequences[name] = sequence
+        return sequence
+
+    def cached_window(self, sequence, number):
+        """Returns a decoded window of bases, using a cache."""
+        key = (sequence.name, number)
+        try:
+            window = self._cache.pop(key)
+        except KeyError:
+            window = sequence._window(number)
+        self._cache[key] = window
+        if len(self._cache) > CACHE_WINDOWS:
+            self._cache.popitem(last=False)
+        return window
+
+    def close(self):
+        self._cache.clear()
+        del self.data
+
+
+def fasta_records(fasta_filename):
+    """Yields (name, sequence) tuples from a FASTA file."""
+    handle = open(fasta_filename)
+    name = None
+    lines = []
+    for line in handle:
+        if line[0] == ">":
+            if name is not None:
+                yield name, "".join(lines)
+            name = line[1:].split(None, 1)[0]
+            lines = []
+        else:
+            lines.append(line.strip())
+    if name is not None:
+        yield name, "".join(lines)
+    handle.close()
+
+
+def build(fasta_filename, twobit_filename):
+    """Convert a FASTA file into a UCSC 2bit file."""
+    names = [name for name, seq in fasta_records(fasta_filename)]
+    if not names:
+        sys_exit("No sequences found in FASTA file %s" % fasta_filename)
+    for name in names:
+        if len(name) > 255:
+            sys_exit("Sequence name too long for 2bit format: %s" % name)
+    handle = open(twobit_filename, "wb")
+    handle.write(struct.pack("<IIII", SIGNATURE, 0, len(names), 0))
+    index_offset = handle.tell()
+    #Index offsets are filled in once the sequences are written
+    for name in names:
+        handle.write(struct.pack("<B", len(name)) + name + struct.pack("<I", 0))
+    offsets = []
+    for name, seq in fasta_records(fasta_filename):
+        bases = np.fromstring(seq.upper(), np.uint8)
+        ambiguous = ~ACGT[bases]
+        other = (ambiguous & (bases != N)).sum()
+        if other:
+            sys.stderr.write("Warning, %i ambiguous bases in %s stored as N\n" % (other, name))
+        #Start and end of each run of N (or other ambiguous) bases
+        changes = np.flatnonzero(np.diff(np.concatenate([[0], ambiguous.view(np.int8), [0]])))
+        n_starts = changes[0::2]
+        n_sizes = changes[1::2] - n_starts
+        codes = CODES[bases]
+        codes = np.concatenate([codes, np.zeros(-len(codes) % 4, np.uint8)]).reshape(-1, 4)
+        packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+        offsets.append(handle.tell())
+        if handle.tell() >= 2 ** 32:
+            sys_exit("2bit file too large (over 4GB)")
+        handle.write(struct.pack("<II", len(bases), len(n_starts)))
+        handle.write(n_starts.astype("<u4").tostring())
+        handle.write(n_sizes.astype("<u4").tostring())
+        #No (soft) mask blocks, and the reserved field
+        handle.write(struct.pack("<II", 0, 0))
+        handle.write(packed.astype(np.uint8).tostring())
+        sys.stderr.write("Added %s, length %i with %i N blocks\n" % (name, len(bases), len(n_starts)))
+    handle.seek(index_offset)
+    for name, offset in zip(names, offsets):
+        handle.write(struct.pack("<B", len(name)) + name + struct.pack("<I", offset))
+    handle.close()
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options] reference.fasta\n\n" + usage,
+                          version="%prog "+VERSION)
+    parser.add_option("-o", "--output", dest="output",
+                      type="string", metavar="FILE",
+                      help="2bit file to create from the FASTA file")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("Expected one FASTA file")
+    if not options.output:
+        parser.error("Output 2bit filename (-o) required")
+    build(args[0], options.output)